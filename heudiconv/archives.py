@@ -0,0 +1,557 @@
+"""Access to files within (possibly compressed) tarballs without extraction
+
+Members of tarballs are registered under paths within some directory, as
+if they were extracted there.  Such paths can be passed around as any
+other file path, read via `open_file`, and get extracted to the disk only
+when needed (see `materialize_files`).
+
+Lists of members of tarballs are kept in an index directory (see
+`set_index_dir`), so unchanged tarballs do not need to be decompressed
+just to find out what they contain.  If `indexed_gzip` is available, seek
+points of gzip compressed tarballs are kept there as well, so any member
+can be read without decompressing the tarball from its beginning.  Index
+files which were not used for long, or do not fit into the size limit, get
+evicted (see `evict_indexes`).
+"""
+
+import hashlib
+import io
+import os
+import os.path as op
+import pickle
+import shutil
+import tarfile
+import tempfile
+import time
+from collections import OrderedDict
+
+from .cache import DEFAULT_MAX_AGE, DEFAULT_MAX_SIZE, get_default_cache_dir
+
+import logging
+lgr = logging.getLogger(__name__)
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# bump whenever format of the stored index changes
+INDEX_FORMAT_VERSION = 1
+
+# path -> (tarball, TarInfo) for all registered members
+_members = {}
+# tarball -> open TarFile, for reading members in the current process
+_open_tarfiles = {}
+_open_tarfiles_pid = None
+# (path, content) of the member read last, so it could be read again without
+# seeking back within a compressed tarball
+_last_read = (None, None)
+# path -> os.stat_result of files, as obtained while finding them
+_stats = {}
+# temporary directories to register members under, made by this process
+_temp_dirs = []
+_temp_dirs_pid = None
+# directory to keep indexes of tarballs in, None to not keep them
+_DEFAULT_INDEX_DIR = object()
+_index_dir = _DEFAULT_INDEX_DIR
+
+
+def _map(func, args, jobs=1):
+    """Return [func(*a) for a in args], using a pool of `jobs` processes"""
+    if jobs is None or jobs <= 1 or len(args) <= 1:
+        return [func(*a) for a in args]
+    from multiprocessing import Pool
+    pool = Pool(min(jobs, len(args)))
+    try:
+        res = pool.map(_call, [(func,) + tuple(a) for a in args], 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return res
+
+
+def _call(args):
+    return args[0](*args[1:])
+
+
+def set_index_dir(path):
+    """Set directory to keep indexes of tarballs in
+
+    Parameters
+    ----------
+    path : str or None
+      If None, indexes are neither used nor stored
+    """
+    global _index_dir
+    _index_dir = path
+
+
+def get_index_dir():
+    """Return directory to keep indexes of tarballs in, or None
+
+    Unless set by `set_index_dir`, it is `tarballs` under
+    `get_default_cache_dir()` as of the time of the call
+    """
+    if _index_dir is _DEFAULT_INDEX_DIR:
+        return op.join(get_default_cache_dir(), 'tarballs')
+    return _index_dir
+
+
+def _get_index_path(archive, index_dir, ext):
+    digest = hashlib.md5(op.realpath(archive).encode('utf-8')).hexdigest()
+    return op.join(index_dir, digest + ext)
+
+
+def _touch(path):
+    """Mark the index file as used now, so it does not get evicted"""
+    try:
+        os.utime(path, None)
+    except OSError as exc:
+        lgr.debug("Failed to update times of %s: %s", path, exc)
+
+
+def evict_indexes(index_dir, max_age=DEFAULT_MAX_AGE,
+                  max_size=DEFAULT_MAX_SIZE):
+    """Remove index files which were not used for too long or do not fit
+
+    Index files get their modification time updated whenever they are used,
+    so those used least recently are removed first.
+
+    Parameters
+    ----------
+    index_dir : str
+    max_age : float, optional
+      Files not used for longer than that (in seconds) get removed
+    max_size : int, optional
+      Maximal total size (in bytes) of the files to keep
+    """
+    files = []
+    for name in os.listdir(index_dir):
+        if name.startswith('.tmp'):
+            continue
+        path = op.join(index_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # removed by another process meanwhile
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    evicted = []
+    total = 0
+    for mtime, size, path in sorted(files, reverse=True):
+        total += size
+        if (max_age is not None and mtime < time.time() - max_age) \
+                or (max_size is not None and total > max_size):
+            evicted.append(path)
+    for path in evicted:
+        try:
+            os.unlink(path)
+        except OSError as exc:
+            lgr.debug("Failed to remove %s: %s", path, exc)
+    if evicted:
+        lgr.debug("Removed %d stale index files from %s", len(evicted),
+                  index_dir)
+
+
+def _is_gzipped(archive):
+    with open(archive, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def _save_atomically(path, write):
+    """Save the file via write(fileobj), so it is never seen incomplete"""
+    dirname = op.dirname(path)
+    if not op.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _load_members_index(archive, index_dir):
+    """Return stored TarInfo of the files, or None if the tarball changed"""
+    path = _get_index_path(archive, index_dir, '.members')
+    if not op.exists(path):
+        return None
+    st = os.stat(archive)
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except Exception as exc:
+        lgr.debug("Failed to load index %s of %s: %s", path, archive, exc)
+        return None
+    if (index.get('version'), index.get('path'), index.get('size'),
+            index.get('mtime')) != (INDEX_FORMAT_VERSION,
+                                    op.realpath(archive), st.st_size,
+                                    st.st_mtime):
+        return None
+    _touch(path)
+    return index['members']
+
+
+def _save_members_index(archive, index_dir, members):
+    st = os.stat(archive)
+    index = {
+        'version': INDEX_FORMAT_VERSION,
+        'path': op.realpath(archive),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'members': members,
+    }
+    try:
+        _save_atomically(_get_index_path(archive, index_dir, '.members'),
+                         lambda f: pickle.dump(index, f, protocol=2))
+    except (IOError, OSError) as exc:
+        lgr.warning("Failed to store index of %s: %s", archive, exc)
+
+
+def _get_gzip_index_path(archive, index_dir):
+    """Return path to the seek points of a gzipped tarball, or None"""
+    if not (indexed_gzip and index_dir and _is_gzipped(archive)):
+        return None
+    # seek points are valid only along with the list of members, so they
+    # are named after the tarball's size and mtime as well
+    st = os.stat(archive)
+    return _get_index_path(
+        archive, index_dir, '-%d-%d.gzidx' % (st.st_size, st.st_mtime))
+
+
+def _remove_stale_gzip_indexes(archive, index_dir, gzip_index):
+    """Remove seek points of the previous versions of the tarball"""
+    prefix = op.basename(_get_index_path(archive, index_dir, '-'))
+    for name in os.listdir(index_dir):
+        path = op.join(index_dir, name)
+        if name.startswith(prefix) and name.endswith('.gzidx') \
+                and path != gzip_index:
+            try:
+                os.unlink(path)
+            except OSError as exc:
+                lgr.debug("Failed to remove %s: %s", path, exc)
+
+
+def _list_archive(archive, index_dir=None):
+    """Return TarInfo of all the files within the tarball
+
+    If `index_dir` is provided, the list is taken from the index of the
+    tarball stored there, or stored there (along with gzip seek points)
+    for subsequent calls
+    """
+    if index_dir:
+        members = _load_members_index(archive, index_dir)
+        if members is not None:
+            lgr.debug("Loaded list of %d files of %s from the index",
+                      len(members), archive)
+            return members
+    gzip_index = _get_gzip_index_path(archive, index_dir)
+    if gzip_index:
+        fobj = indexed_gzip.IndexedGzipFile(archive)
+        tf = tarfile.open(fileobj=fobj, mode='r:')
+    else:
+        fobj = None
+        tf = tarfile.open(archive)
+    try:
+        members = [member for member in tf.getmembers() if member.isfile()]
+        if gzip_index:
+            fobj.build_full_index()
+            try:
+                _save_atomically(gzip_index,
+                                 lambda f: fobj.export_index(fileobj=f))
+            except (IOError, OSError) as exc:
+                lgr.warning("Failed to store gzip index of %s: %s",
+                            archive, exc)
+            else:
+                _remove_stale_gzip_indexes(archive, index_dir, gzip_index)
+    finally:
+        tf.close()
+        if fobj is not None:
+            fobj.close()
+    if index_dir:
+        _save_members_index(archive, index_dir, members)
+        evict_indexes(index_dir)
+    return members
+
+
+def make_temp_dir():
+    """Make a temporary directory to register members of tarballs under
+
+    It gets removed, with all the files extracted into it, by
+    `remove_temp_dirs`
+    """
+    global _temp_dirs_pid
+    if _temp_dirs_pid != os.getpid():
+        # those were made by the parent process
+        del _temp_dirs[:]
+        _temp_dirs_pid = os.getpid()
+    tmpdir = tempfile.mkdtemp(prefix='heudiconvDCM')
+    _temp_dirs.append(tmpdir)
+    return tmpdir
+
+
+def is_temporary(filename):
+    """Return True if the file is (to be) extracted into a temporary directory
+
+    Such files get removed once converted, so should not be symlinked
+    """
+    filename = op.abspath(filename)
+    return any(filename.startswith(op.join(tmpdir, ''))
+               for tmpdir in _temp_dirs)
+
+
+def remove_temp_dirs():
+    """Remove temporary directories made by `make_temp_dir` in this process
+
+    Should be called only once no other process (e.g. converting another
+    study session) might need files extracted into them
+    """
+    if _temp_dirs_pid == os.getpid():
+        for tmpdir in _temp_dirs:
+            if op.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+    del _temp_dirs[:]
+
+
+def register_archive(archive, topdir):
+    """Register files within the tarball as if they were extracted to topdir
+
+    Parameters
+    ----------
+    archive : str
+      Path to the tarball (can be compressed)
+    topdir : str
+      Directory to (later) extract files into
+
+    Returns
+    -------
+    list of str
+      Paths of the files of the tarball under topdir, in the order they
+      are stored in the tarball
+    """
+    return register_archives([archive], topdir)[0]
+
+
+def register_archives(archives, topdir, jobs=1):
+    """Register files within multiple tarballs, see `register_archive`
+
+    Parameters
+    ----------
+    archives : list of str
+    topdir : str
+    jobs : int, optional
+      Number of processes to list (i.e. decompress) tarballs with
+
+    Returns
+    -------
+    list of list of str
+      Paths of the files per each tarball, in the order of `archives`
+    """
+    archives = [op.abspath(archive) for archive in archives]
+    index_dir = get_index_dir()
+    res = []
+    for archive, members in zip(
+            archives,
+            _map(_list_archive, [(a, index_dir) for a in archives], jobs)):
+        paths = []
+        for member in members:
+            path = op.join(topdir, member.name)
+            _members[path] = (archive, member)
+            paths.append(path)
+        lgr.debug("Registered %d files from %s under %s",
+                  len(paths), archive, topdir)
+        res.append(paths)
+    return res
+
+
+def is_archived(filename):
+    """Return True if the file is a registered member not extracted yet"""
+    return filename in _members and not op.lexists(filename)
+
+
+def _get_tarfile(archive):
+    global _open_tarfiles_pid
+    if _open_tarfiles_pid != os.getpid():
+        # those were opened by the parent process
+        _open_tarfiles.clear()
+        _open_tarfiles_pid = os.getpid()
+    if archive not in _open_tarfiles:
+        gzip_index = _get_gzip_index_path(archive, get_index_dir())
+        if gzip_index and op.exists(gzip_index):
+            # members can be read in any order without decompressing
+            # everything preceding them
+            fobj = indexed_gzip.IndexedGzipFile(archive)
+            fobj.import_index(gzip_index)
+            _touch(gzip_index)
+            _open_tarfiles[archive] = tarfile.open(fileobj=fobj, mode='r:')
+        else:
+            _open_tarfiles[archive] = tarfile.open(archive)
+    return _open_tarfiles[archive]
+
+
+def _get_member(filename):
+    archive, member = _members[filename]
+    return archive, _get_tarfile(archive), member
+
+
+def open_file(filename):
+    """Open the file, or the registered member if not extracted, for reading
+
+    Members of compressed tarballs are read most efficiently in the order
+    they are stored in the tarball, since then the tarball gets
+    decompressed only once.  The same member can be opened again right
+    away at no cost.
+
+    Returns
+    -------
+    file object
+      Binary, and supporting seek
+    """
+    global _last_read
+    if not is_archived(filename):
+        return open(filename, 'rb')
+    if _last_read[0] != filename:
+        _, tf, member = _get_member(filename)
+        _last_read = (filename, tf.extractfile(member).read())
+    return io.BytesIO(_last_read[1])
+
+
+def set_file_stats(stats):
+    """Set stat results of files to be used by `get_file_key`
+
+    So files found by scanning directories (see `parser.find_files`) do not
+    need to be stat'ed again, which is costly e.g. on NFS.
+
+    Parameters
+    ----------
+    stats : dict
+      path -> os.stat_result, replacing those set before
+    """
+    global _stats
+    _stats = dict(stats)
+
+
+def get_file_stat(filename):
+    """Return os.stat_result of the file, as set by `set_file_stats` if so"""
+    return _stats.get(filename) or os.stat(filename)
+
+
+def get_file_key(filename):
+    """Return (path, size, mtime) identifying the content of the file
+
+    For registered members, extracted or not, path points within the
+    tarball, and mtime is the one of the tarball itself.  Stat results set
+    by `set_file_stats` are used for other files if available
+    """
+    if filename not in _members:
+        st = get_file_stat(filename)
+        return op.realpath(filename), st.st_size, st.st_mtime
+    archive, member = _members[filename]
+    return ('%s//%s' % (op.realpath(archive), member.name), member.size,
+            os.stat(archive).st_mtime)
+
+
+def relocate_files(files, registered):
+    """Return files, with those gone replaced by the same registered members
+
+    e.g. conversion tables of previous runs refer to files of tarballs
+    under temporary directories, which got removed since then (see
+    `remove_temp_dirs`).  Such files are replaced by the files among
+    `registered` which are members of the same name, i.e. of the name
+    matching the longest trailing part of their paths.  Files matching
+    members of multiple `registered` files are left as they are
+    """
+    by_name = {}
+    for f in registered:
+        if f in _members:
+            by_name.setdefault(_members[f][1].name, []).append(f)
+    res = []
+    for f in files:
+        if f not in _members and not op.lexists(f):
+            parts = f.replace(os.sep, '/').split('/')
+            for i in range(1, len(parts)):
+                candidates = by_name.get('/'.join(parts[i:]))
+                if candidates:
+                    if len(candidates) == 1:
+                        f = candidates[0]
+                    break
+        res.append(f)
+    return res
+
+
+def get_archive(filename):
+    """Return path to the tarball of the file if it was not extracted yet"""
+    return _members[filename][0] if is_archived(filename) else None
+
+
+def _extract_members(archive, members):
+    """Extract (TarInfo, path) members of the tarball, in the given order"""
+    tf = _get_tarfile(archive)
+    for member, path in members:
+        dirname = op.dirname(path)
+        if not op.exists(dirname):
+            os.makedirs(dirname)
+        src = tf.extractfile(member)
+        with open(path, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        # sanitize permission bits
+        os.chmod(path, 0o700)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+def materialize_files(files, jobs=1):
+    """Extract registered members among the files if not extracted yet
+
+    Members are extracted in the order they are stored within each tarball,
+    so a tarball is decompressed at most once.
+
+    Parameters
+    ----------
+    files : list of str
+    jobs : int, optional
+      Number of processes to extract from multiple tarballs concurrently
+    """
+    per_archive = OrderedDict()
+    for f in files:
+        if is_archived(f):
+            archive, member = _members[f]
+            per_archive.setdefault(archive, []).append(
+                (member.offset, member, f))
+    args = []
+    for archive, members in per_archive.items():
+        lgr.info("Extracting %d files from %s", len(members), archive)
+        args.append((archive, [(member, path) for _, member, path in
+                               sorted(members, key=lambda m: m[0])]))
+    _map(_extract_members, args, jobs)
+
+
+def clear_materialized_files(files):
+    """Remove registered members among the files which were extracted
+
+    They stay registered, so could be extracted again if needed.  Other
+    files are left intact
+    """
+    for f in files:
+        if f in _members and op.lexists(f):
+            os.unlink(f)
+
+
+def close_archives():
+    """Close tarballs opened by this process"""
+    global _last_read
+    _last_read = (None, None)
+    if _open_tarfiles_pid == os.getpid():
+        for tf in _open_tarfiles.values():
+            tf.close()
+            # TarFile does not close a file object it was given
+            tf.fileobj.close()
+    _open_tarfiles.clear()
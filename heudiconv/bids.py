@@ -11,8 +11,7 @@ import csv
 from random import sample
 from glob import glob
 
-from heudiconv.external.pydicom import dcm
-
+from .dicoms import get_dicom_header_fields
 from .parser import find_files
 from .utils import (
     load_json,
@@ -75,7 +74,8 @@ def populate_bids_templates(path, defaults={}):
     # FIELDS_TO_TRACK = {'RepetitionTime', 'FlipAngle', 'EchoTime',
     #                    'Manufacturer', 'SliceTiming', ''}
     for fpath in find_files('.*_task-.*\_bold\.json', topdir=path,
-                        exclude_vcs=True, exclude="/\.(datalad|heudiconv)/"):
+                        exclude_vcs=True,
+                        exclude_dirs="/\.(datalad|heudiconv)/$"):
         task = re.sub('.*_(task-[^_\.]*(_acq-[^_\.]*)?)_.*', r'\1', fpath)
         json_ = load_json(fpath)
         if task not in tasks:
@@ -193,12 +193,14 @@ def find_subj_ses(f_name):
     return res.get('subj', None), res.get('ses', None)
 
 
-def save_scans_key(item, bids_files):
+def save_scans_key(item, bids_files, header_store=None):
     """
     Parameters
     ----------
     item:
     bids_files: str or list
+    header_store: dict, optional
+        Fields of DICOM headers, see `get_formatted_scans_key_row`
 
     Returns
     -------
@@ -215,7 +217,8 @@ def save_scans_key(item, bids_files):
         # get filenames
         f_name = '/'.join(bids_file.split('/')[-2:])
         f_name = f_name.replace('json', 'nii.gz')
-        rows[f_name] = get_formatted_scans_key_row(item[-1][0])
+        rows[f_name] = get_formatted_scans_key_row(item[-1][0],
+                                                   header_store)
         subj_, ses_ = find_subj_ses(f_name)
         if not subj_:
             lgr.warning(
@@ -280,11 +283,16 @@ def add_rows_to_scans_keys_file(fn, newrows):
         writer.writerows([header] + data_rows_sorted)
 
 
-def get_formatted_scans_key_row(dcm_fn):
+def get_formatted_scans_key_row(dcm_fn, header_store=None):
     """
     Parameters
     ----------
-    item
+    dcm_fn: str
+        DICOM file
+    header_store: dict, optional
+        Fields of DICOM headers as populated while grouping DICOMs (see
+        `group_dicoms_into_seqinfos`).  The file is read only if it is not
+        there
 
     Returns
     -------
@@ -292,29 +300,26 @@ def get_formatted_scans_key_row(dcm_fn):
         [ISO acquisition time, performing physician name, random string]
 
     """
-    dcm_data = dcm.read_file(dcm_fn, stop_before_pixels=True, force=True)
+    fields = get_dicom_header_fields(dcm_fn, header_store)
     # we need to store filenames and acquisition times
     # parse date and time and get it into isoformat
     try:
-        date = dcm_data.ContentDate
-        time = dcm_data.ContentTime.split('.')[0]
+        date = fields['ContentDate']
+        time = fields['ContentTime'].split('.')[0]
         td = time + date
         acq_time = datetime.strptime(td, '%H%M%S%Y%m%d').isoformat()
-    except AttributeError as exc:
-        lgr.warning("Failed to get date/time for the content: %s", str(exc))
+    except KeyError as exc:
+        lgr.warning("Failed to get date/time for the content: no %s",
+                    str(exc))
         acq_time = None
     # add random string
     # But let's make it reproducible by using all UIDs
     # (might change across versions?)
     randcontent = u''.join(
-        [getattr(dcm_data, f) or '' for f in sorted(dir(dcm_data))
-         if f.endswith('UID')]
+        [fields[f] or '' for f in sorted(fields) if f.endswith('UID')]
     )
     randstr = hashlib.md5(randcontent.encode()).hexdigest()[:8]
-    try:
-        perfphys = dcm_data.PerformingPhysicianName
-    except AttributeError:
-        perfphys = ''
+    perfphys = fields.get('PerformingPhysicianName', '')
     row = [acq_time, perfphys, randstr]
     # empty entries should be 'n/a'
     # https://github.com/dartmouth-pbs/heudiconv/issues/32
@@ -0,0 +1,634 @@
+"""Persistent caches of information extracted from DICOM headers, and of
+files converted from DICOMs"""
+
+import inspect
+import hashlib
+import os
+import os.path as op
+import pickle
+import shutil
+import sqlite3
+import time
+import types
+
+import logging
+lgr = logging.getLogger(__name__)
+
+# bump whenever format of the cached values changes
+CACHE_FORMAT_VERSION = '3'
+# entries not used for that long (in seconds) get evicted
+DEFAULT_MAX_AGE = 90 * 24 * 3600
+# if cached values take more than that (in bytes), least recently used get
+# evicted
+DEFAULT_MAX_SIZE = 1024 ** 3
+# as DEFAULT_MAX_SIZE, for files converted from DICOMs (see `ConversionCache`)
+DEFAULT_MAX_CONVERSIONS_SIZE = 20 * 1024 ** 3
+
+
+def get_default_cache_dir():
+    """Return directory (under XDG_CACHE_HOME) for heudiconv caches"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or op.join(op.expanduser('~'), '.cache')
+    return op.join(cache_home, 'heudiconv')
+
+
+def _get_versions():
+    """Versions of the modules whose objects might be pickled in the cache"""
+    from heudiconv import __version__
+    from heudiconv.external.pydicom import dcm
+    import nibabel
+    return '-'.join([CACHE_FORMAT_VERSION, __version__,
+                     getattr(dcm, '__version__', '?'), nibabel.__version__])
+
+
+def _iter_codes(code):
+    """Generate the code object and those nested within it, recursively"""
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            for code_ in _iter_codes(const):
+                yield code_
+
+
+def get_callable_digest(func, _seen=None):
+    """Return a digest of the code of a callable, e.g. heuristic's filter_dicom
+
+    Digest covers the source code of the function along with module level
+    values (e.g. lists of UIDs to skip) and functions it refers to, also
+    from within code nested in it (e.g. comprehensions), so it changes
+    whenever results of the function might change.
+
+    Returns
+    -------
+    str or None
+      None if no source code is available for `func`
+    """
+    if _seen is None:
+        _seen = set()
+    _seen.add(func)
+    try:
+        parts = [inspect.getsource(func)]
+    except (IOError, OSError, TypeError):
+        return None
+    code = getattr(func, '__code__', None)
+    globals_ = getattr(func, '__globals__', {})
+    names = set()
+    for code_ in _iter_codes(code) if code else []:
+        names.update(code_.co_names)
+        if code_ is not code:
+            # e.g. of comprehensions, lambdas, or inner functions
+            parts.append('%s %r %r' % (
+                hashlib.md5(code_.co_code).hexdigest(),
+                [c for c in code_.co_consts
+                 if not isinstance(c, types.CodeType)],
+                code_.co_names))
+    for name in sorted(names):
+        if name not in globals_:
+            continue
+        value = globals_[name]
+        if inspect.isfunction(value):
+            if value not in _seen:
+                parts.append(
+                    '%s:%s' % (name, get_callable_digest(value, _seen)))
+        elif inspect.ismodule(value) or inspect.isclass(value):
+            continue
+        else:
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value)
+            parts.append('%s=%r' % (name, value))
+    return hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class HeaderCache(object):
+    """SQLite based cache of values extracted from (DICOM) files
+
+    Entries are keyed by the real path of a file, and are valid only as long
+    as the size and modification time of the file remain the same.  Values
+    which depend on some filtering function (e.g. heuristic's filter_dicom)
+    are stored separately per digest of that function.
+
+    Connection is established lazily, and reestablished in forked processes.
+    """
+
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE,
+                 max_size=DEFAULT_MAX_SIZE):
+        """
+
+        Parameters
+        ----------
+        path : str, optional
+          Path to the SQLite database.  If None, `dicom_headers.sqlite`
+          under `get_default_cache_dir()` is used
+        max_age : float, optional
+          Entries not used for longer than that (in seconds) get evicted
+        max_size : int, optional
+          Maximal total size (in bytes) of the cached values to keep
+        """
+        self.path = path or op.join(get_default_cache_dir(),
+                                    'dicom_headers.sqlite')
+        self.max_age = max_age
+        self.max_size = max_size
+        self._conn = None
+        self._pid = None
+        self._accessed = set()
+        self._pending = []
+        self._pending_filtered = []
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.path)
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            dirname = op.dirname(self.path)
+            if dirname and not op.exists(dirname):
+                os.makedirs(dirname)
+            if self._pid not in (None, os.getpid()):
+                # pending entries belong to the parent process
+                self._accessed, self._pending, self._pending_filtered = \
+                    set(), [], []
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._pid = os.getpid()
+            self._init_db()
+        return self._conn
+
+    def _init_db(self):
+        conn = self._conn
+        conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                     "(key TEXT PRIMARY KEY, value TEXT)")
+        versions = _get_versions()
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key='versions'").fetchone()
+        if row and row[0] != versions:
+            lgr.info("Resetting DICOM header cache %s populated by "
+                     "different versions (%s)", self.path, row[0])
+            conn.execute("DROP TABLE IF EXISTS headers")
+            conn.execute("DROP TABLE IF EXISTS filtered")
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('versions', ?)",
+                     (versions,))
+        conn.execute("CREATE TABLE IF NOT EXISTS headers "
+                     "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                     "accessed REAL, value BLOB)")
+        conn.execute("CREATE TABLE IF NOT EXISTS filtered "
+                     "(path TEXT, filter TEXT, size INTEGER, mtime REAL, "
+                     "filtered INTEGER, PRIMARY KEY (path, filter))")
+        conn.commit()
+
+    @staticmethod
+    def get_key(filename):
+        """Return (realpath, size, mtime) key for the file
+
+        See `archives.get_file_key` for files within tarballs
+        """
+        from .archives import get_file_key
+        return get_file_key(filename)
+
+    def get(self, key, filter_id=None):
+        """Return cached (value, filtered) for the key, or None if not cached
+
+        Parameters
+        ----------
+        key : tuple
+          As returned by `get_key`
+        filter_id : str, optional
+          Digest of the filtering function.  If provided, the entry is
+          considered cached only if the filtering result is known as well
+        """
+        path, size, mtime = key
+        row = self.conn.execute(
+            "SELECT value FROM headers WHERE path=? AND size=? AND mtime=?",
+            (path, size, mtime)).fetchone()
+        if row is None:
+            return None
+        filtered = False
+        if filter_id:
+            frow = self.conn.execute(
+                "SELECT filtered FROM filtered WHERE path=? AND filter=? "
+                "AND size=? AND mtime=?",
+                (path, filter_id, size, mtime)).fetchone()
+            if frow is None:
+                return None
+            filtered = bool(frow[0])
+        try:
+            value = pickle.loads(bytes(row[0]))
+        except Exception as exc:
+            lgr.debug("Failed to load cached value for %s: %s", path, exc)
+            return None
+        self._accessed.add(path)
+        return value, filtered
+
+    def set(self, key, value, filter_id=None, filtered=False):
+        """Cache the value (and filtering result) for the key"""
+        path, size, mtime = key
+        self._pending.append(
+            (path, size, mtime, time.time(),
+             sqlite3.Binary(pickle.dumps(value, protocol=2))))
+        if filter_id:
+            self._pending_filtered.append(
+                (path, filter_id, size, mtime, int(bool(filtered))))
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        """Store pending entries and access times in the database"""
+        if not (self._pending or self._accessed):
+            return
+        conn = self.conn
+        conn.executemany(
+            "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+            self._pending)
+        conn.executemany(
+            "INSERT OR REPLACE INTO filtered VALUES (?, ?, ?, ?, ?)",
+            self._pending_filtered)
+        now = time.time()
+        conn.executemany(
+            "UPDATE headers SET accessed=? WHERE path=?",
+            [(now, path) for path in self._accessed])
+        conn.commit()
+        self._accessed, self._pending, self._pending_filtered = \
+            set(), [], []
+
+    def evict(self):
+        """Remove entries which were not used for too long or do not fit"""
+        conn = self.conn
+        self.flush()
+        if self.max_age is not None:
+            conn.execute("DELETE FROM headers WHERE accessed < ?",
+                         (time.time() - self.max_age,))
+        if self.max_size is not None:
+            total = 0
+            evicted = []
+            for path, size in conn.execute(
+                    "SELECT path, LENGTH(value) FROM headers "
+                    "ORDER BY accessed DESC"):
+                total += size
+                if total > self.max_size:
+                    evicted.append((path,))
+            conn.executemany("DELETE FROM headers WHERE path=?", evicted)
+        conn.execute("DELETE FROM filtered WHERE path NOT IN "
+                     "(SELECT path FROM headers)")
+        conn.commit()
+
+    def close(self):
+        """Flush pending entries, evict stale ones and close the database"""
+        if self._pid not in (None, os.getpid()):
+            return
+        if self._conn is None and not self._pending:
+            return
+        try:
+            self.evict()
+        finally:
+            self._conn.close()
+            self._conn = None
+
+
+class FilesState(object):
+    """State of the files found by a run, so the next one parses only new ones
+
+    Information from headers of the files (as cached by `HeaderCache`) is
+    stored in a single pickle, entries being valid only as long as the size
+    and modification time of a file remain the same.  Only the files
+    requested during the run are retained when saving it, so the state
+    follows the set of files as it grows (or shrinks).  Fields of headers
+    of the individual files (`header` of `DicomFileInfo`) are kept aside
+    from the rest of the information, which then gets stored only once
+    for all the files of a series.
+
+    It can be used in place of a `HeaderCache`, in which case the files not
+    known to the state are looked up in `header_cache`.
+
+    As the header cache, the state should be kept in a directory of the user
+    (e.g. under `get_default_cache_dir()`), since loading a pickle from
+    elsewhere (e.g. a shared dataset) could execute arbitrary code.  States
+    in that directory not used for `max_age` get removed when saving.
+    """
+
+    def __init__(self, path, header_cache=None, max_age=DEFAULT_MAX_AGE):
+        """
+
+        Parameters
+        ----------
+        path : str
+          Path to the pickle file to load the state from and save it to
+        header_cache : HeaderCache, optional
+          Cache to consult (and populate) for the files not in the state
+        max_age : float, optional
+          Other states (*.pkl files) in the directory of `path` which were
+          not used for longer than that (in seconds) get removed
+        """
+        self.path = path
+        self.header_cache = header_cache
+        self.max_age = max_age
+        # path -> (size, mtime, filter_id, filtered, index of info, header)
+        self._files = {}
+        self._infos = []
+        self._loaded = 0
+        self._load()
+        self._accessed = {}
+        # index of info per its pickle, so infos of files of the same series
+        # get stored only once
+        self._info_indexes = {}
+        self._header_cache_keys = {}
+        self._changed = False
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.path)
+
+    def _load(self):
+        if not op.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as exc:
+            lgr.warning("Failed to load state of files from %s: %s",
+                        self.path, exc)
+            return
+        if state.get('versions') != _get_versions():
+            lgr.info("Ignoring state of files %s saved by different "
+                     "versions (%s)", self.path, state.get('versions'))
+            return
+        self._files, self._infos = state['files'], state['infos']
+        self._loaded = len(self._files)
+        try:
+            # so it does not get evicted while in use
+            os.utime(self.path, None)
+        except OSError as exc:
+            lgr.debug("Failed to update times of %s: %s", self.path, exc)
+
+    def get_key(self, filename):
+        """Return (path, size, mtime) key for the file
+
+        Unlike in `HeaderCache`, path is not resolved, so the key is obtained
+        without any system call for the files found while scanning
+        directories (see `archives.get_file_stat`).  Files within tarballs
+        have the same keys as in `HeaderCache`
+        """
+        from .archives import get_file_key, get_file_stat, is_archived
+        if is_archived(filename):
+            key = get_file_key(filename)
+            if self.header_cache is not None:
+                self._header_cache_keys[key[0]] = key
+            return key
+        st = get_file_stat(filename)
+        return filename, st.st_size, st.st_mtime
+
+    def get(self, key, filter_id=None):
+        """Return known (value, filtered) for the key, or None
+
+        See `HeaderCache.get`
+        """
+        path, size, mtime = key
+        entry = self._files.get(path)
+        if entry is not None and entry[:3] == (size, mtime, filter_id):
+            self._accessed[path] = entry
+            info = self._infos[entry[4]]
+            if entry[5] is not None:
+                info = info._replace(header=entry[5])
+            return info, entry[3]
+        if self.header_cache is None:
+            return None
+        hkey = self._header_cache_keys.pop(path, None) \
+            or self.header_cache.get_key(path)
+        res = self.header_cache.get(hkey, filter_id)
+        if res is None:
+            # to be set later on
+            self._header_cache_keys[path] = hkey
+        else:
+            self._add(key, res[0], filter_id, res[1])
+        return res
+
+    def set(self, key, value, filter_id=None, filtered=False):
+        """Store the value (and filtering result) for the key"""
+        self._add(key, value, filter_id, filtered)
+        if self.header_cache is not None:
+            path = key[0]
+            hkey = self._header_cache_keys.pop(path, None) \
+                or self.header_cache.get_key(path)
+            self.header_cache.set(hkey, value, filter_id, filtered)
+
+    def _add(self, key, value, filter_id, filtered):
+        path, size, mtime = key
+        header = getattr(value, 'header', None)
+        if header is not None:
+            value = value._replace(header=None)
+        if not self._info_indexes and self._infos:
+            self._info_indexes = dict(
+                (pickle.dumps(info, protocol=2), i)
+                for i, info in enumerate(self._infos))
+        pickled = pickle.dumps(value, protocol=2)
+        index = self._info_indexes.get(pickled)
+        if index is None:
+            index = self._info_indexes[pickled] = len(self._infos)
+            self._infos.append(value)
+        self._accessed[path] = (size, mtime, filter_id, bool(filtered), index,
+                                header)
+        self._changed = True
+
+    def flush(self):
+        """Save the state of the files requested so far"""
+        if self.header_cache is not None:
+            self.header_cache.flush()
+        if not (self._changed or len(self._accessed) != self._loaded):
+            return
+        used = sorted(set(entry[4] for entry in self._accessed.values()))
+        remap = dict((old, new) for new, old in enumerate(used))
+        state = {
+            'versions': _get_versions(),
+            'files': dict((path, entry[:4] + (remap[entry[4]],) + entry[5:])
+                          for path, entry in self._accessed.items()),
+            'infos': [self._infos[i] for i in used],
+        }
+        dirname = op.dirname(self.path)
+        if dirname and not op.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=2)
+        os.rename(tmp, self.path)
+        lgr.debug("Saved state of %d files in %s", len(state['files']),
+                  self.path)
+        self._loaded = len(self._accessed)
+        self._changed = False
+        self._evict()
+
+    def _evict(self):
+        """Remove other states in the directory not used for too long"""
+        if self.max_age is None:
+            return
+        dirname = op.dirname(op.abspath(self.path))
+        for name in os.listdir(dirname):
+            path = op.join(dirname, name)
+            if not name.endswith('.pkl') or path == op.abspath(self.path):
+                continue
+            try:
+                if os.stat(path).st_mtime < time.time() - self.max_age:
+                    os.unlink(path)
+                    lgr.debug("Removed stale state of files %s", path)
+            except OSError as exc:
+                lgr.debug("Failed to remove %s: %s", path, exc)
+
+
+class ConversionCache(object):
+    """Directory based cache of files converted from DICOMs
+
+    Entries are keyed by the paths, sizes and modification times of the
+    DICOMs (see `archives.get_file_key`), as the header cache is, and by
+    the parameters of the conversion (e.g. version and options of the
+    converter), so DICOMs are not even read to find out that they were
+    converted before, regardless of how the outputs get named.  Files are
+    stored as the converter produced them, i.e. before they get renamed or
+    post-processed.  They are reflinked (see `utils.output_file`) between
+    the cache and the outputs, so they share their data where the
+    filesystem supports it, and are copied otherwise (e.g. on ext4), i.e.
+    take twice the space of the outputs.  Entries not used for too long, or
+    not fitting, get evicted (see `evict`).
+    """
+
+    INDEX = 'outputs.json'
+
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE,
+                 max_size=DEFAULT_MAX_CONVERSIONS_SIZE):
+        """
+
+        Parameters
+        ----------
+        path : str, optional
+          Directory to store entries under.  By default conversions under
+          `get_default_cache_dir()`
+        max_age : float, optional
+          Entries not used for longer than that (in seconds) get evicted
+        max_size : int, optional
+          Maximal total size (in bytes) of the cached files to keep
+        """
+        self.path = path or op.join(get_default_cache_dir(), 'conversions')
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.path)
+
+    @staticmethod
+    def get_key(files, *params):
+        """Return the key for converting the files with the parameters
+
+        Order of the files is irrelevant
+        """
+        from .archives import get_file_key
+        parts = [str(p) for p in params] \
+            + sorted(repr(get_file_key(f)) for f in files)
+        return hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def _get_entry_dir(self, key):
+        return op.join(self.path, key[:2], key)
+
+    def get(self, key, outdir):
+        """Output files of the entry into outdir
+
+        Returns
+        -------
+        dict or None
+          Lists of the files in outdir per each output field (e.g.
+          'converted_files'), as they were passed to `set`.  None if there
+          is no such entry
+        """
+        from .utils import load_json, output_file
+        entry = self._get_entry_dir(key)
+        index = op.join(entry, self.INDEX)
+        try:
+            outputs = load_json(index)
+            # so it gets evicted after those used less recently
+            os.utime(index, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if not op.exists(outdir):
+            os.makedirs(outdir)
+        res = {}
+        try:
+            for field, names in outputs.items():
+                res[field] = []
+                for name in names:
+                    res[field].append(op.join(outdir, name))
+                    output_file(op.join(entry, name), res[field][-1],
+                                'reflink')
+        except (IOError, OSError) as exc:
+            # e.g. evicted by another process meanwhile
+            lgr.debug("Failed to get converted files from %s: %s",
+                      entry, exc)
+            return None
+        lgr.debug("Got %d converted files from %s",
+                  sum(map(len, res.values())), entry)
+        return res
+
+    def set(self, key, res):
+        """Store the files (lists of them per each output field)
+
+        Files must have distinct names.  An existing entry is retained
+        """
+        from .utils import output_file, save_json
+        entry = self._get_entry_dir(key)
+        if op.exists(entry):
+            return
+        # so the entry appears complete, even if stored concurrently
+        tmp = '%s.tmp%d' % (entry, os.getpid())
+        os.makedirs(tmp)
+        try:
+            outputs = {}
+            for field, files in res.items():
+                outputs[field] = [op.basename(f) for f in files]
+                for f in files:
+                    output_file(f, op.join(tmp, op.basename(f)), 'reflink')
+            save_json(op.join(tmp, self.INDEX), outputs)
+            os.rename(tmp, entry)
+        except OSError as exc:
+            lgr.debug("Did not store converted files in %s: %s", entry, exc)
+        finally:
+            if op.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def evict(self):
+        """Remove entries which were not used for too long or do not fit
+
+        Index files of the entries get their modification time updated
+        whenever the entries are used, so those used least recently are
+        removed first
+        """
+        if not op.isdir(self.path):
+            return
+        entries = []
+        for subdir in os.listdir(self.path):
+            subdir = op.join(self.path, subdir)
+            if not op.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if '.tmp' in name:
+                    # being stored or removed
+                    continue
+                entry = op.join(subdir, name)
+                try:
+                    mtime = os.stat(op.join(entry, self.INDEX)).st_mtime
+                    size = sum(os.stat(op.join(entry, f)).st_size
+                               for f in os.listdir(entry))
+                except OSError:
+                    # removed by another process meanwhile
+                    continue
+                entries.append((mtime, size, entry))
+        evicted = []
+        total = 0
+        for mtime, size, entry in sorted(entries, reverse=True):
+            total += size
+            if (self.max_age is not None
+                    and mtime < time.time() - self.max_age) \
+                    or (self.max_size is not None and total > self.max_size):
+                evicted.append(entry)
+        for entry in evicted:
+            # so it is not found while being removed
+            tmp = '%s.tmp%d' % (entry, os.getpid())
+            try:
+                os.rename(entry, tmp)
+                shutil.rmtree(tmp)
+            except OSError as exc:
+                lgr.debug("Failed to remove %s: %s", entry, exc)
+        if evicted:
+            lgr.debug("Removed %d stale entries from %s", len(evicted),
+                      self.path)
@@ -4,8 +4,19 @@ from argparse import ArgumentParser
 import sys
 
 from .. import __version__, __packagename__
+from ..archives import materialize_files, remove_temp_dirs, set_index_dir
+from ..cache import ConversionCache, get_default_cache_dir
 from ..parser import get_study_sessions
-from ..utils import load_heuristic, anonymize_sid, treat_infofile, SeqInfo
+from ..utils import (
+    load_heuristic,
+    anonymize_sid,
+    treat_infofile,
+    SeqInfo,
+    can_lock,
+    enable_locking,
+    get_fork_context,
+    FILE_OUTPUT_MODES,
+)
 from ..convert import prep_conversion
 from ..bids import populate_bids_templates, tuneup_bids_json_files
 from ..queue import queue_conversion
@@ -62,10 +73,14 @@ def process_extra_commands(outdir, args):
     elif args.command == 'ls':
         heuristic = load_heuristic(args.heuristic)
         heuristic_ls = getattr(heuristic, 'ls', None)
+        header_cache = get_header_cache(args)
         for f in args.files:
             study_sessions = get_study_sessions(
                 args.dicom_dir_template, [f], heuristic, outdir,
-                args.session, args.subjs, grouping=args.grouping)
+                args.session, args.subjs, grouping=args.grouping,
+                jobs=args.jobs, header_cache=header_cache,
+                use_dicomdir=args.use_dicomdir,
+                allow_no_preamble=args.allow_no_preamble)
             print(f)
             for study_session, sequences in study_sessions.items():
                 suf = ''
@@ -75,6 +90,8 @@ def process_extra_commands(outdir, args):
                     "\t%s %d sequences%s"
                     % (str(study_session), len(sequences), suf)
                 )
+        if header_cache:
+            header_cache.close()
     elif args.command == 'populate-templates':
         heuristic = load_heuristic(args.heuristic)
         for f in args.files:
@@ -96,6 +113,14 @@ def process_extra_commands(outdir, args):
     return
 
 
+def get_header_cache(args):
+    """Return HeaderCache to use according to the arguments, or None"""
+    if args.no_header_cache:
+        return None
+    from ..cache import HeaderCache
+    return HeaderCache(args.header_cache)
+
+
 def main(argv=None):
     parser = get_parser()
     args = parser.parse_args(argv)
@@ -210,8 +235,68 @@ def get_parser():
     parser.add_argument('--minmeta', action='store_true',
                         help='Exclude dcmstack meta information in sidecar '
                         'jsons')
+    parser.add_argument('--dicom-output', default='copy',
+                        choices=FILE_OUTPUT_MODES,
+                        help='How to output DICOMs (into <prefix>_dicom '
+                        'directories) if not BIDS: copy them (default), '
+                        'hard link, symlink, or reflink them. DICOMs are '
+                        'copied if they cannot be hard linked or reflinked '
+                        '(e.g. across filesystems). DICOMs extracted from '
+                        'tarballs are hard linked instead of symlinked')
     parser.add_argument('--random-seed', type=int, default=None,
                         help='Random seed to initialize RNG')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to use for parsing DICOM '
+                        'headers while grouping them into sequences, for '
+                        'reading and extracting multiple tarballs, and for '
+                        'converting multiple study sessions (or sequences '
+                        'of a single one). Results do not depend on it, '
+                        'besides the order of rows in participants.tsv')
+    parser.add_argument('--header-cache', default=None,
+                        help='Path to the SQLite database to cache '
+                        'information from DICOM headers in, so unchanged '
+                        'files are not parsed again by subsequent runs. '
+                        'By default dicom_headers.sqlite under '
+                        '$XDG_CACHE_HOME/heudiconv (~/.cache/heudiconv) is '
+                        'used')
+    parser.add_argument('--no-header-cache', action='store_true',
+                        help='Do not use (or populate) the cache of DICOM '
+                        'headers')
+    parser.add_argument('--conversion-cache', nargs='?', const='',
+                        default=None, metavar='DIR',
+                        help='Directory to cache files converted by dcm2niix '
+                        'in, keyed by the paths, sizes and modification '
+                        'times of the DICOMs (or of the tarballs they are '
+                        'in) and the version of dcm2niix, so DICOMs '
+                        'converted before (e.g. by a run with a different '
+                        'heuristic) are not converted again. Files are '
+                        'reflinked between the cache and the output '
+                        'directory where the filesystem supports it (e.g. '
+                        'btrfs, XFS), and copied otherwise (e.g. ext4), so '
+                        'the converted files are then written, and take '
+                        'space, twice. Entries not used for 90 days, or '
+                        'beyond 20 GiB of the least recently used ones, get '
+                        'removed at the end of a run. If DIR is not given, '
+                        'conversions under $XDG_CACHE_HOME/heudiconv is used')
+    parser.add_argument('--no-archive-index', action='store_true',
+                        help='Do not use (or populate) indexes of input '
+                        'tarballs under $XDG_CACHE_HOME/heudiconv/tarballs, '
+                        'which let subsequent runs read them without '
+                        'decompressing them first')
+    parser.add_argument('--no-files-state', action='store_true',
+                        help='Do not keep information on the files found '
+                        'under --files (under $XDG_CACHE_HOME/heudiconv/files), '
+                        'which lets subsequent runs parse only new or changed '
+                        'files')
+    parser.add_argument('--use-dicomdir', action='store_true',
+                        help='Take series of the DICOMs referenced by DICOMDIR '
+                        'files (e.g. on exported media) from DICOMDIR, so only '
+                        'the first DICOM of each series gets parsed')
+    parser.add_argument('--allow-no-preamble', action='store_true',
+                        help='Also process files without DICOM preamble and '
+                        '"DICM" prefix, if they start with a DICOM element. '
+                        'By default such files are ignored without being '
+                        'parsed')
     submission = parser.add_argument_group('Conversion submission options')
     submission.add_argument('-q', '--queue', default=None,
                             help='select batch system to submit jobs to instead'
@@ -231,8 +316,15 @@ def process_args(args):
 
     outdir = op.abspath(args.outdir)
 
+    if args.no_archive_index:
+        set_index_dir(None)
+
     if args.command:
-        process_extra_commands(outdir, args)
+        try:
+            process_extra_commands(outdir, args)
+        finally:
+            # e.g. `ls` registers files of tarballs under temporary directories
+            remove_temp_dirs()
         return
 
     lgr.info(INIT_MSG(packname=__packagename__,
@@ -247,9 +339,28 @@ def process_args(args):
 
     heuristic = load_heuristic(args.heuristic)
 
-    study_sessions = get_study_sessions(args.dicom_dir_template, args.files,
-                                        heuristic, outdir, args.session,
-                                        args.subjs, grouping=args.grouping)
+    header_cache = get_header_cache(args)
+    try:
+        _process_study_sessions(args, outdir, heuristic, header_cache)
+    finally:
+        if header_cache:
+            header_cache.close()
+        if args.conversion_cache is not None:
+            ConversionCache(args.conversion_cache or None).evict()
+
+
+def _process_study_sessions(args, outdir, heuristic, header_cache):
+    """Sort files into study sessions and convert each one of them"""
+    # fields of DICOM headers read while sorting, needed for the conversion
+    header_store = {}
+    study_sessions = get_study_sessions(
+        args.dicom_dir_template, args.files, heuristic, outdir, args.session,
+        args.subjs, grouping=args.grouping, jobs=args.jobs,
+        header_cache=header_cache, use_dicomdir=args.use_dicomdir,
+        allow_no_preamble=args.allow_no_preamble,
+        state_dir=None if args.no_files_state
+        else op.join(get_default_cache_dir(), 'files'),
+        header_store=header_store)
 
     # extract tarballs, and replace their entries with expanded lists of files
     # TODO: we might need to sort so sessions are ordered???
@@ -257,98 +368,43 @@ def process_args(args):
 
     # processed_studydirs = set()
 
-    for (locator, session, sid), files_or_seqinfo in study_sessions.items():
-
-        # Allow for session to be overloaded from command line
-        if args.session is not None:
-            session = args.session
-        if args.locator is not None:
-            locator = args.locator
-        if not len(files_or_seqinfo):
-            raise ValueError("nothing to process?")
-        # that is how life is ATM :-/ since we don't do sorting if subj
-        # template is provided
-        if isinstance(files_or_seqinfo, dict):
-            assert(isinstance(list(files_or_seqinfo.keys())[0], SeqInfo))
-            dicoms = None
-            seqinfo = files_or_seqinfo
+    nsessions = len(study_sessions)
+    context = None
+    if args.jobs > 1 and nsessions > 1 and not args.queue \
+            and not args.datalad and can_lock():
+        context = get_fork_context()
+        if context is None:
+            lgr.warning("Cannot fork processes, processing study sessions "
+                        "one after another")
+    try:
+        if context is not None:
+            # sessions are independent besides files of the whole study,
+            # which get updated under a lock.  Sequences of each session
+            # then get converted one after another
+            jobs = min(args.jobs, nsessions)
+            lgr.info("Processing study sessions using %d processes", jobs)
+            pool = context.Pool(jobs, initializer=_init_study_session_worker,
+                                initargs=(args, outdir, heuristic,
+                                          header_cache, header_store))
+            try:
+                for _ in pool.imap_unordered(_process_study_session_worker,
+                                             list(study_sessions.items())):
+                    pass
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
         else:
-            dicoms = files_or_seqinfo
-            seqinfo = None
-
-        if locator == 'unknown':
-            lgr.warning("Skipping unknown locator dataset")
-            continue
-
-        if args.queue:
-            if seqinfo and not dicoms:
-                # flatten them all and provide into batching, which again
-                # would group them... heh
-                dicoms = sum(seqinfo.values(), [])
-                raise NotImplementedError(
-                    "we already grouped them so need to add a switch to avoid "
-                    "any grouping, so no outdir prefix doubled etc")
-
-            progname = op.abspath(inspect.getfile(inspect.currentframe()))
-
-            queue_conversion(progname,
-                             args.queue,
-                             study_outdir,
-                             heuristic.filename,
-                             dicoms,
-                             sid,
-                             args.anon_cmd,
-                             args.converter,
-                             session,
-                             args.with_prov,
-                             args.bids)
-            continue
-
-        anon_sid = anonymize_sid(sid, args.anon_cmd) if args.anon_cmd else None
-        if args.anon_cmd:
-            lgr.info('Anonymized {} to {}'.format(sid, anon_sid))
-
-        study_outdir = op.join(outdir, locator or '')
-        anon_outdir = args.conv_outdir or outdir
-        anon_study_outdir = op.join(anon_outdir, locator or '')
-
-        # TODO: --datalad  cmdline option, which would take care about initiating
-        # the outdir -> study_outdir datasets if not yet there
-        if args.datalad:
-            from ..external.dlad import prepare_datalad
-            dlad_sid = sid if not anon_sid else anon_sid
-            dl_msg = prepare_datalad(anon_study_outdir, anon_outdir, dlad_sid,
-                                     session, seqinfo, dicoms, args.bids)
-
-        lgr.info("PROCESSING STARTS: {0}".format(
-            str(dict(subject=sid, outdir=study_outdir, session=session))))
-
-        prep_conversion(sid,
-                        dicoms,
-                        study_outdir,
-                        heuristic,
-                        converter=args.converter,
-                        anon_sid=anon_sid,
-                        anon_outdir=anon_study_outdir,
-                        with_prov=args.with_prov,
-                        ses=session,
-                        bids=args.bids,
-                        seqinfo=seqinfo,
-                        min_meta=args.minmeta,
-                        overwrite=args.overwrite,)
-
-        lgr.info("PROCESSING DONE: {0}".format(
-            str(dict(subject=sid, outdir=study_outdir, session=session))))
-
-        if args.datalad:
-            from ..external.dlad import add_to_datalad
-            msg = "Converted subject %s" % dl_msg
-            # TODO:  whenever propagate to supers work -- do just
-            # ds.save(msg=msg)
-            #  also in batch mode might fail since we have no locking ATM
-            #  and theoretically no need actually to save entire study
-            #  we just need that
-            add_to_datalad(outdir, study_outdir, msg, args.bids)
+            for study_session, files_or_seqinfo in study_sessions.items():
+                _process_study_session(args, outdir, heuristic, header_cache,
+                                       header_store, study_session,
+                                       files_or_seqinfo, jobs=args.jobs)
+    finally:
+        if not args.queue:
+            # files extracted from tarballs are needed by the submitted jobs
+            remove_temp_dirs()
 
     # if args.bids:
     #     # Let's populate BIDS templates for folks to take care about
@@ -359,5 +415,131 @@ def process_args(args):
     # is pretty much present in .heudiconv/SUBJECT/info so we could just poke there
 
 
+# arguments for the worker processes, set by the pool initializer.  Workers
+# get forked, so the heuristic module and header cache do not need to be
+# picklable (and the header store does not get pickled for every session)
+_worker_args = ()
+
+
+def _init_study_session_worker(*args):
+    global _worker_args
+    _worker_args = args
+    enable_locking()
+
+
+def _process_study_session_worker(study_session_files):
+    _process_study_session(*(_worker_args + study_session_files), jobs=1)
+
+
+def _process_study_session(args, outdir, heuristic, header_cache, header_store,
+                           study_session, files_or_seqinfo, jobs=1):
+    """Convert a single study session, using `jobs` processes"""
+    locator, session, sid = study_session
+
+    # Allow for session to be overloaded from command line
+    if args.session is not None:
+        session = args.session
+    if args.locator is not None:
+        locator = args.locator
+    if not len(files_or_seqinfo):
+        raise ValueError("nothing to process?")
+    # that is how life is ATM :-/ since we don't do sorting if subj
+    # template is provided
+    if isinstance(files_or_seqinfo, dict):
+        assert(isinstance(list(files_or_seqinfo.keys())[0], SeqInfo))
+        dicoms = None
+        seqinfo = files_or_seqinfo
+    else:
+        dicoms = files_or_seqinfo
+        seqinfo = None
+
+    if locator == 'unknown':
+        lgr.warning("Skipping unknown locator dataset")
+        return
+
+    if args.queue:
+        if seqinfo and not dicoms:
+            # flatten them all and provide into batching, which again
+            # would group them... heh
+            dicoms = sum(seqinfo.values(), [])
+            raise NotImplementedError(
+                "we already grouped them so need to add a switch to avoid "
+                "any grouping, so no outdir prefix doubled etc")
+
+        progname = op.abspath(inspect.getfile(inspect.currentframe()))
+        # files from tarballs must be on disk for the submitted jobs
+        materialize_files(dicoms, jobs=jobs)
+
+        queue_conversion(progname,
+                         args.queue,
+                         study_outdir,
+                         heuristic.filename,
+                         dicoms,
+                         sid,
+                         args.anon_cmd,
+                         args.converter,
+                         session,
+                         args.with_prov,
+                         args.bids)
+        return
+
+    conversion_cache = None
+    if args.conversion_cache is not None:
+        conversion_cache = ConversionCache(args.conversion_cache or None)
+
+    anon_sid = anonymize_sid(sid, args.anon_cmd) if args.anon_cmd else None
+    if args.anon_cmd:
+        lgr.info('Anonymized {} to {}'.format(sid, anon_sid))
+
+    study_outdir = op.join(outdir, locator or '')
+    anon_outdir = args.conv_outdir or outdir
+    anon_study_outdir = op.join(anon_outdir, locator or '')
+
+    # TODO: --datalad  cmdline option, which would take care about initiating
+    # the outdir -> study_outdir datasets if not yet there
+    if args.datalad:
+        from ..external.dlad import prepare_datalad
+        dlad_sid = sid if not anon_sid else anon_sid
+        dl_msg = prepare_datalad(anon_study_outdir, anon_outdir, dlad_sid,
+                                 session, seqinfo, dicoms, args.bids)
+
+    lgr.info("PROCESSING STARTS: {0}".format(
+        str(dict(subject=sid, outdir=study_outdir, session=session))))
+
+    prep_conversion(sid,
+                    dicoms,
+                    study_outdir,
+                    heuristic,
+                    converter=args.converter,
+                    anon_sid=anon_sid,
+                    anon_outdir=anon_study_outdir,
+                    with_prov=args.with_prov,
+                    ses=session,
+                    bids=args.bids,
+                    seqinfo=seqinfo,
+                    min_meta=args.minmeta,
+                    overwrite=args.overwrite,
+                    jobs=jobs,
+                    header_cache=header_cache,
+                    use_dicomdir=args.use_dicomdir,
+                    allow_no_preamble=args.allow_no_preamble,
+                    dicom_output=args.dicom_output,
+                    header_store=header_store,
+                    conversion_cache=conversion_cache)
+
+    lgr.info("PROCESSING DONE: {0}".format(
+        str(dict(subject=sid, outdir=study_outdir, session=session))))
+
+    if args.datalad:
+        from ..external.dlad import add_to_datalad
+        msg = "Converted subject %s" % dl_msg
+        # TODO:  whenever propagate to supers work -- do just
+        # ds.save(msg=msg)
+        #  also in batch mode might fail since we have no locking ATM
+        #  and theoretically no need actually to save entire study
+        #  we just need that
+        add_to_datalad(outdir, study_outdir, msg, args.bids)
+
+
 if __name__ == "__main__":
     main()
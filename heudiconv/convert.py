@@ -1,8 +1,11 @@
 import os
 import os.path as op
 import logging
+import re
 import shutil
 import sys
+from collections import defaultdict, OrderedDict
+from functools import partial
 
 from .utils import (
     read_config,
@@ -11,12 +14,16 @@ from .utils import (
     write_config,
     TempDirs,
     safe_copyfile,
+    safe_movefile,
     treat_infofile,
     set_readonly,
-    clear_temp_dicoms,
     seqinfo_fields,
     assure_no_file_exists,
-    file_md5sum
+    file_md5sum,
+    locked,
+    output_file,
+    run_node,
+    get_fork_context,
 )
 from .bids import (
     convert_sid_bids,
@@ -25,6 +32,12 @@ from .bids import (
     tuneup_bids_json_files,
     add_participant_record,
 )
+from .archives import (
+    clear_materialized_files,
+    is_temporary,
+    materialize_files,
+    relocate_files,
+)
 from .dicoms import (
     group_dicoms_into_seqinfos,
     embed_metadata_from_dicoms,
@@ -33,6 +46,12 @@ from .dicoms import (
 
 lgr = logging.getLogger(__name__)
 
+# outputs of dcm2niix, as named by nipype's Dcm2niix interface
+DCM2NIIX_OUTPUTS = ('converted_files', 'bvecs', 'bvals', 'mvecs', 'bids')
+# options dcm2niix is run with besides -b, -f, and -o, as by that interface
+DCM2NIIX_OPTIONS = ('-z', 'y', '-x', 'n', '-t', 'n', '-m', '0', '-w', '2',
+                    '-s', 'n', '-v', 'n')
+
 
 def conversion_info(subject, outdir, info, filegroup, ses):
     convert_info = []
@@ -79,13 +98,20 @@ def conversion_info(subject, outdir, info, filegroup, ses):
 
 def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
                    anon_outdir, with_prov, ses, bids, seqinfo, min_meta,
-                   overwrite):
+                   overwrite, jobs=1, header_cache=None,
+                   use_dicomdir=False, allow_no_preamble=False,
+                   dicom_output='copy', header_store=None,
+                   conversion_cache=None):
     if dicoms:
         lgr.info("Processing %d dicoms", len(dicoms))
     elif seqinfo:
         lgr.info("Processing %d pre-sorted seqinfo entries", len(seqinfo))
     else:
         raise ValueError("neither dicoms nor seqinfo dict was provided")
+    # fields of DICOM headers read while grouping, so converted DICOMs do
+    # not need to be read again
+    if header_store is None:
+        header_store = {}
 
     if bids:
         if not sid:
@@ -105,8 +131,10 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
         idir = op.join(idir, 'ses-%s' % str(ses))
     if anon_outdir == outdir:
         idir = op.join(idir, 'info')
-    if not op.exists(idir):
-        os.makedirs(idir)
+    # sessions of the same subject might be processed concurrently
+    with locked(outdir):
+        if not op.exists(idir):
+            os.makedirs(idir)
 
     ses_suffix = "_ses-%s" % ses if ses is not None else ""
     info_file = op.join(idir, '%s%s.auto.txt' % (sid, ses_suffix))
@@ -140,6 +168,11 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
                  "because %s exists", edit_file)
         info = read_config(edit_file)
         filegroup = load_json(filegroup_file)
+        # files of tarballs were registered under a different temporary
+        # directory by the run which saved it
+        registered = dicoms or sum(seqinfo.values(), [])
+        filegroup = dict((series_id, relocate_files(files, registered))
+                         for series_id, files in filegroup.items())
         # XXX Yarik finally understood why basedir was dragged along!
         # So we could reuse the same PATHs definitions possibly consistent
         # across re-runs... BUT that wouldn't work anyways if e.g.
@@ -149,14 +182,20 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
     else:
         # TODO -- might have been done outside already!
         # MG -- will have to try with both dicom template, files
-        assure_no_file_exists(target_heuristic_filename)
-        safe_copyfile(heuristic.filename, idir)
+        with locked(outdir):
+            assure_no_file_exists(target_heuristic_filename)
+            safe_copyfile(heuristic.filename, idir)
         if dicoms:
             seqinfo = group_dicoms_into_seqinfos(
                 dicoms,
                 file_filter=getattr(heuristic, 'filter_files', None),
                 dcmfilter=getattr(heuristic, 'filter_dicom', None),
-                grouping=None)
+                grouping=None,
+                jobs=jobs,
+                header_cache=header_cache,
+                use_dicomdir=use_dicomdir,
+                allow_no_preamble=allow_no_preamble,
+                header_store=header_store)
         seqinfo_list = list(seqinfo.keys())
         filegroup = {si.series_id: x for si, x in seqinfo.items()}
         dicominfo_file = op.join(idir, 'dicominfo%s.tsv' % ses_suffix)
@@ -166,6 +205,10 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
             fp.write('\t'.join([val for val in seqinfo_fields]) + '\n')
             for seq in seqinfo_list:
                 fp.write('\t'.join([str(val) for val in seq]) + '\n')
+        # heuristics might read DICOMs of the series, e.g. the example ones,
+        # which otherwise would not be extracted from tarballs yet
+        materialize_files([files[0] for files in seqinfo.values() if files],
+                          jobs=jobs)
         lgr.debug("Calling out to %s.infodict", heuristic)
         info = heuristic.infotodict(seqinfo_list)
         lgr.debug("Writing to {}, {}, {}".format(info_file, edit_file,
@@ -186,6 +229,12 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
     if converter.lower() != 'none':
         lgr.info("Doing conversion using %s", converter)
         cinfo = conversion_info(anon_sid, tdir, info, filegroup, ses)
+        # extract files from tarballs only for the series selected by the
+        # heuristic, all in a single pass through each tarball
+        materialize_files([f for item in cinfo for f in item[2]], jobs=jobs)
+        # so series can be told apart within outputs of a single dcm2niix run
+        series_uids = dict((tuple(files), getattr(si, 'series_uid', None))
+                           for si, files in (seqinfo or {}).items())
         convert(cinfo,
                 converter=converter,
                 scaninfo_suffix=getattr(heuristic, 'scaninfo_suffix', '.json'),
@@ -194,31 +243,44 @@ def prep_conversion(sid, dicoms, outdir, heuristic, converter, anon_sid,
                 bids=bids,
                 outdir=tdir,
                 min_meta=min_meta,
-                overwrite=overwrite,)
-
+                overwrite=overwrite,
+                symlink=dicom_output,
+                jobs=jobs,
+                series_uids=[series_uids.get(tuple(item[2]))
+                             for item in cinfo],
+                header_store=header_store,
+                conversion_cache=conversion_cache)
+
+    # only files of this session, others might be getting converted from
+    # the same temporary directory
     for item_dicoms in filegroup.values():
-        clear_temp_dicoms(item_dicoms)
+        clear_materialized_files(item_dicoms)
 
     if bids:
-        if seqinfo:
-            keys = list(seqinfo)
-            add_participant_record(anon_outdir,
-                                   anon_sid,
-                                   keys[0].patient_age,
-                                   keys[0].patient_sex)
-        populate_bids_templates(anon_outdir,
-                                getattr(heuristic, 'DEFAULT_FIELDS', {}))
+        # files of the whole study, so other sessions might be updating them
+        with locked(anon_outdir):
+            if seqinfo:
+                keys = list(seqinfo)
+                add_participant_record(anon_outdir,
+                                       anon_sid,
+                                       keys[0].patient_age,
+                                       keys[0].patient_sex)
+            populate_bids_templates(anon_outdir,
+                                    getattr(heuristic, 'DEFAULT_FIELDS', {}))
 
 
 def convert(items, converter, scaninfo_suffix, custom_callable, with_prov,
-            bids, outdir, min_meta, overwrite, symlink=True, prov_file=None):
+            bids, outdir, min_meta, overwrite, symlink='copy', prov_file=None,
+            jobs=1, series_uids=None, header_store=None,
+            conversion_cache=None):
     """Perform actual conversion (calls to converter etc) given info from
     heuristic's `infotodict`
 
     Parameters
     ----------
     items
-    symlink
+    symlink : {'copy', 'hardlink', 'symlink', 'reflink'} or bool, optional
+      How to output DICOMs if not BIDS, see `convert_dicom`
     converter
     scaninfo_suffix
     custom_callable
@@ -227,106 +289,357 @@ def convert(items, converter, scaninfo_suffix, custom_callable, with_prov,
     sourcedir
     outdir
     min_meta
+    jobs : int, optional
+      Number of processes to convert items with.  Items of the same field
+      map directory are still converted one after another by a single
+      process, since their sidecars are fixed up together, and *_scans.tsv
+      files are updated (and `custom_callable` is called) by this process
+      in the order of items
+    series_uids : list, optional
+      SeriesInstanceUID of the DICOMs of each item (None if not known).
+      Items converted by dcm2niix which have known and distinct UIDs are
+      converted by a single run of dcm2niix per process (see
+      `dcm2niix_convert_series`)
+    header_store : dict, optional
+      Fields of DICOM headers as populated while grouping them (see
+      `group_dicoms_into_seqinfos`), so DICOMs found there are not read
+      again to fill in *_scans.tsv files or to timestamp tarballs of DICOMs
+    conversion_cache : ConversionCache, optional
+      Cache of files converted by dcm2niix.  DICOMs of items converted
+      before (with the same version of dcm2niix) are not converted again,
+      but their converted files are taken from the cache
 
     Returns
     -------
     None
     """
-    prov_files = []
+    kwargs = dict(converter=converter, scaninfo_suffix=scaninfo_suffix,
+                  with_prov=with_prov, bids=bids, outdir=outdir,
+                  min_meta=min_meta, overwrite=overwrite, symlink=symlink,
+                  series_uids=series_uids, header_store=header_store,
+                  conversion_cache=conversion_cache)
+    tasks = _get_convert_tasks(items, bids)
+    context = None
+    if jobs is not None and jobs > 1 and len(tasks) > 1:
+        context = get_fork_context()
+        if context is None:
+            lgr.warning("Cannot fork processes, converting items one after "
+                        "another")
+    if context is None:
+        tempdirs = TempDirs()
+        for i, _ in _convert_items(list(enumerate(items)), tempdirs=tempdirs,
+                                   **kwargs):
+            if custom_callable is not None:
+                custom_callable(*items[i])
+        return
+
+    jobs = min(jobs, len(tasks))
+    lgr.info("Converting %d items using %d processes", len(items), jobs)
+    # workers get forked, so they know members of tarballs registered so far
+    pool = context.Pool(jobs, initializer=_init_convert_worker,
+                        initargs=(kwargs,))
+    # items are post-processed in their order as soon as all the preceding
+    # ones are converted
+    converted = {}
+    nprocessed = 0
+    try:
+        for task_scans in pool.imap_unordered(
+                _convert_items_worker,
+                [[(i, items[i]) for i in task] for task in tasks]):
+            converted.update(task_scans)
+            while nprocessed in converted:
+                item = items[nprocessed]
+                for bids_outfiles in converted.pop(nprocessed):
+                    save_scans_key(item, bids_outfiles, header_store)
+                if custom_callable is not None:
+                    custom_callable(*item)
+                nprocessed += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _get_convert_tasks(items, bids):
+    """Return lists of indices of items to be converted by a single process
+
+    Each item gets converted on its own, besides those going into the same
+    field map directory, which get converted together (in their order) since
+    `tuneup_bids_json_files` fixes up their sidecars based on each other
+    """
+    tasks = []
+    fmap_tasks = {}
+    for i, item in enumerate(items):
+        prefix_dirname = op.dirname(item[0] + '.ext')
+        if bids and op.basename(prefix_dirname) == 'fmap':
+            if prefix_dirname in fmap_tasks:
+                fmap_tasks[prefix_dirname].append(i)
+                continue
+            fmap_tasks[prefix_dirname] = [i]
+            tasks.append(fmap_tasks[prefix_dirname])
+        else:
+            tasks.append([i])
+    return tasks
+
+
+# arguments for the worker processes, set by the pool initializer
+_worker_kwargs = {}
+
+
+def _init_convert_worker(kwargs):
+    _worker_kwargs.update(kwargs)
+
+
+def _convert_items_worker(indexed_items):
+    """Convert (index, item)s, returning {index: lists of BIDS files}
+
+    BIDS files are those to be recorded in *_scans.tsv by the main process
+    """
     tempdirs = TempDirs()
+    try:
+        return dict(_convert_items(indexed_items, tempdirs=tempdirs,
+                                   save_scans=False, **_worker_kwargs))
+    finally:
+        tempdirs.cleanup()
 
-    for item_idx, item in enumerate(items):
-
-        prefix, outtypes, item_dicoms = item[:3]
-        if not isinstance(outtypes, (list, tuple)):
-            outtypes = (outtypes,)
-
-        prefix_dirname = op.dirname(prefix + '.ext')
-        outname_bids = prefix + '.json'
-        bids_outfiles = []
-        lgr.info('Converting %s (%d DICOMs) -> %s . '
-                 'Converter: %s . Output types: %s',
-                 prefix, len(item_dicoms), prefix_dirname, converter, outtypes)
-        # We want to create this dir only if we are converting it to nifti,
-        # or if we're using BIDS
-        dicom_only = outtypes == ('dicom',)
-        if not(dicom_only and bids) and not op.exists(prefix_dirname):
-            os.makedirs(prefix_dirname)
 
-        for outtype in outtypes:
-            lgr.debug("Processing %d dicoms for output type %s. Overwrite=%s",
-                     len(item_dicoms), outtype, overwrite)
-            lgr.debug("Includes the following dicoms: %s", item_dicoms)
-
-            seqtype = op.basename(op.dirname(prefix)) if bids else None
-
-            # set empty outname and scaninfo in case we only want dicoms
-            outname = ''
-            scaninfo = ''
-            if outtype == 'dicom':
-                convert_dicom(item_dicoms, bids, prefix,
-                              outdir, tempdirs, symlink, overwrite)
-            elif outtype in ['nii', 'nii.gz']:
-                assert converter == 'dcm2niix', ('Invalid converter '
-                                                 '{}'.format(converter))
-
-                outname, scaninfo = (prefix + '.' + outtype,
-                                     prefix + scaninfo_suffix)
-
-                if not op.exists(outname) or overwrite:
-                    tmpdir = tempdirs('dcm2niix')
-
-                    # run conversion through nipype
-                    res, prov_file = nipype_convert(item_dicoms, prefix, with_prov,
-                                                    bids, tmpdir)
-
-                    bids_outfiles = save_converted_files(res, item_dicoms, bids,
-                                                         outtype, prefix,
-                                                         outname_bids,
-                                                         overwrite=overwrite)
-
-                    # save acquisition time information if it's BIDS
-                    # at this point we still have acquisition date
-                    if bids:
-                        save_scans_key(item, bids_outfiles)
-                    # Fix up and unify BIDS files
-                    tuneup_bids_json_files(bids_outfiles)
-
-                    if prov_file:
-                        prov_files.append(prov_file)
-
-                    tempdirs.rmtree(tmpdir)
+def _convert_items(indexed_items, tempdirs, series_uids=None,
+                   conversion_cache=None, **kwargs):
+    """Convert (index, item)s, generating (index, scans) as they get converted
+
+    Converted files of the items to be converted by dcm2niix are taken from
+    `conversion_cache` if it has them.  DICOMs of the rest get converted by
+    a single run of dcm2niix first (see `_get_series_to_convert`), and the
+    rest of the conversion then proceeds item by item (see `_convert_item`)
+    """
+    converted = {}
+    tmpdirs = []
+    keys = {}
+    if conversion_cache is not None:
+        keys = _get_conversion_keys(indexed_items, conversion_cache, **kwargs)
+    if keys:
+        tmpdirs.append(tempdirs('dcm2niix'))
+        for i, key in keys.items():
+            res = conversion_cache.get(key, op.join(tmpdirs[-1], str(i)))
+            if res is not None:
+                converted[i] = res
+        lgr.info("Took converted files of %d out of %d items from %s",
+                 len(converted), len(keys), conversion_cache)
+    pending = [(i, item) for i, item in indexed_items if i not in converted]
+    series = _get_series_to_convert(pending, series_uids, **kwargs)
+    if series:
+        tmpdirs.append(tempdirs('dcm2niix'))
+        lgr.info("Converting %d series by a single run of dcm2niix",
+                 len(series))
+        try:
+            series_converted = dcm2niix_convert_series(
+                dict((uid, pending[j][1][2]) for j, uid in series.items()),
+                kwargs['bids'], tmpdirs[-1])
+        except RuntimeError as exc:
+            lgr.warning("Will convert series one by one since: %s", exc)
+            series_converted = None
+        for j, uid in (series.items() if series_converted else []):
+            # the rest gets another chance to be converted on its own
+            if series_converted[uid]['converted_files']:
+                i = pending[j][0]
+                converted[i] = series_converted[uid]
+                if i in keys:
+                    conversion_cache.set(keys[i], converted[i])
+    try:
+        for i, item in indexed_items:
+            save_converted = None
+            if i in keys and i not in converted:
+                save_converted = partial(conversion_cache.set, keys[i])
+            yield i, _convert_item(item, tempdirs=tempdirs,
+                                   converted=converted.get(i),
+                                   save_converted=save_converted, **kwargs)
+    finally:
+        for tmpdir in tmpdirs:
+            tempdirs.rmtree(tmpdir)
+
+
+def _get_nifti_outtype(item, overwrite):
+    """Return the first of NIfTI output types of the item, if it is to be
+    converted into it (i.e. unless it was converted already), or None
+    """
+    prefix, outtypes = item[:2]
+    if not isinstance(outtypes, (list, tuple)):
+        outtypes = (outtypes,)
+    outtype = [t for t in outtypes if t in ('nii', 'nii.gz')][:1]
+    if (outtype and item[2]
+            and (overwrite or not op.exists(prefix + '.' + outtype[0]))):
+        return outtype[0]
+    return None
+
+
+def _get_conversion_keys(indexed_items, conversion_cache, converter,
+                         with_prov, bids, overwrite, **kwargs):
+    """Return {index: key in conversion_cache} of the items to be converted
+    by dcm2niix
+
+    Empty if conversion requires nipype (for provenance), or version of
+    dcm2niix is not known
+    """
+    if converter != 'dcm2niix' or with_prov:
+        return {}
+    version = get_dcm2niix_version()
+    if version is None:
+        lgr.warning("Not using %s since version of dcm2niix is not known",
+                    conversion_cache)
+        return {}
+    return dict(
+        (i, conversion_cache.get_key(item[2], version, bids,
+                                     ' '.join(DCM2NIIX_OPTIONS)))
+        for i, item in indexed_items if _get_nifti_outtype(item, overwrite))
+
+
+def _get_series_to_convert(indexed_items, series_uids, converter, with_prov,
+                           overwrite, **kwargs):
+    """Return {position in indexed_items: SeriesInstanceUID} to be converted
+    by a single run of dcm2niix
+
+    Those are the items to be converted into NIfTI by dcm2niix (without
+    provenance, which requires nipype), with known and distinct UIDs.  Empty
+    if there are less than two of them, since there is nothing to gain then
+    """
+    if not series_uids or converter != 'dcm2niix' or with_prov:
+        return {}
+    series = {}
+    uids = defaultdict(int)
+    for j, (i, item) in enumerate(indexed_items):
+        uid = series_uids[i]
+        uids[uid] += 1
+        if uid and _get_nifti_outtype(item, overwrite):
+            series[j] = uid
+    series = dict((j, uid) for j, uid in series.items() if uids[uid] == 1)
+    return series if len(series) > 1 else {}
+
+
+def _convert_item(item, converter, scaninfo_suffix, with_prov, bids, outdir,
+                  min_meta, overwrite, symlink, tempdirs, save_scans=True,
+                  converted=None, header_store=None, save_converted=None):
+    """Convert a single item, see `convert`
+
+    `converted` are the outputs of dcm2niix (as returned by
+    `dcm2niix_convert`) for the first of NIfTI output types, if its DICOMs
+    were converted already.  Otherwise outputs of dcm2niix get passed to
+    `save_converted` (if provided) once it is run on the DICOMs
+
+    Returns
+    -------
+    list of list of str
+      BIDS files to be recorded in *_scans.tsv if `save_scans` is False,
+      per each converted output type
+    """
+    scans = []
+    prov_file = None
+    prefix, outtypes, item_dicoms = item[:3]
+    if not isinstance(outtypes, (list, tuple)):
+        outtypes = (outtypes,)
+
+    prefix_dirname = op.dirname(prefix + '.ext')
+    outname_bids = prefix + '.json'
+    bids_outfiles = []
+    lgr.info('Converting %s (%d DICOMs) -> %s . '
+             'Converter: %s . Output types: %s',
+             prefix, len(item_dicoms), prefix_dirname, converter, outtypes)
+    # in case files from tarballs were not extracted yet
+    materialize_files(item_dicoms)
+    # We want to create this dir only if we are converting it to nifti,
+    # or if we're using BIDS
+    dicom_only = outtypes == ('dicom',)
+    if not(dicom_only and bids) and not op.exists(prefix_dirname):
+        try:
+            os.makedirs(prefix_dirname)
+        except OSError:
+            # might have been just created while converting another item
+            if not op.isdir(prefix_dirname):
+                raise
+
+    for outtype in outtypes:
+        lgr.debug("Processing %d dicoms for output type %s. Overwrite=%s",
+                 len(item_dicoms), outtype, overwrite)
+        lgr.debug("Includes the following dicoms: %s", item_dicoms)
+
+        seqtype = op.basename(op.dirname(prefix)) if bids else None
+
+        # set empty outname and scaninfo in case we only want dicoms
+        outname = ''
+        scaninfo = ''
+        if outtype == 'dicom':
+            convert_dicom(item_dicoms, bids, prefix,
+                          outdir, tempdirs, symlink, overwrite,
+                          header_store=header_store)
+        elif outtype in ['nii', 'nii.gz']:
+            assert converter == 'dcm2niix', ('Invalid converter '
+                                             '{}'.format(converter))
+
+            outname, scaninfo = (prefix + '.' + outtype,
+                                 prefix + scaninfo_suffix)
+
+            if not op.exists(outname) or overwrite:
+                tmpdir = tempdirs('dcm2niix')
+
+                if converted is not None:
+                    res, converted = converted, None
+                elif with_prov:
+                    # run conversion through nipype to get provenance
+                    res, prov_file = nipype_convert(item_dicoms, prefix,
+                                                    with_prov, bids, tmpdir)
+                    res = get_nipype_outputs(res)
                 else:
-                    raise RuntimeError(
-                        "was asked to convert into %s but destination already exists"
-                        % (outname)
-                    )
-
-        if len(bids_outfiles) > 1:
-            lgr.warning("For now not embedding BIDS and info generated "
-                        ".nii.gz itself since sequence produced "
-                        "multiple files")
-        elif not bids_outfiles:
-            lgr.debug("No BIDS files were produced, nothing to embed to then")
-        elif outname:
-            embed_metadata_from_dicoms(bids, item_dicoms, outname, outname_bids,
-                                       prov_file, scaninfo, tempdirs, with_prov,
-                                       min_meta)
-        if scaninfo and op.exists(scaninfo):
-            lgr.info("Post-treating %s file", scaninfo)
-            treat_infofile(scaninfo)
-
-        # this may not always be the case: ex. fieldmap1, fieldmap2
-        # will address after refactor
-        if outname and op.exists(outname):
-            set_readonly(outname)
-
-        if custom_callable is not None:
-            custom_callable(*item)
+                    res = dcm2niix_convert(item_dicoms, prefix, bids, tmpdir)
+                    if save_converted is not None and res['converted_files']:
+                        save_converted(res)
+                        save_converted = None
+
+                bids_outfiles = save_converted_files(res, item_dicoms, bids,
+                                                     outtype, prefix,
+                                                     outname_bids,
+                                                     overwrite=overwrite)
+
+                # save acquisition time information if it's BIDS
+                # at this point we still have acquisition date
+                if bids:
+                    if save_scans:
+                        save_scans_key(item, bids_outfiles, header_store)
+                    else:
+                        scans.append(bids_outfiles)
+                # Fix up and unify BIDS files
+                tuneup_bids_json_files(bids_outfiles)
+
+                tempdirs.rmtree(tmpdir)
+            else:
+                raise RuntimeError(
+                    "was asked to convert into %s but destination already exists"
+                    % (outname)
+                )
+
+    if len(bids_outfiles) > 1:
+        lgr.warning("For now not embedding BIDS and info generated "
+                    ".nii.gz itself since sequence produced "
+                    "multiple files")
+    elif not bids_outfiles:
+        lgr.debug("No BIDS files were produced, nothing to embed to then")
+    elif outname:
+        embed_metadata_from_dicoms(bids, item_dicoms, outname, outname_bids,
+                                   prov_file, scaninfo, tempdirs, with_prov,
+                                   min_meta)
+    if scaninfo and op.exists(scaninfo):
+        lgr.info("Post-treating %s file", scaninfo)
+        treat_infofile(scaninfo)
+
+    # this may not always be the case: ex. fieldmap1, fieldmap2
+    # will address after refactor
+    if outname and op.exists(outname):
+        set_readonly(outname)
+    return scans
 
 
 def convert_dicom(item_dicoms, bids, prefix,
-                  outdir, tempdirs, symlink, overwrite):
+                  outdir, tempdirs, symlink, overwrite, header_store=None):
     """Save DICOMs as output (default is by symbolic link)
 
     Parameters
@@ -342,10 +655,16 @@ def convert_dicom(item_dicoms, bids, prefix,
     tempdirs : TempDirs instance
         Object to handle temporary directories created
         TODO: remove
-    symlink : bool
-        Create softlink to DICOMs - if False, create hardlink instead.
+    symlink : {'copy', 'hardlink', 'symlink', 'reflink'} or bool
+        How to output DICOMs (see `utils.output_file`) if not BIDS, with
+        True and False standing for 'symlink' and 'copy'.  DICOMs
+        extracted into temporary directories (see `archives.is_temporary`)
+        get hard linked instead of symlinked, since those directories are
+        removed after conversion
     overwrite : bool
         If True, allows overwriting of previous conversion
+    header_store : dict, optional
+        Fields of DICOM headers, see `compress_dicoms`
 
     Returns
     -------
@@ -363,7 +682,8 @@ def convert_dicom(item_dicoms, bids, prefix,
         compress_dicoms(item_dicoms,
                         op.join(sourcedir_, op.basename(prefix)),
                         tempdirs,
-                        overwrite)
+                        overwrite,
+                        header_store=header_store)
     else:
         dicomdir = prefix + '_dicom'
         if op.exists(dicomdir):
@@ -371,15 +691,16 @@ def convert_dicom(item_dicoms, bids, prefix,
                      'removing...'.format(dicomdir))
             shutil.rmtree(dicomdir)
         os.mkdir(dicomdir)
+        if symlink is True or symlink is False:
+            # as it used to be passed before other modes were supported
+            symlink = 'symlink' if symlink else 'copy'
         for filename in item_dicoms:
             outfile = op.join(dicomdir, op.basename(filename))
             if not op.islink(outfile):
-                # TODO: add option to enable hardlink?
-#                if symlink:
-#                    os.symlink(filename, outfile)
-#                else:
-#                    os.link(filename, outfile)
-                shutil.copyfile(filename, outfile)
+                mode = symlink
+                if mode == 'symlink' and is_temporary(filename):
+                    mode = 'hardlink'
+                output_file(filename, outfile, mode)
 
 
 def nipype_convert(item_dicoms, prefix, with_prov, bids, tmpdir):
@@ -406,7 +727,7 @@ def nipype_convert(item_dicoms, prefix, with_prov, bids, tmpdir):
     else:
         convertnode.terminal_output = 'allatonce'
     convertnode.inputs.bids_format = bids
-    eg = convertnode.run()
+    eg = run_node(convertnode)
 
     # prov information
     prov_file = prefix + '_prov.ttl' if with_prov else None
@@ -419,14 +740,177 @@ def nipype_convert(item_dicoms, prefix, with_prov, bids, tmpdir):
     return eg, prov_file
 
 
+def get_nipype_outputs(res):
+    """Return outputs of nipype's Dcm2niix node as `dcm2niix_convert` does"""
+    from nipype.interfaces.base import isdefined
+    outputs = {}
+    for field in DCM2NIIX_OUTPUTS:
+        value = getattr(res.outputs, field)
+        if not isdefined(value):
+            value = []
+        elif not isinstance(value, list):
+            value = [value]
+        outputs[field] = value
+    return outputs
+
+
+def _stage_dicoms(item_dicoms, dicom_dir):
+    """Symlink DICOMs into a directory of their own, for dcm2niix to convert"""
+    os.makedirs(dicom_dir)
+    names = set()
+    for i, f in enumerate(item_dicoms):
+        name = op.basename(f)
+        if name in names:
+            name = '%d-%s' % (i, name)
+        names.add(name)
+        os.symlink(op.abspath(f), op.join(dicom_dir, name))
+
+
+def _run_dcm2niix(dicom_dir, filename, bids, tmpdir):
+    """Run dcm2niix on DICOMs under dicom_dir, converting them into tmpdir
+
+    Returns
+    -------
+    list of str
+      Paths (without extensions) of the outputs, in the order dcm2niix
+      reported them
+    """
+    import subprocess
+    cmd = ['dcm2niix', '-b', 'y' if bids else 'n'] + list(DCM2NIIX_OPTIONS) \
+        + ['-f', filename, '-o', '.', dicom_dir]
+    lgr.debug("Running %s", ' '.join(cmd))
+    proc = subprocess.Popen(cmd, cwd=tmpdir, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = proc.communicate()[0].decode('utf-8', 'replace')
+    lgr.debug("dcm2niix output:\n%s", out)
+    if proc.returncode:
+        raise RuntimeError(
+            "dcm2niix exited with %d while converting %s:\n%s"
+            % (proc.returncode, dicom_dir, out))
+    return [op.abspath(op.join(tmpdir, re.search(r'\S+/\S+', line).group(0)))
+            for line in out.splitlines() if line.startswith('Convert ')]
+
+
+# version of dcm2niix, once it is known
+_dcm2niix_version = []
+
+
+def get_dcm2niix_version():
+    """Return version of dcm2niix (e.g. 'v1.0.20190902'), None if not known"""
+    if not _dcm2niix_version:
+        import subprocess
+        try:
+            out = subprocess.Popen(
+                ['dcm2niix', '--version'], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT).communicate()[0]
+        except OSError as exc:
+            lgr.debug("Failed to run dcm2niix: %s", exc)
+            out = b''
+        versions = re.findall(r'^v\d\S*', out.decode('utf-8', 'replace'),
+                              re.M)
+        _dcm2niix_version.append(versions[-1] if versions else None)
+    return _dcm2niix_version[0]
+
+
+def _get_dcm2niix_outputs(basenames):
+    """Sort files produced by dcm2niix as nipype's Dcm2niix interface does"""
+    outputs = dict((field, []) for field in DCM2NIIX_OUTPUTS)
+    for basename in basenames:
+        for ext in ('.bval', '.bvec', '.mvec', '.json', '.txt', '.nii',
+                    '.nii.gz'):
+            if not op.exists(basename + ext):
+                continue
+            if ext in ('.nii', '.nii.gz'):
+                field = 'converted_files'
+            elif ext in ('.json', '.txt'):
+                field = 'bids'
+            else:
+                field = ext[1:] + 's'
+            outputs[field].append(basename + ext)
+    # the same file might be reported multiple times (e.g. for mosaics)
+    outputs['converted_files'] = list(
+        OrderedDict.fromkeys(outputs['converted_files']))
+    return outputs
+
+
+def dcm2niix_convert(item_dicoms, prefix, bids, tmpdir):
+    """Convert DICOMs by running dcm2niix directly
+
+    Runs dcm2niix with the same options nipype's Dcm2niix interface does
+    (see `nipype_convert`), but without the overhead of nipype's Node.
+    Only the given DICOMs get converted, as they are symlinked into a
+    directory of their own.
+
+    Parameters
+    ----------
+    item_dicoms : list of str
+    prefix : str
+      Output prefix, the name of its directory is used as the name of
+      the output files within tmpdir
+    bids : bool
+      Either to produce BIDS sidecars
+    tmpdir : str
+      Directory to convert into
+
+    Returns
+    -------
+    dict
+      Lists of files per each of `DCM2NIIX_OUTPUTS`, in the order dcm2niix
+      reported them
+    """
+    dicom_dir = op.join(tmpdir, 'dicoms')
+    _stage_dicoms(item_dicoms, dicom_dir)
+    return _get_dcm2niix_outputs(_run_dcm2niix(
+        dicom_dir, op.basename(op.dirname(prefix)), bids, tmpdir))
+
+
+def dcm2niix_convert_series(series_dicoms, bids, tmpdir):
+    """Convert multiple series by a single run of dcm2niix
+
+    Outputs are named by SeriesInstanceUID (followed by the suffixes
+    dcm2niix adds, e.g. for echoes), which maps them back to the series,
+    unless UIDs do not consist of digits and dots only as they should.
+
+    Parameters
+    ----------
+    series_dicoms : dict
+      DICOMs per SeriesInstanceUID, i.e. all files of a series should have
+      that UID
+    bids : bool
+      Either to produce BIDS sidecars
+    tmpdir : str
+      Directory to convert into
+
+    Returns
+    -------
+    dict or None
+      Outputs (as returned by `dcm2niix_convert`) per SeriesInstanceUID.
+      None if some output could not be attributed to any of the series
+    """
+    dicom_dir = op.join(tmpdir, 'dicoms')
+    for i, uid in enumerate(sorted(series_dicoms)):
+        _stage_dicoms(series_dicoms[uid], op.join(dicom_dir, str(i)))
+    series_basenames = dict((uid, []) for uid in series_dicoms)
+    for basename in _run_dcm2niix(dicom_dir, '%j', bids, tmpdir):
+        # dcm2niix might add suffixes, e.g. '_e2' or 'a' for repeated names
+        uid = re.match(r'[\d.]*', op.basename(basename)).group(0)
+        if uid not in series_basenames:
+            lgr.warning("Could not attribute %s converted by dcm2niix to any "
+                        "of %d series", basename, len(series_dicoms))
+            return None
+        series_basenames[uid].append(basename)
+    return dict((uid, _get_dcm2niix_outputs(basenames))
+                for uid, basenames in series_basenames.items())
+
+
 def save_converted_files(res, item_dicoms, bids, outtype, prefix, outname_bids, overwrite):
-    """Copy converted files from tempdir to output directory.
+    """Move converted files from tempdir to output directory.
     Will rename files if necessary.
 
     Parameters
     ----------
-    res : Node
-        Nipype conversion Node with results
+    res : dict
+        Converted files, as returned by `dcm2niix_convert`
     item_dicoms: list of filenames
         DICOMs converted
     bids : bool
@@ -439,21 +923,21 @@ def save_converted_files(res, item_dicoms, bids, outtype, prefix, outname_bids,
         Converted BIDS files
 
     """
-    from nipype.interfaces.base import isdefined
-
     bids_outfiles = []
-    res_files = res.outputs.converted_files
+    res_files = res['converted_files']
 
     if not len(res_files):
         lgr.debug("DICOMs {} were not converted".format(item_dicoms))
         return
 
-    if isdefined(res.outputs.bvecs) and isdefined(res.outputs.bvals):
+    if res['bvecs'] and res['bvals']:
+        if len(res['bvecs']) > 1 or len(res['bvals']) > 1:
+            raise TypeError("Multiple bvec/bval files detected.")
         outname_bvecs, outname_bvals = prefix + '.bvec', prefix + '.bval'
-        safe_copyfile(res.outputs.bvecs, outname_bvecs, overwrite)
-        safe_copyfile(res.outputs.bvals, outname_bvals, overwrite)
+        safe_movefile(res['bvecs'][0], outname_bvecs, overwrite)
+        safe_movefile(res['bvals'][0], outname_bvals, overwrite)
 
-    if isinstance(res_files, list):
+    if len(res_files) > 1:
         # we should provide specific handling for fmap,
         # dwi etc which might spit out multiple files
 
@@ -469,25 +953,24 @@ def save_converted_files(res, item_dicoms, bids, outtype, prefix, outname_bids,
 
         # Also copy BIDS files although they might need to
         # be merged/postprocessed later
-        bids_files = (res.outputs.bids
-                      if len(res.outputs.bids) == len(res_files)
+        bids_files = (res['bids']
+                      if len(res['bids']) == len(res_files)
                       else [None] * len(res_files))
 
         for fl, suffix, bids_file in zip(res_files, suffixes, bids_files):
             outname = "%s%s.%s" % (prefix, suffix, outtype)
-            safe_copyfile(fl, outname, overwrite)
+            safe_movefile(fl, outname, overwrite)
             if bids_file:
                 outname_bids_file = "%s%s.json" % (prefix, suffix)
-                safe_copyfile(bids_file, outname_bids_file, overwrite)
+                safe_movefile(bids_file, outname_bids_file, overwrite)
                 bids_outfiles.append(outname_bids_file)
-    # res_files is not a list
+    # a single file was converted
     else:
         outname = "{}.{}".format(prefix, outtype)
-        safe_copyfile(res_files, outname, overwrite)
-        if isdefined(res.outputs.bids):
-            try:
-                safe_copyfile(res.outputs.bids, outname_bids, overwrite)
-                bids_outfiles.append(outname_bids)
-            except TypeError as exc:  ##catch lists
-                raise TypeError("Multiple BIDS sidecars detected.")
+        safe_movefile(res_files[0], outname, overwrite)
+        if len(res['bids']) > 1:
+            raise TypeError("Multiple BIDS sidecars detected.")
+        if res['bids']:
+            safe_movefile(res['bids'][0], outname_bids, overwrite)
+            bids_outfiles.append(outname_bids)
     return bids_outfiles
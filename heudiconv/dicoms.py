@@ -2,197 +2,912 @@
 import os
 import os.path as op
 import logging
-from collections import OrderedDict
+import operator
+import struct
+from collections import OrderedDict, defaultdict, namedtuple
 import tarfile
+try:
+    from collections.abc import Sequence
+except ImportError:  # PY2
+    from collections import Sequence
 
 from heudiconv.external.pydicom import dcm
 
-from .utils import SeqInfo, load_json, set_readonly
+from .archives import (
+    get_archive,
+    is_archived,
+    open_file,
+)
+from .utils import (
+    SeqInfo,
+    get_fork_context,
+    load_json,
+    run_node,
+    set_readonly,
+)
 
 lgr = logging.getLogger(__name__)
 
-def group_dicoms_into_seqinfos(files, file_filter, dcmfilter, grouping):
-    """Process list of dicoms and return seqinfo and file group
-    `seqinfo` contains per-sequence extract of fields from DICOMs which
-    will be later provided into heuristics to decide on filenames
+
+def read_dicom_header(filename):
+    """Read DICOM header only, i.e. stop before reaching pixel data
+
+    Elements values get decoded by pydicom only when accessed, so only the
+    tags used for grouping and `SeqInfo` construction get actually parsed.
+    Files within tarballs which were not extracted yet (see `archives`)
+    are read directly from the tarball.
+    """
+    if not is_archived(filename):
+        return dcm.read_file(filename, stop_before_pixels=True, force=True)
+    with open_file(filename) as f:
+        return dcm.read_file(f, stop_before_pixels=True, force=True)
+
+
+# Tags of pixel data elements (PixelData, DoubleFloatPixelData,
+# FloatPixelData), which DICOM images have
+PIXEL_DATA_TAGS = (0x7fe00010, 0x7fe00009, 0x7fe00008)
+
+
+def read_dicom_header_of_image(filename, force=False):
+    """Read DICOM header as `read_dicom_header`, telling if it is an image
+
+    Returns
+    -------
+    dcm_data : pydicom.dataset.Dataset
+    is_image : bool
+      Either the header is followed by pixel data
+    """
+    pixel_tags = []
+
+    def stop_when(tag, vr, length):
+        if tag in PIXEL_DATA_TAGS:
+            pixel_tags.append(tag)
+            return True
+        return False
+
+    with open_file(filename) as f:
+        dcm_data = dcm.filereader.read_partial(f, stop_when, force=force)
+    return dcm_data, bool(pixel_tags)
+
+
+def stack_dicom_headers(dcmfiles, force=False):
+    """Stack DICOMs as dcmstack's `parse_and_stack` does, but by headers only
+
+    DICOMs are grouped as by `parse_and_group` (by `default_group_keys`),
+    and each group is stacked into `HeaderDicomStack` as `HeaderDataset`s,
+    so pixel data is neither read nor stacked.  Stacks are thus useful for their shape,
+    affine, and meta data (e.g. as embedded by their `to_nifti`) only.
+
     Parameters
     ----------
-    files : list of str
-      List of files to consider
-    file_filter : callable, optional
-      Applied to each item of filenames. Should return True if file needs to be
-      kept, False otherwise.
-    dcmfilter : callable, optional
-      If called on dcm_data and returns True, it is used to set series_id
-    grouping : {'studyUID', 'accession_number', None}, optional
-        what to group by: studyUID or accession_number
+    dcmfiles : list of str
+    force : bool, optional
+      Read files even if they do not look like DICOMs
+
     Returns
     -------
-    seqinfo : list of list
-      `seqinfo` is a list of info entries per each sequence (some entry
-      there defines a key for `filegrp`)
-    filegrp : dict
-      `filegrp` is a dictionary with files groupped per each sequence
+    OrderedDict
+      HeaderDicomStack per key of its group, as `parse_and_stack` returns
+      DicomStacks
     """
-    allowed_groupings = ['studyUID', 'accession_number', None]
-    if grouping not in allowed_groupings:
-        raise ValueError('I do not know how to group by {0}'.format(grouping))
-    per_studyUID = grouping == 'studyUID'
-    per_accession_number = grouping == 'accession_number'
-    lgr.info("Analyzing %d dicoms", len(files))
+    import numpy as np
+    from dcmstack.extract import default_extractor
+    from heudiconv.external.dcmstack import (
+        ds,
+        HeaderDataset,
+        HeaderDicomStack,
+    )
 
-    groups = [[], []]
-    mwgroup = []
+    group_keys, close_keys = ds.default_group_keys, ds.default_close_keys
+    # (full key, [(dcm_data, meta)]) per key of values compared for equality
+    groups = {}
+    for filename in dcmfiles:
+        dcm_data, is_image = read_dicom_header_of_image(filename, force)
+        if not is_image:
+            lgr.debug("Skipping non-image data set: %s", filename)
+            continue
+        meta = default_extractor(dcm_data)
+        key = []
+        for grp_key in group_keys:
+            value = meta.get(grp_key)
+            if isinstance(value, (list, dcm.multival.MultiValue)):
+                value = tuple(value)
+            key.append(value)
+        subgroups = groups.setdefault(
+            tuple(v for k, v in zip(group_keys, key) if k not in close_keys),
+            [])
+        # values of close_keys are compared with a tolerance, to the values
+        # of the first data set of the group
+        for group_key, group in subgroups:
+            if all((v1 is None and v2 is None) or
+                   (v1 is not None and v2 is not None and
+                    np.allclose(v1, v2, atol=5e-5))
+                   for k, v1, v2 in zip(group_keys, group_key, key)
+                   if k in close_keys):
+                group.append((dcm_data, meta))
+                break
+        else:
+            subgroups.append((tuple(key), [(dcm_data, meta)]))
 
-    studyUID = None
-    # for sanity check that all DICOMs came from the same
-    # "study".  If not -- what is the use-case? (interrupted acquisition?)
-    # and how would then we deal with series numbers
-    # which would differ already
-    if file_filter:
-        nfl_before = len(files)
-        files = list(filter(file_filter, files))
-        nfl_after = len(files)
-        lgr.info('Filtering out {0} dicoms based on their filename'.format(
-            nfl_before-nfl_after))
-    for fidx, filename in enumerate(files):
-        from heudiconv.external.dcmstack import ds
-        # TODO after getting a regression test check if the same behavior
-        #      with stop_before_pixels=True
-        mw = ds.wrapper_from_data(dcm.read_file(filename, force=True))
-
-        for sig in ('iop', 'ICE_Dims', 'SequenceName'):
-            try:
-                del mw.series_signature[sig]
-            except:
-                pass
+    stacks = OrderedDict()
+    for key, group in sorted((g for subgroups in groups.values()
+                              for g in subgroups),
+                             key=operator.itemgetter(0)):
+        stack = HeaderDicomStack()
+        for dcm_data, meta in group:
+            stack.add_dcm(HeaderDataset(dcm_data), meta)
+        stacks[key] = stack
+    return stacks
+
+
+def is_dicom_file(filename, allow_no_preamble=False):
+    """Return True if the file looks like a DICOM file
+
+    Only the first 132 bytes are read to check for the 128 bytes preamble
+    followed by the 'DICM' prefix.
+
+    Parameters
+    ----------
+    filename : str
+    allow_no_preamble : bool, optional
+      Also consider files without preamble, as long as they start with an
+      element of the file meta information (0002) or identifying (0008)
+      group, as written by some old or non-conformant software
+    """
+    try:
+        with open_file(filename) as f:
+            head = f.read(132)
+    except (IOError, OSError) as exc:
+        lgr.debug("Cannot read %s: %s", filename, exc)
+        return False
+    if head[128:132] == b'DICM':
+        return True
+    if allow_no_preamble and len(head) >= 8:
+        group, = struct.unpack('<H', head[:2])
+        return group in (0x0002, 0x0008)
+    return False
+
+
+def get_image_shape(mw):
+    """Return image shape as deduced from the DICOM header alone
+
+    Parameters
+    ----------
+    mw : Wrapper
+      dcmstack (nibabel) wrapper around a header-only DICOM dataset
+
+    Returns
+    -------
+    tuple of int or None
+      (Rows, Columns[, NumberOfFrames]), or None if there is no image data
+    """
+    if mw.is_mosaic:
+        # mosaic dimensions come from the CSA header, not from pixel data
+        return mw.image_shape
+    dcm_data = mw.dcm_data
+    rows, columns = dcm_data.get('Rows'), dcm_data.get('Columns')
+    if rows is None or columns is None:
+        return None
+    shape = (int(rows), int(columns))
+    nframes = int(dcm_data.get('NumberOfFrames', 1) or 1)
+    if nframes > 1:
+        shape += (nframes,)
+    return shape
+
+
+def _hashable(value):
+    """Convert value (e.g. a MultiValue or numpy array) into a hashable one"""
+    if hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        value = value.tolist()
+    if isinstance(value, Sequence) and \
+            not isinstance(value, (str, bytes, type(u''))):
+        return tuple(_hashable(v) for v in value)
+    hash(value)  # to raise TypeError right here if still unhashable
+    return value
+
+
+def get_series_signature_key(series_signature):
+    """Return a hashable key for the exactly compared fields of a signature
+
+    Two wrappers with different keys can never be `is_same_series`, so the key
+    could be used to index series representatives.  Fields compared with a
+    tolerance (e.g. voxel sizes) are not included, so wrappers with the same
+    key still need to be compared with `is_same_series`.
+
+    Parameters
+    ----------
+    series_signature : dict
+      `series_signature` of a dcmstack (nibabel) wrapper, i.e. a mapping of
+      field name into (value, comparison function)
 
+    Returns
+    -------
+    tuple or None
+      None if some exactly compared value could not be made hashable
+    """
+    key = []
+    for field in sorted(series_signature):
+        value, func = series_signature[field]
+        # a missing field and a field with None value compare the same
+        if func is not operator.eq or value is None:
+            continue
         try:
-            file_studyUID = mw.dcm_data.StudyInstanceUID
-        except AttributeError:
-            lgr.info("File {} is missing any StudyInstanceUID".format(filename))
-            file_studyUID = None
+            key.append((field, _hashable(value)))
+        except TypeError:
+            return None
+    return tuple(key)
+
+
+# Fields of DICOM headers needed to group files and to describe series in
+# SeqInfo.  Only their values are retained (and passed between processes)
+SEQINFO_DICOM_FIELDS = (
+    'AccessionNumber',
+    'AcquisitionDate',
+    'EchoTime',
+    'ImageType',
+    'PatientAge',
+    'PatientID',
+    'PatientSex',
+    'ProtocolName',
+    'ReferringPhysicianName',
+    'RepetitionTime',
+    'SeriesDescription',
+    'SeriesInstanceUID',
+    'SeriesNumber',
+    'StudyDescription',
+    'StudyInstanceUID',
+)
+# Sequences of which only the number of items is retained, as
+# 'NumberOf<name without Sequence>s', e.g. NumberOfReferencedImages
+SEQINFO_DICOM_SEQUENCES = (
+    'ReferencedImageSequence',
+    'SourceImageSequence',
+)
+# Tags of the sequence name, in the order of preference
+SEQUENCE_NAME_TAGS = (
+    (0x18, 0x24),  # GE and Philips scanners
+    (0x19, 0x109c),  # Siemens scanners
+)
+# Fields of DICOM headers (besides all the *UID ones) needed only once series
+# get converted.  They are retained just for a few files of each series (see
+# `header_store` of `group_dicoms_into_seqinfos`)
+HEADER_DICOM_FIELDS = (
+    'ContentDate',
+    'ContentTime',
+    'PerformingPhysicianName',
+    'SeriesDate',
+    'SeriesTime',
+)
+
+DicomFileInfo = namedtuple(
+    'DicomFileInfo',
+    [
+        'series_id',  # (SeriesNumber, ProtocolName), negative if to be ignored
+        'study_uid',  # None if not quite a "normal" DICOM
+        'series_signature',  # for comparison with other files
+        'image_shape',
+        'fields',  # dict as returned by get_seqinfo_fields
+        'header',  # dict as returned by get_header_fields, None if unknown
+    ]
+)
+
+# for files which are not DICOMs at all
+_NOT_DICOM_FILE_INFO = DicomFileInfo((-1, 'none'), None, {}, None, {}, None)
+
+
+def get_seqinfo_fields(dcm_data):
+    """Extract values of the fields needed for SeqInfo from the DICOM header
+
+    Values are taken as they are (multi-valued ones as lists), so no
+    reference to the dataset itself is retained.
+
+    Returns
+    -------
+    dict
+      Values of the present `SEQINFO_DICOM_FIELDS`, numbers of items
+      in `SEQINFO_DICOM_SEQUENCES`, and `SequenceName` (see
+      `SEQUENCE_NAME_TAGS`)
+    """
+    fields = {}
+    for field in SEQINFO_DICOM_FIELDS:
+        if field in dcm_data:
+            value = getattr(dcm_data, field)
+            if isinstance(value, dcm.multival.MultiValue):
+                value = list(value)
+            fields[field] = value
+    for field in SEQINFO_DICOM_SEQUENCES:
+        if field in dcm_data:
+            fields['NumberOf%ss' % field[:-len('Sequence')]] = \
+                len(getattr(dcm_data, field))
+    for tag in SEQUENCE_NAME_TAGS:
+        if dcm_data.get(tag, None):
+            fields['SequenceName'] = dcm_data[tag].value
+            break
+    return fields
+
+
+def get_header_fields(dcm_data):
+    """Extract values of the fields needed after conversion from the header
 
+    Returns
+    -------
+    dict
+      Values of the present `HEADER_DICOM_FIELDS` and of all the top level
+      elements with keywords ending with 'UID'
+    """
+    fields = {}
+    for field in dcm_data.dir():
+        if field in HEADER_DICOM_FIELDS or field.endswith('UID'):
+            value = getattr(dcm_data, field)
+            if isinstance(value, dcm.multival.MultiValue):
+                value = list(value)
+            fields[field] = value
+    return fields
+
+
+def get_dicom_header_fields(filename, header_store=None):
+    """Return fields of the DICOM header as returned by `get_header_fields`
+
+    They are taken from `header_store` (see `group_dicoms_into_seqinfos`)
+    if the file is there, and read from the file otherwise
+    """
+    if header_store and filename in header_store:
+        return header_store[filename]
+    return get_header_fields(
+        dcm.read_file(filename, stop_before_pixels=True, force=True))
+
+
+def _read_dicom_file_info(filename, dcmfilter=None, allow_no_preamble=False):
+    """Read DICOM header and extract information needed for grouping
+
+    Returns
+    -------
+    dcm_info : DicomFileInfo
+      Not yet affected by `dcmfilter`.  `_NOT_DICOM_FILE_INFO` if the file
+      does not look like a DICOM (see `is_dicom_file`)
+    filtered : bool
+      Either `dcmfilter` returned True for the DICOM
+    """
+    if not is_dicom_file(filename, allow_no_preamble):
+        lgr.debug("Ignoring %s since it does not look like a DICOM",
+                  filename)
+        return _NOT_DICOM_FILE_INFO, False
+
+    from heudiconv.external.dcmstack import ds
+    mw = ds.wrapper_from_data(read_dicom_header(filename))
+
+    for sig in ('iop', 'ICE_Dims', 'SequenceName'):
         try:
-            series_id = (int(mw.dcm_data.SeriesNumber),
-                         mw.dcm_data.ProtocolName)
-            file_studyUID = mw.dcm_data.StudyInstanceUID
-
-            if not per_studyUID:
-                # verify that we are working with a single study
-                if studyUID is None:
-                    studyUID = file_studyUID
-                elif not per_accession_number:
-                    assert studyUID == file_studyUID, (
-                    "Conflicting study identifiers found [{}, {}].".format(
-                    studyUID, file_studyUID
-                    ))
-        except AttributeError as exc:
-            lgr.warning('Ignoring %s since not quite a "normal" DICOM: %s',
-                        filename, exc)
-            series_id = (-1, 'none')
-            file_studyUID = None
-
-        if not series_id[0] < 0:
-            if dcmfilter is not None and dcmfilter(mw.dcm_data):
-                series_id = (-1, mw.dcm_data.ProtocolName)
-
-        # filter out unwanted non-image-data DICOMs by assigning
-        # a series number < 0 (see test below)
-        if not series_id[0] < 0 and mw.dcm_data[0x0008, 0x0016].repval in (
-                'Raw Data Storage',
-                'GrayscaleSoftcopyPresentationStateStorage'):
-            series_id = (-1, mw.dcm_data.ProtocolName)
-
-        if per_studyUID:
+            del mw.series_signature[sig]
+        except:
+            pass
+
+    try:
+        file_studyUID = mw.dcm_data.StudyInstanceUID
+    except AttributeError:
+        lgr.info("File {} is missing any StudyInstanceUID".format(filename))
+        file_studyUID = None
+
+    try:
+        series_id = (int(mw.dcm_data.SeriesNumber),
+                     mw.dcm_data.ProtocolName)
+        file_studyUID = mw.dcm_data.StudyInstanceUID
+    except AttributeError as exc:
+        lgr.warning('Ignoring %s since not quite a "normal" DICOM: %s',
+                    filename, exc)
+        series_id = (-1, 'none')
+        file_studyUID = None
+
+    # filter out unwanted non-image-data DICOMs by assigning
+    # a series number < 0 (see test below)
+    if not series_id[0] < 0 and mw.dcm_data[0x0008, 0x0016].repval in (
+            'Raw Data Storage',
+            'GrayscaleSoftcopyPresentationStateStorage'):
+        series_id = (-1, mw.dcm_data.ProtocolName)
+
+    filtered = bool(not series_id[0] < 0 and dcmfilter is not None
+                    and dcmfilter(mw.dcm_data))
+
+    dcm_info = DicomFileInfo(series_id, file_studyUID,
+                             dict(mw.series_signature), get_image_shape(mw),
+                             get_seqinfo_fields(mw.dcm_data),
+                             get_header_fields(mw.dcm_data))
+    return dcm_info, filtered
+
+
+def _filter_dicom_file_info(dcm_info, filtered):
+    """Assign negative series number to DICOMs filtered out by dcmfilter"""
+    if filtered and not dcm_info.series_id[0] < 0:
+        return dcm_info._replace(
+            series_id=(-1, dcm_info.fields.get('ProtocolName')))
+    return dcm_info
+
+
+def get_dicom_file_info(filename, dcmfilter=None, allow_no_preamble=False):
+    """Read DICOM header and extract information needed for grouping
+
+    Parameters
+    ----------
+    filename : str
+    dcmfilter : callable, optional
+      If called on dcm_data and returns True, file gets a negative series
+      number, i.e. will be ignored
+    allow_no_preamble : bool, optional
+      Passed to `is_dicom_file`.  Files not looking like DICOMs get
+      a negative series number as well
+
+    Returns
+    -------
+    DicomFileInfo
+    """
+    return _filter_dicom_file_info(
+        *_read_dicom_file_info(filename, dcmfilter, allow_no_preamble))
+
+
+# arguments for the worker processes, set by the pool initializer.  Those are
+# forked, so dcmfilter does not need to be picklable
+_worker_kwargs = {}
+
+
+def _init_dicom_file_info_worker(dcmfilter, allow_no_preamble):
+    _worker_kwargs.update(dcmfilter=dcmfilter,
+                          allow_no_preamble=allow_no_preamble)
+
+
+def _read_dicom_file_infos_worker(files):
+    return [_read_dicom_file_info(f, **_worker_kwargs) for f in files]
+
+
+def _get_chunks(files, chunksize):
+    """Split files into chunks to be processed by workers
+
+    Files from the same tarball (not extracted yet) go into the same chunk,
+    so each tarball gets decompressed only by a single worker
+    """
+    chunks = []
+    prev_archive = None
+    for f in files:
+        archive = get_archive(f)
+        if chunks and archive == prev_archive and (
+                archive is not None or len(chunks[-1]) < chunksize):
+            chunks[-1].append(f)
+        else:
+            chunks.append([f])
+        prev_archive = archive
+    return chunks
+
+
+def _iter_read_dicom_file_infos(files, dcmfilter=None, jobs=1,
+                                allow_no_preamble=False):
+    """Generate (DicomFileInfo, filtered) for each file, in the order of files
+    """
+    chunks = None
+    context = None
+    if jobs is not None and jobs > 1 and len(files) > 1:
+        context = get_fork_context()
+        if context is None:
+            lgr.warning("Parsing DICOM headers serially since processes "
+                        "cannot be forked")
+    if context is not None:
+        # a few chunks per process to balance the load while keeping chunks
+        # large enough to amortize interprocess communication
+        chunks = _get_chunks(files,
+                             max(1, min(256, len(files) // (jobs * 4))))
+    if not chunks or len(chunks) == 1:
+        for filename in files:
+            yield _read_dicom_file_info(filename, dcmfilter, allow_no_preamble)
+        return
+
+    jobs = min(jobs, len(chunks))
+    lgr.info("Parsing DICOM headers using %d processes", jobs)
+    pool = context.Pool(jobs,
+                        initializer=_init_dicom_file_info_worker,
+                        initargs=(dcmfilter, allow_no_preamble))
+    try:
+        for res in pool.imap(_read_dicom_file_infos_worker, chunks):
+            for r in res:
+                yield r
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def iter_dicom_file_infos(files, dcmfilter=None, jobs=1, header_cache=None,
+                          allow_no_preamble=False):
+    """Generate DicomFileInfo for each file, in the order of files
+
+    Files which do not look like DICOMs (see `is_dicom_file`) are not
+    parsed, and get a negative series number, i.e. will be ignored
+
+    Parameters
+    ----------
+    files : list of str
+    dcmfilter : callable, optional
+    jobs : int, optional
+      If more than 1, headers are parsed by a pool of processes, each
+      handling a contiguous chunk of files at a time (all files of a tarball
+      go into a single chunk).  Results are still generated in the order of
+      `files`
+    header_cache : HeaderCache, optional
+      Cache to consult first, so headers of files which did not change
+      since they were cached are not parsed again
+    allow_no_preamble : bool, optional
+      Passed to `is_dicom_file`.  Header cache is not used then
+    """
+    cached = [None] * len(files)
+    if header_cache is not None and allow_no_preamble:
+        # cached headers might be of files without preamble, which must be
+        # ignored otherwise
+        lgr.debug("Not using header cache for files without preamble")
+        header_cache = None
+    if header_cache is not None:
+        filter_id = ''
+        if dcmfilter is not None:
+            from .cache import get_callable_digest
+            filter_id = get_callable_digest(dcmfilter)
+            if filter_id is None:
+                lgr.debug("Cannot establish digest of %s, not using header "
+                          "cache", dcmfilter)
+                header_cache = None
+    if header_cache is not None:
+        keys = [header_cache.get_key(f) for f in files]
+        cached = [header_cache.get(key, filter_id) for key in keys]
+        lgr.info("Found %d out of %d DICOM headers in %s",
+                 sum(c is not None for c in cached), len(files), header_cache)
+
+    parsed = _iter_read_dicom_file_infos(
+        [f for f, c in zip(files, cached) if c is None], dcmfilter, jobs=jobs,
+        allow_no_preamble=allow_no_preamble)
+    nnot_dicom = 0
+    for i, res in enumerate(cached):
+        if res is None:
+            res = next(parsed)
+            if res[0] == _NOT_DICOM_FILE_INFO:
+                # not cached, since files are sniffed quickly anyways
+                nnot_dicom += 1
+            elif header_cache is not None:
+                header_cache.set(keys[i], res[0], filter_id, res[1])
+        yield _filter_dicom_file_info(*res)
+    if nnot_dicom:
+        lgr.info("Ignored %d files which do not look like DICOMs", nnot_dicom)
+    # let parsing finish up, e.g. shut down the pool of processes
+    for _ in parsed:
+        pass
+    if header_cache is not None:
+        header_cache.flush()
+
+
+def read_dicomdir_series(dicomdir):
+    """Return files of each series referenced by a DICOMDIR
+
+    Only IMAGE records are considered, so files of other kinds (e.g.
+    presentation states) are not listed.
+
+    Parameters
+    ----------
+    dicomdir : str
+      Path to the DICOMDIR file.  Referenced files are relative to its
+      directory
+
+    Returns
+    -------
+    OrderedDict
+      Lists of paths to the image files per each SeriesInstanceUID (or
+      position of the series record within DICOMDIR if it has no UID)
+    """
+    ds = dcm.read_file(dicomdir, force=True)
+    records = list(ds.get('DirectoryRecordSequence', []))
+    topdir = op.dirname(dicomdir)
+
+    by_offset = {}
+    for record in records:
+        offset = getattr(record, 'seq_item_tell', None)
+        if offset is None:
+            by_offset = None
+            break
+        by_offset[offset] = record
+
+    def iter_entity(offset):
+        """Generate records of the directory entity starting at offset"""
+        seen = set()
+        while offset and offset in by_offset and offset not in seen:
+            seen.add(offset)
+            record = by_offset[offset]
+            yield record
+            offset = record.get('OffsetOfTheNextDirectoryRecord', 0)
+
+    def iter_leaves(offset, series):
+        for record in iter_entity(offset):
+            if record.DirectoryRecordType == 'SERIES':
+                series = record
+            elif record.DirectoryRecordType == 'IMAGE':
+                yield series, record
+            lower = record.get('OffsetOfReferencedLowerLevelDirectoryEntity',
+                               0)
+            for leaf in iter_leaves(lower, series):
+                yield leaf
+
+    if by_offset is not None:
+        leaves = iter_leaves(
+            ds.get('OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity',
+                   0),
+            None)
+    else:
+        # cannot follow the offsets, so rely on records being stored in
+        # the order of the hierarchy, as they typically are
+        def iter_flat():
+            series = None
+            for record in records:
+                if record.DirectoryRecordType == 'SERIES':
+                    series = record
+                elif record.DirectoryRecordType == 'IMAGE':
+                    yield series, record
+        leaves = iter_flat()
+
+    series_files = OrderedDict()
+    series_keys = {}
+    for series, record in leaves:
+        if series is None or 'ReferencedFileID' not in record:
+            continue
+        if id(series) not in series_keys:
+            series_keys[id(series)] = series.get(
+                'SeriesInstanceUID', len(series_keys))
+        file_id = record.ReferencedFileID
+        if not isinstance(file_id, (dcm.multival.MultiValue, list)):
+            file_id = [file_id]
+        series_files.setdefault(series_keys[id(series)], []).append(
+            op.join(topdir, *file_id))
+    return series_files
+
+
+def _iter_files_dicom_file_infos(files, use_dicomdir=False, **kwargs):
+    """Generate (filename, DicomFileInfo), in the order of files
+
+    If `use_dicomdir`, files referenced by any DICOMDIR among the files are
+    not parsed, but get DicomFileInfo of the first file of their series
+    (without its `header`).  DICOMDIR files themselves are then skipped.
+    `kwargs` are passed to `iter_dicom_file_infos`.
+    """
+    dicomdirs = [f for f in files if op.basename(f) == 'DICOMDIR'] \
+        if use_dicomdir else []
+    # index of the representative within reps per each file covered by
+    # some DICOMDIR
+    represented_by = {}
+    reps = []
+    if dicomdirs:
+        present = dict((op.normpath(f), f) for f in files)
+        for dicomdir in dicomdirs:
+            nfiles_before = len(represented_by)
+            for series_files in read_dicomdir_series(dicomdir).values():
+                series_files = [present[op.normpath(f)] for f in series_files
+                                if op.normpath(f) in present]
+                series_files = [f for f in series_files
+                                if f not in represented_by]
+                if not series_files:
+                    continue
+                for f in series_files:
+                    represented_by[f] = len(reps)
+                reps.append(series_files[0])
+            lgr.info("Using %s to group %d files", dicomdir,
+                     len(represented_by) - nfiles_before)
+        files_ = [f for f in files
+                  if f not in represented_by and op.basename(f) != 'DICOMDIR']
+        rep_infos = list(iter_dicom_file_infos(reps, **kwargs))
+        # header fields of the representatives are not those of other files
+        other_infos = [info._replace(header=None) for info in rep_infos]
+    else:
+        files_ = files
+    dicom_infos = iter_dicom_file_infos(files_, **kwargs)
+    if not dicomdirs:
+        for ifile, dcm_info in enumerate(dicom_infos):
+            yield files[ifile], dcm_info
+        return
+    for f in files:
+        if f in represented_by:
+            irep = represented_by[f]
+            yield f, (rep_infos if f == reps[irep] else other_infos)[irep]
+        elif op.basename(f) != 'DICOMDIR':
+            yield f, next(dicom_infos)
+    # let parsing finish up
+    for _ in dicom_infos:
+        pass
+
+
+def is_same_series(signature1, signature2):
+    """Return True if two series signatures appear to be of the same series
+
+    Mirrors `is_same_series` of dcmstack (nibabel) wrappers, but operates on
+    the `series_signature` dictionaries themselves.
+    """
+    keys1, keys2 = set(signature1), set(signature2)
+    # compare using our own rules where both have values
+    for key in keys1.intersection(keys2):
+        v1, func = signature1[key]
+        v2, _ = signature2[key]
+        if not func(v1, v2):
+            return False
+    # values present in one or the other but not both
+    for keys, signature in ((keys1 - keys2, signature1),
+                            (keys2 - keys1, signature2)):
+        for key in keys:
+            v1, func = signature[key]
+            if not func(v1, None):
+                return False
+    return True
+
+
+class _SeriesGrouper(object):
+    """Accumulates DicomFileInfo of files, grouping them into series
+
+    Representatives of all the series seen are retained, while files of
+    the series are bucketed only until they are popped.  If `header_store`
+    is provided, header fields of the first file and of the first file
+    in sorted order of each series get stored in it once the series is
+    popped (see `group_dicoms_into_seqinfos`).
+    """
+
+    def __init__(self, grouping, header_store=None):
+        allowed_groupings = ['studyUID', 'accession_number', None]
+        if grouping not in allowed_groupings:
+            raise ValueError(
+                'I do not know how to group by {0}'.format(grouping))
+        self.per_studyUID = grouping == 'studyUID'
+        self.per_accession_number = grouping == 'accession_number'
+        # for sanity check that all DICOMs came from the same
+        # "study".  If not -- what is the use-case? (interrupted acquisition?)
+        # and how would then we deal with series numbers
+        # which would differ already
+        self.studyUID = None
+        self.mwgroup = []
+        # indexes of mwgroup entries per their series signature key, so every
+        # file gets compared with is_same_series only to a few candidates
+        self.mwgroup_index = defaultdict(list)
+        self.mwgroup_unindexed = []
+        # files per series_id, in the order of files, and index of the
+        # mwgroup entry (the last one seen) to describe each series_id with
+        self.series_files = OrderedDict()
+        self.series_mwidx = {}
+        self.header_store = header_store
+        # (filename, header) of the first and of the smallest file per
+        # series_id
+        self.series_headers = {}
+
+    def add(self, filename, dcm_info):
+        """Add a file to the series it belongs to"""
+        series_id, file_studyUID = dcm_info.series_id, dcm_info.study_uid
+
+        if not self.per_studyUID and file_studyUID is not None:
+            # verify that we are working with a single study
+            if self.studyUID is None:
+                self.studyUID = file_studyUID
+            elif not self.per_accession_number:
+                assert self.studyUID == file_studyUID, (
+                "Conflicting study identifiers found [{}, {}].".format(
+                self.studyUID, file_studyUID
+                ))
+
+        if self.per_studyUID:
             series_id = series_id + (file_studyUID,)
 
-        ingrp = False
-        for idx in range(len(mwgroup)):
-            # same = mw.is_same_series(mwgroup[idx])
-            if mw.is_same_series(mwgroup[idx]):
+        mwgroup = self.mwgroup
+        file_series_ids = []
+        sig_key = get_series_signature_key(dcm_info.series_signature)
+        if sig_key is None:
+            candidates = range(len(mwgroup))
+        elif self.mwgroup_unindexed:
+            candidates = sorted(self.mwgroup_index.get(sig_key, []) +
+                                self.mwgroup_unindexed)
+        else:
+            candidates = self.mwgroup_index.get(sig_key, [])
+        for idx in candidates:
+            if is_same_series(dcm_info.series_signature,
+                              mwgroup[idx].series_signature):
                 # the same series should have the same study uuid
-                assert (mwgroup[idx].dcm_data.get('StudyInstanceUID', None)
+                assert (mwgroup[idx].fields.get('StudyInstanceUID', None)
                         == file_studyUID)
-                ingrp = True
                 if series_id[0] >= 0:
-                    series_id = (mwgroup[idx].dcm_data.SeriesNumber,
-                                 mwgroup[idx].dcm_data.ProtocolName)
-                    if per_studyUID:
+                    series_id = (mwgroup[idx].fields['SeriesNumber'],
+                                 mwgroup[idx].fields['ProtocolName'])
+                    if self.per_studyUID:
                         series_id = series_id + (file_studyUID,)
-                groups[0].append(series_id)
-                groups[1].append(idx)
+                file_series_ids.append((series_id, idx))
 
-        if not ingrp:
-            mwgroup.append(mw)
-            groups[0].append(series_id)
-            groups[1].append(len(mwgroup) - 1)
+        if not file_series_ids:
+            if sig_key is None:
+                self.mwgroup_unindexed.append(len(mwgroup))
+            else:
+                self.mwgroup_index[sig_key].append(len(mwgroup))
+            mwgroup.append(dcm_info)
+            file_series_ids.append((series_id, len(mwgroup) - 1))
 
-    group_map = dict(zip(groups[0], groups[1]))
+        for series_id, idx in file_series_ids:
+            self.series_mwidx[series_id] = idx
+            bucket = self.series_files.setdefault(series_id, [])
+            # file might match multiple entries of the same series
+            if not bucket or bucket[-1] is not filename:
+                bucket.append(filename)
+                if self.header_store is not None:
+                    self._add_header(series_id, filename, dcm_info.header)
 
-    total = 0
-    seqinfo = OrderedDict()
+    def _add_header(self, series_id, filename, header):
+        first, smallest = self.series_headers.get(
+            series_id, ((filename, header),) * 2)
+        if filename < smallest[0]:
+            smallest = (filename, header)
+        self.series_headers[series_id] = (first, smallest)
 
-    # for the next line to make any sense the series_id needs to
-    # be sortable in a way that preserves the series order
-    for series_id, mwidx in sorted(group_map.items()):
-        if series_id[0] < 0:
-            # skip our fake series with unwanted files
-            continue
-        mw = mwgroup[mwidx]
-        if mw.image_shape is None:
+    def pop_series(self):
+        """Generate (series_id, DicomFileInfo, files) of the series so far
+
+        Series are sorted by their series_id, and forgotten (but not their
+        representatives) once generated
+        """
+        # for the next line to make any sense the series_id needs to
+        # be sortable in a way that preserves the series order
+        for series_id in sorted(self.series_files):
+            series_files = self.series_files.pop(series_id)
+            mwidx = self.series_mwidx.pop(series_id)
+            headers = self.series_headers.pop(series_id, ())
+            if series_id[0] < 0:
+                # skip our fake series with unwanted files
+                continue
+            for filename, header in headers:
+                if header is not None:
+                    self.header_store[filename] = header
+            yield series_id, self.mwgroup[mwidx], series_files
+
+    def get_seqinfo(self, series_id, mw, series_files, total):
+        """Return (group key, SeqInfo) describing the series
+
+        Group key is StudyInstanceUID, AccessionNumber, or None, depending
+        on the grouping.  None is returned instead of SeqInfo if the series
+        has no image data
+        """
+        image_shape = mw.image_shape
+        if image_shape is None:
             # this whole thing has now image data (maybe just PSg DICOMs)
             # nothing to see here, just move on
-            continue
-        dcminfo = mw.dcm_data
-        series_files = [files[i] for i, s in enumerate(groups[0])
-                        if s == series_id]
+            return None, None
+        dcminfo = mw.fields
         # turn the series_id into a human-readable string -- string is needed
         # for JSON storage later on
-        if per_studyUID:
+        if self.per_studyUID:
             studyUID = series_id[2]
             series_id = series_id[:2]
         accession_number = dcminfo.get('AccessionNumber')
 
         series_id = '-'.join(map(str, series_id))
 
-        size = list(mw.image_shape) + [len(series_files)]
+        size = list(image_shape) + [len(series_files)]
         total += size[-1]
         if len(size) < 4:
             size.append(1)
 
         # MG - refactor into util function
         try:
-            TR = float(dcminfo.RepetitionTime) / 1000.
-        except (AttributeError, ValueError):
+            TR = float(dcminfo['RepetitionTime']) / 1000.
+        except (KeyError, ValueError):
             TR = -1
         try:
-            TE = float(dcminfo.EchoTime)
-        except (AttributeError, ValueError):
+            TE = float(dcminfo['EchoTime'])
+        except (KeyError, ValueError):
             TE = -1
         try:
-            refphys = str(dcminfo.ReferringPhysicianName)
-        except AttributeError:
+            refphys = str(dcminfo['ReferringPhysicianName'])
+        except KeyError:
             refphys = ''
         try:
-            image_type = tuple(dcminfo.ImageType)
-        except AttributeError:
+            image_type = tuple(dcminfo['ImageType'])
+        except KeyError:
             image_type = ''
-        try:
-            series_desc = dcminfo.SeriesDescription
-        except AttributeError:
-            series_desc = ''
 
         motion_corrected = 'MOCO' in image_type
 
-        if dcminfo.get([0x18,0x24], None):
-            # GE and Philips scanners
-            sequence_name = dcminfo[0x18,0x24].value
-        elif dcminfo.get([0x19, 0x109c], None):
-            # Siemens scanners
-            sequence_name = dcminfo[0x19, 0x109c].value
-        else:
-            sequence_name = 'Not found'
+        sequence_name = dcminfo.get('SequenceName', 'Not found')
 
         info = SeqInfo(
             total,
@@ -202,7 +917,7 @@ def group_dicoms_into_seqinfos(files, file_filter, dcmfilter, grouping):
             '-', '-',
             size[0], size[1], size[2], size[3],
             TR, TE,
-            dcminfo.ProtocolName,
+            dcminfo['ProtocolName'],
             motion_corrected,
             'derived' in [x.lower() for x in dcminfo.get('ImageType', [])],
             dcminfo.get('PatientID'),
@@ -220,40 +935,109 @@ def group_dicoms_into_seqinfos(files, file_filter, dcmfilter, grouping):
         )
         # candidates
         # dcminfo.AccessionNumber
-        #   len(dcminfo.ReferencedImageSequence)
-        #   len(dcminfo.SourceImageSequence)
+        #   dcminfo.NumberOfReferencedImages
+        #   dcminfo.NumberOfSourceImages
         # FOR demographics
-        if per_studyUID:
+        if self.per_studyUID:
             key = studyUID.split('.')[-1]
-        elif per_accession_number:
-            key = accession_number
+            group = studyUID
+        elif self.per_accession_number:
+            key = group = accession_number
         else:
             key = ''
+            group = None
         lgr.debug("%30s %30s %27s %27s %5s nref=%-2d nsrc=%-2d %s" % (
             key,
             info.series_id,
-            dcminfo.SeriesDescription,
-            dcminfo.ProtocolName,
+            dcminfo.get('SeriesDescription'),
+            dcminfo['ProtocolName'],
             info.is_derived,
-            len(dcminfo.get('ReferencedImageSequence', '')),
-            len(dcminfo.get('SourceImageSequence', '')),
+            dcminfo.get('NumberOfReferencedImages', 0),
+            dcminfo.get('NumberOfSourceImages', 0),
             info.image_type
         ))
-        if per_studyUID:
-            if studyUID not in seqinfo:
-                seqinfo[studyUID] = OrderedDict()
-            seqinfo[studyUID][info] = series_files
-        elif per_accession_number:
-            if accession_number not in seqinfo:
-                seqinfo[accession_number] = OrderedDict()
-            seqinfo[accession_number][info] = series_files
+        return group, info
+
+
+def _filter_files(files, file_filter):
+    if file_filter:
+        nfl_before = len(files)
+        files = list(filter(file_filter, files))
+        nfl_after = len(files)
+        lgr.info('Filtering out {0} dicoms based on their filename'.format(
+            nfl_before-nfl_after))
+    return files
+
+
+def group_dicoms_into_seqinfos(files, file_filter, dcmfilter, grouping,
+                               jobs=1, header_cache=None, use_dicomdir=False,
+                               allow_no_preamble=False, header_store=None):
+    """Process list of dicoms and return seqinfo and file group
+    `seqinfo` contains per-sequence extract of fields from DICOMs which
+    will be later provided into heuristics to decide on filenames
+    Parameters
+    ----------
+    files : list of str
+      List of files to consider
+    file_filter : callable, optional
+      Applied to each item of filenames. Should return True if file needs to be
+      kept, False otherwise.
+    dcmfilter : callable, optional
+      If called on dcm_data and returns True, it is used to set series_id
+    grouping : {'studyUID', 'accession_number', None}, optional
+        what to group by: studyUID or accession_number
+    jobs : int, optional
+      Number of processes to parse DICOM headers with.  Grouping results
+      do not depend on it
+    header_cache : HeaderCache, optional
+      Cache of previously parsed DICOM headers
+    use_dicomdir : bool, optional
+      If True and there are DICOMDIR files among the files, series of the
+      files they reference are taken from DICOMDIR, and only the first file
+      of each series is parsed
+    allow_no_preamble : bool, optional
+      If True, files without DICOM preamble are parsed as well (see
+      `is_dicom_file`).  Otherwise they are ignored
+    header_store : dict, optional
+      If provided, fields of the headers (see `get_header_fields`) of the
+      first file of each sequence, and of its first file in sorted order,
+      get stored there per filename.  It could then be passed to
+      `prep_conversion` (or `convert`), so those files do not get read again
+    Returns
+    -------
+    seqinfo : list of list
+      `seqinfo` is a list of info entries per each sequence (some entry
+      there defines a key for `filegrp`)
+    filegrp : dict
+      `filegrp` is a dictionary with files groupped per each sequence
+    """
+    grouper = _SeriesGrouper(grouping, header_store=header_store)
+    lgr.info("Analyzing %d dicoms", len(files))
+    files = _filter_files(files, file_filter)
+    for filename, dcm_info in _iter_files_dicom_file_infos(
+            files, use_dicomdir=use_dicomdir, dcmfilter=dcmfilter,
+            jobs=jobs, header_cache=header_cache,
+            allow_no_preamble=allow_no_preamble):
+        grouper.add(filename, dcm_info)
+
+    total = 0
+    seqinfo = OrderedDict()
+    for series_id, mw, series_files in grouper.pop_series():
+        group, info = grouper.get_seqinfo(series_id, mw, series_files, total)
+        if info is None:
+            continue
+        total = info.total_files_till_now
+        if grouper.per_studyUID or grouper.per_accession_number:
+            if group not in seqinfo:
+                seqinfo[group] = OrderedDict()
+            seqinfo[group][info] = series_files
         else:
             seqinfo[info] = series_files
 
-    if per_studyUID:
+    if grouper.per_studyUID:
         lgr.info("Generated sequence info for %d studies with %d entries total",
                  len(seqinfo), sum(map(len, seqinfo.values())))
-    elif per_accession_number:
+    elif grouper.per_accession_number:
         lgr.info("Generated sequence info for %d accession numbers with %d "
                  "entries total", len(seqinfo), sum(map(len, seqinfo.values())))
     else:
@@ -261,22 +1045,95 @@ def group_dicoms_into_seqinfos(files, file_filter, dcmfilter, grouping):
     return seqinfo
 
 
-def get_dicom_series_time(dicom_list):
+def iter_seqinfos(files, file_filter, dcmfilter, grouping, jobs=1,
+                  header_cache=None, use_dicomdir=False,
+                  allow_no_preamble=False, header_store=None):
+    """Generate information on each sequence as soon as it is complete
+
+    Streaming counterpart of `group_dicoms_into_seqinfos`, so processing of
+    sequences could start before all the files are parsed.  Files are
+    considered in runs of consecutive files from the same directory, and
+    sequences seen within a run are generated once the run is over, i.e.
+    it works best for layouts with one (or a few) sequence(s) per directory,
+    as typically exported by scanners.  Only files of the sequences within
+    the current run are kept in memory.
+
+    Parameters
+    ----------
+    files : list of str
+    file_filter : callable, optional
+    dcmfilter : callable, optional
+    grouping : {'studyUID', 'accession_number', None}, optional
+    jobs : int, optional
+    header_cache : HeaderCache, optional
+    use_dicomdir : bool, optional
+    allow_no_preamble : bool, optional
+    header_store : dict, optional
+      See `group_dicoms_into_seqinfos`
+
+    Yields
+    ------
+    group : str or None
+      StudyInstanceUID or AccessionNumber (depending on `grouping`), i.e. the
+      key `group_dicoms_into_seqinfos` would place the sequence under
+    seqinfo : SeqInfo
+      Its `total_files_till_now` accounts for the sequences generated before
+    files : list of str
+    """
+    grouper = _SeriesGrouper(grouping, header_store=header_store)
+    files = _filter_files(files, file_filter)
+    total = 0
+    completed = set()
+    prev_dirname = None
+    for filename, dcm_info in _iter_files_dicom_file_infos(
+            files, use_dicomdir=use_dicomdir, dcmfilter=dcmfilter,
+            jobs=jobs, header_cache=header_cache,
+            allow_no_preamble=allow_no_preamble):
+        dirname = op.dirname(filename)
+        if dirname != prev_dirname:
+            for res in _pop_seqinfos(grouper, completed, total):
+                total = res[1].total_files_till_now
+                yield res
+            prev_dirname = dirname
+        grouper.add(filename, dcm_info)
+    for res in _pop_seqinfos(grouper, completed, total):
+        yield res
+
+
+def _pop_seqinfos(grouper, completed, total):
+    """Generate (group, SeqInfo, files) for the series accumulated so far"""
+    for series_id, mw, series_files in grouper.pop_series():
+        if series_id in completed:
+            lgr.warning(
+                "Files of sequence %s were found after the sequence was "
+                "considered to be complete.  They will be provided as a "
+                "separate sequence", series_id)
+        completed.add(series_id)
+        group, info = grouper.get_seqinfo(series_id, mw, series_files, total)
+        if info is None:
+            continue
+        total = info.total_files_till_now
+        yield group, info, series_files
+
+
+def get_dicom_series_time(dicom_list, header_store=None):
     """Get time in seconds since epoch from dicom series date and time
-    Primarily to be used for reproducible time stamping
+    Primarily to be used for reproducible time stamping.  Header of the first
+    file is taken from `header_store` if it is there
     """
     import time
     import calendar
 
-    dicom = dcm.read_file(dicom_list[0], stop_before_pixels=True, force=True)
-    dcm_date = dicom.SeriesDate  # YYYYMMDD
-    dcm_time = dicom.SeriesTime  # HHMMSS.MICROSEC
+    fields = get_dicom_header_fields(dicom_list[0], header_store)
+    dcm_date = fields['SeriesDate']  # YYYYMMDD
+    dcm_time = fields['SeriesTime']  # HHMMSS.MICROSEC
     dicom_time_str = dcm_date + dcm_time.split('.', 1)[0]  # YYYYMMDDHHMMSS
     # convert to epoch
     return calendar.timegm(time.strptime(dicom_time_str, '%Y%m%d%H%M%S'))
 
 
-def compress_dicoms(dicom_list, out_prefix, tempdirs, overwrite):
+def compress_dicoms(dicom_list, out_prefix, tempdirs, overwrite,
+                    header_store=None):
     """Archives DICOMs into a tarball
 
     Also tries to do it reproducibly, so takes the date for files
@@ -293,6 +1150,8 @@ def compress_dicoms(dicom_list, out_prefix, tempdirs, overwrite):
       TempDirs object to handle multiple tmpdirs
     overwrite : bool
       Overwrite existing tarfiles
+    header_store : dict, optional
+      Fields of DICOM headers, as populated by `group_dicoms_into_seqinfos`
 
     Returns
     -------
@@ -311,7 +1170,7 @@ def compress_dicoms(dicom_list, out_prefix, tempdirs, overwrite):
     # Solution from DataLad although ugly enough:
 
     dicom_list = sorted(dicom_list)
-    dcm_time = get_dicom_series_time(dicom_list)
+    dcm_time = get_dicom_series_time(dicom_list, header_store)
 
     def _assign_dicom_time(ti):
         # Reset the date to match the one of the last commit, not from the
@@ -379,7 +1238,12 @@ def embed_nifti(dcmfiles, niftifile, infofile, bids_info, force, min_meta):
 
     if not min_meta:
         import dcmstack as ds
-        stack = ds.parse_and_stack(dcmfiles, force=force).values()
+        from heudiconv.dicoms import stack_dicom_headers
+        if op.exists(niftifile):
+            # only meta data is needed, so pixel data does not get even read
+            stack = stack_dicom_headers(dcmfiles, force=force).values()
+        else:
+            stack = ds.parse_and_stack(dcmfiles, force=force).values()
         if len(stack) > 1:
             raise ValueError('Found multiple series')
         stack = stack[0]
@@ -421,6 +1285,20 @@ def embed_nifti(dcmfiles, niftifile, infofile, bids_info, force, min_meta):
     return niftifile, infofile
 
 
+def _run_embed_nifti_node(embed_kwargs, tmpdir):
+    """Run `embed_nifti` as a nipype Node within tmpdir, return its result"""
+    from nipype import Node, Function
+    embedfunc = Node(Function(input_names=['dcmfiles', 'niftifile', 'infofile',
+                                           'bids_info', 'force', 'min_meta'],
+                              output_names=['outfile', 'meta'],
+                              function=embed_nifti),
+                     name='embedder')
+    for name, value in embed_kwargs.items():
+        setattr(embedfunc.inputs, name, value)
+    embedfunc.base_dir = tmpdir
+    return run_node(embedfunc)
+
+
 def embed_metadata_from_dicoms(bids, item_dicoms, outname, outname_bids,
                                prov_file, scaninfo, tempdirs, with_prov,
                                min_meta):
@@ -443,27 +1321,15 @@ def embed_metadata_from_dicoms(bids, item_dicoms, outname, outname_bids,
     -------
 
     """
-    from nipype import Node, Function
-    tmpdir = tempdirs(prefix='embedmeta')
-
     # We need to assure that paths are absolute if they are relative
     item_dicoms = list(map(op.abspath, item_dicoms))
-
-    embedfunc = Node(Function(input_names=['dcmfiles', 'niftifile', 'infofile',
-                                           'bids_info', 'force', 'min_meta'],
-                              output_names=['outfile', 'meta'],
-                              function=embed_nifti),
-                     name='embedder')
-    embedfunc.inputs.dcmfiles = item_dicoms
-    embedfunc.inputs.niftifile = op.abspath(outname)
-    embedfunc.inputs.infofile = op.abspath(scaninfo)
-    embedfunc.inputs.min_meta = min_meta
-    if bids:
-        embedfunc.inputs.bids_info = load_json(op.abspath(outname_bids))
-    else:
-        embedfunc.inputs.bids_info = None
-    embedfunc.inputs.force = True
-    embedfunc.base_dir = tmpdir
+    embed_kwargs = dict(
+        dcmfiles=item_dicoms,
+        niftifile=op.abspath(outname),
+        infofile=op.abspath(scaninfo),
+        bids_info=load_json(op.abspath(outname_bids)) if bids else None,
+        force=True,
+        min_meta=min_meta)
     cwd = os.getcwd()
     lgr.debug("Embedding into %s based on dicoms[0]=%s for nifti %s",
               scaninfo, item_dicoms[0], outname)
@@ -472,7 +1338,12 @@ def embed_metadata_from_dicoms(bids, item_dicoms, outname, outname_bids,
             # TODO: handle annexed file case
             if not op.islink(scaninfo):
                 set_readonly(scaninfo, False)
-        res = embedfunc.run()
+        if with_prov:
+            # run through nipype, which records provenance of the embedding
+            res = _run_embed_nifti_node(embed_kwargs,
+                                        tempdirs(prefix='embedmeta'))
+        else:
+            embed_nifti(**embed_kwargs)
         set_readonly(scaninfo)
         if with_prov:
             g = res.provenance.rdf()
@@ -25,3 +25,50 @@ except ImportError as e:
     sys.modules['dicom'] = dcm
     # and try again
     import dcmstack as ds
+
+import numpy as np
+
+
+def _zeros(shape):
+    """Return array of zeros of the shape, taking no memory"""
+    return np.broadcast_to(np.zeros((), dtype=np.int16), shape)
+
+
+class HeaderDataset(dcm.dataset.Dataset):
+    """pydicom data set of a DICOM header, i.e. read without pixel data
+
+    Its pixel array is all zeros, so it can be wrapped (e.g. by nibabel's
+    `wrapper_from_data`) and stacked as any image, without pixel data ever
+    being read.
+    """
+
+    # so it is taken for an image (see dcmstack's `is_image`), as it was
+    # before its pixel data got dropped
+    PixelData = None
+
+    def __init__(self, dcm_data):
+        super(HeaderDataset, self).__init__(dcm_data)
+        for attr in ('file_meta', 'preamble', 'is_little_endian',
+                     'is_implicit_VR'):
+            if hasattr(dcm_data, attr):
+                setattr(self, attr, getattr(dcm_data, attr))
+
+    @property
+    def pixel_array(self):
+        """Zeros of the shape of the pixel data"""
+        return _zeros((self.Rows, self.Columns))
+
+
+class HeaderDicomStack(ds.DicomStack):
+    """DicomStack of `HeaderDataset`s
+
+    Its voxels are all zeros (taking no memory), so only the shape, affine,
+    and meta data of the stack (e.g. as embedded by `to_nifti`) are of any
+    use.
+    """
+
+    def get_data(self):
+        """Get an array of zeros (taking no memory) of the stack's shape"""
+        return _zeros(self.shape)
+
+    data = property(fget=get_data)
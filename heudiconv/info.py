@@ -13,6 +13,7 @@ REQUIRES = [
     'pydicom',
     'nipype',
     'pathlib',
+    'scandir; python_version < "3.5"',
     'dcmstack>=0.7',
 ]
 
@@ -27,7 +28,9 @@ TESTS_REQUIRES = [
 EXTRA_REQUIRES = {
     'tests': TESTS_REQUIRES,
     'extras': [],  # Requires patched version ATM ['dcmstack'],
-    'datalad': ['datalad']
+    'datalad': ['datalad'],
+    # seek points of gzipped tarballs, see `archives`
+    'archives': ['indexed_gzip'],
 }
 
 # Flatten the lists
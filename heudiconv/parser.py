@@ -1,5 +1,5 @@
+import hashlib
 import logging
-import os
 import os.path as op
 from glob import glob
 import re
@@ -7,8 +7,14 @@ import re
 from collections import defaultdict, OrderedDict
 
 import tarfile
-from tempfile import mkdtemp
 
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+
+from .archives import make_temp_dir, register_archives, set_file_stats
+from .cache import FilesState
 from .dicoms import group_dicoms_into_seqinfos
 from .utils import (
     docstring_parameter,
@@ -23,9 +29,17 @@ lgr = logging.getLogger(__name__)
 
 _VCS_REGEX = '%s\.(?:git|gitattributes|svn|bzr|hg)(?:%s|$)' % (op.sep, op.sep)
 
+def _get_entry_stat(entry):
+    try:
+        return entry.stat()
+    except OSError:
+        # e.g. a broken symlink
+        return None
+
+
 @docstring_parameter(_VCS_REGEX)
 def find_files(regex, topdir=op.curdir, exclude=None,
-               exclude_vcs=True, dirs=False):
+               exclude_vcs=True, dirs=False, stat=False, exclude_dirs=None):
     """Generator to find files matching regex
     Parameters
     ----------
@@ -39,26 +53,82 @@ def find_files(regex, topdir=op.curdir, exclude=None,
       Directory where to search
     dirs: bool, optional
       Either to match directories as well as files
+    stat: bool, optional
+      If True, generate (path, os.stat_result) pairs, with stat results
+      obtained while scanning directories (None if it failed)
+    exclude_dirs: basestring, optional
+      Directories whose path (with trailing separator) matches are not
+      descended into, nor matched themselves.  Known VCS subdirectories
+      are not descended into either if `exclude_vcs` is True, since all
+      the paths under them would be excluded anyway
     """
+    regex = re.compile(regex)
+    excludes = []
+    if exclude:
+        excludes.append(re.compile(exclude))
+    if exclude_vcs:
+        excludes.append(re.compile(
+            _VCS_REGEX if exclude_vcs is True else exclude_vcs))
+    prunes = []
+    if exclude_dirs:
+        prunes.append(re.compile(exclude_dirs))
+    if exclude_vcs is True:
+        prunes.append(excludes[-1])
 
-    for dirpath, dirnames, filenames in os.walk(topdir):
-        names = (dirnames + filenames) if dirs else filenames
-        paths = (op.join(dirpath, name) for name in names)
-        for path in filter(re.compile(regex).search, paths):
-            path = path.rstrip(op.sep)
-            if exclude and re.search(exclude, path):
+    def is_excluded(path, excludes):
+        return any(e.search(path) for e in excludes)
+
+    subdirs = [topdir]
+    while subdirs:
+        dirpath = subdirs.pop()
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            # as os.walk, ignore directories which cannot be listed
+            continue
+        dirnames = []
+        # as os.walk, directories go before files
+        dir_entries = []
+        file_entries = []
+        for entry in entries:
+            path = op.join(dirpath, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if is_excluded(path + op.sep, prunes):
+                    continue
+                if not entry.is_symlink():
+                    dirnames.append(path)
+                if dirs:
+                    dir_entries.append((path, entry))
+            else:
+                file_entries.append((path, entry))
+        for path, entry in dir_entries + file_entries:
+            if not regex.search(path):
                 continue
-            if exclude_vcs and re.search(_VCS_REGEX, path):
+            path = path.rstrip(op.sep)
+            if is_excluded(path, excludes):
                 continue
-            yield path
+            yield (path, _get_entry_stat(entry)) if stat else path
+        # descend in the order os.walk would
+        subdirs.extend(reversed(dirnames))
 
 
-def get_extracted_dicoms(fl):
+def get_extracted_dicoms(fl, jobs=1):
     """Given a list of files, possibly extract some from tarballs
     For 'classical' heudiconv, if multiple tarballs are provided, they correspond
     to different sessions, so here we would group into sessions and return
     pairs  `sessionid`, `files`  with `sessionid` being None if no "sessions"
     detected for that file or there was just a single tarball in the list
+
+    Files of tarballs are not extracted right away, but only registered
+    under a temporary directory (see `archives`), so their headers are read
+    directly from the tarballs, and only the first files of the sequences
+    (e.g. for heuristics to read) and files which get converted are
+    extracted later on.  Contents of multiple tarballs are listed by `jobs`
+    processes concurrently
     """
     # TODO: bring check back?
     # if any(not tarfile.is_tarfile(i) for i in fl):
@@ -66,11 +136,12 @@ def get_extracted_dicoms(fl):
 
     # tarfiles already know what they contain, and often the filenames
     # are unique, or at least in a unqiue subdir per session
-    # strategy: extract everything in a temp dir and assemble a list
+    # strategy: register everything under a temp dir and assemble a list
     # of all files in all tarballs
 
-    # cannot use TempDirs since will trigger cleanup with __del__
-    tmpdir = mkdtemp(prefix='heudiconvDCM')
+    # cannot use TempDirs since will trigger cleanup with __del__, while
+    # other study sessions might still be converted from it
+    tmpdir = make_temp_dir()
 
     sessions = defaultdict(list)
     session = 0
@@ -78,26 +149,20 @@ def get_extracted_dicoms(fl):
         fl = list(fl)
 
     # needs sorting to keep the generated "session" label deterministic
+    tarballs = []
     for i, t in enumerate(sorted(fl)):
         # "classical" heudiconv has that heuristic to handle multiple
         # tarballs as providing different sessions per each tarball
         if not tarfile.is_tarfile(t):
             sessions[None].append(t)
             continue
+        tarballs.append(t)
 
-        tf = tarfile.open(t)
-        # check content and sanitize permission bits
-        tmembers = tf.getmembers()
-        for tm in tmembers:
-            tm.mode = 0o700
-        # get all files, assemble full path in tmp dir
-        tf_content = [m.name for m in tmembers if m.isfile()]
-        # store full paths to each file, so we don't need to drag along
-        # tmpdir as some basedir
-        sessions[session] = [op.join(tmpdir, f) for f in tf_content]
+    # store full paths to each file, so we don't need to drag along
+    # tmpdir as some basedir
+    for tarball_files in register_archives(tarballs, tmpdir, jobs=jobs):
+        sessions[session] = tarball_files
         session += 1
-        # extract into tmp dir
-        tf.extractall(path=tmpdir, members=tmembers)
 
     if session == 1:
         # we had only 1 session, so no really multiple sessions according
@@ -109,7 +174,10 @@ def get_extracted_dicoms(fl):
 
 
 def get_study_sessions(dicom_dir_template, files_opt, heuristic, outdir,
-                       session, sids, grouping='studyUID'):
+                       session, sids, grouping='studyUID', jobs=1,
+                       header_cache=None, use_dicomdir=False,
+                       allow_no_preamble=False, state_dir=None,
+                       header_store=None):
     """Given options from cmdline sort files or dicom seqinfos into
     study_sessions which put together files for a single session of a subject
     in a study
@@ -118,6 +186,16 @@ def get_study_sessions(dicom_dir_template, files_opt, heuristic, outdir,
       loads files pointed by each subject and possibly sessions as corresponding
       to different tarballs
     - if files_opt is provided, sorts all DICOMs it can find under those paths
+      (using `jobs` processes to parse DICOM headers, consulting
+      `header_cache` if provided, and taking series of the files referenced
+      by DICOMDIRs from them if `use_dicomdir`).  Files without DICOM
+      preamble are ignored unless `allow_no_preamble`.  If `state_dir` is
+      provided, information on the files is kept there (see
+      `cache.FilesState`), so subsequent runs on the same files_opt parse
+      only new or changed files.  States get unpickled, so `state_dir`
+      must not be shared with others (e.g. within the output dataset).  Fields of headers needed for the
+      conversion get stored in `header_store` if provided (see
+      `group_dicoms_into_seqinfos`)
     """
     study_sessions = {}
     if dicom_dir_template:
@@ -135,7 +213,7 @@ def get_study_sessions(dicom_dir_template, files_opt, heuristic, outdir,
         for sid in sids:
             sdir = dicom_dir_template.format(subject=sid, session=session)
             files = sorted(glob(sdir))
-            for session_, files_ in get_extracted_dicoms(files):
+            for session_, files_ in get_extracted_dicoms(files, jobs=jobs):
                 if session_ is not None and session:
                     lgr.warning(
                         "We had session specified (%s) but while analyzing "
@@ -152,24 +230,42 @@ def get_study_sessions(dicom_dir_template, files_opt, heuristic, outdir,
         # prep files
         # assert files_opt
         files = []
+        stats = {}
         for f in files_opt:
             if op.isdir(f):
-                files += sorted(find_files(
-                    '.*', topdir=f, exclude_vcs=True, exclude="/\.datalad/"))
+                found = sorted(find_files(
+                    '.*', topdir=f, exclude_vcs=True,
+                    exclude_dirs=r"/\.(datalad|heudiconv)/$", stat=True))
+                files += [path for path, _ in found]
+                stats.update((path, st) for path, st in found if st)
             else:
                 files.append(f)
+        # so files do not get stat'ed again, e.g. by header_cache
+        set_file_stats(stats)
 
         # in this scenario we don't care about sessions obtained this way
         files_ = []
-        for _, files_ex in get_extracted_dicoms(files):
+        for _, files_ex in get_extracted_dicoms(files, jobs=jobs):
             files_ += files_ex
 
+        if state_dir:
+            inputs = '\n'.join(sorted(op.abspath(f) for f in files_opt))
+            header_cache = FilesState(
+                op.join(state_dir, 'files-%s.pkl'
+                        % hashlib.md5(inputs.encode('utf-8')).hexdigest()),
+                header_cache=header_cache)
+
         # sort all DICOMS using heuristic
         # TODO:  this one is not grouping by StudyUID but may be we should!
         seqinfo_dict = group_dicoms_into_seqinfos(files_,
             file_filter=getattr(heuristic, 'filter_files', None),
             dcmfilter=getattr(heuristic, 'filter_dicom', None),
-            grouping=grouping)
+            grouping=grouping,
+            jobs=jobs,
+            header_cache=header_cache,
+            use_dicomdir=use_dicomdir,
+            allow_no_preamble=allow_no_preamble,
+            header_store=header_store)
 
         if not getattr(heuristic, 'infotoids', None):
             raise NotImplementedError(
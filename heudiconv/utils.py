@@ -1,4 +1,5 @@
 """Utility objects and functions"""
+import errno
 import hashlib
 import os
 import tempfile
@@ -9,10 +10,15 @@ import shutil
 import copy
 import stat
 import os.path as op
-from pathlib import Path
 from collections import namedtuple
+from contextlib import contextmanager
 from glob import glob
 
+try:
+    import fcntl
+except ImportError:  # e.g. on Windows
+    fcntl = None
+
 import logging
 lgr = logging.getLogger(__name__)
 
@@ -313,21 +319,188 @@ def get_known_heuristics_with_descriptions():
     return heuristics
 
 
-def safe_copyfile(src, dest, overwrite=False):
-    """Copy file but blow if destination name already exists
+# whether `locked` actually locks, see `enable_locking`
+_locking = False
+
+
+def enable_locking(enabled=True):
+    """Make `locked` lock, e.g. while study sessions get processed concurrently
+
+    Otherwise no lock files get created, since nothing else is expected to
+    update the outputs meanwhile
+    """
+    global _locking
+    _locking = enabled
+
+
+@contextmanager
+def locked(path):
+    """Context manager to hold an exclusive lock on the path (e.g. study dir)
+
+    So files shared by processes working on it concurrently (e.g.
+    participants.tsv of a study) get updated by a single process at a time.
+    The lock file is kept within .heudiconv/ of the path.  Nothing gets
+    locked unless enabled (see `enable_locking`), if `fcntl` is not
+    available (see `can_lock`), or if the lock file cannot be opened
+    """
+    f = None
+    if _locking and fcntl is not None:
+        lockdir = op.join(path, '.heudiconv')
+        try:
+            if not op.isdir(lockdir):
+                os.makedirs(lockdir)
+        except OSError:
+            pass  # e.g. just made by another process, or cannot be made
+        try:
+            f = open(op.join(lockdir, '.lock'), 'a')
+        except (IOError, OSError) as exc:
+            lgr.warning("Cannot lock %s, proceeding without a lock: %s",
+                        path, exc)
+    if f is None:
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def can_lock():
+    """Return True if `locked` actually locks"""
+    return fcntl is not None
+
+
+def run_node(node):
+    """Run nipype node, keeping provenance it writes within its directory
+
+    nipype writes provenance (if enabled) into the current directory once
+    the interface has run, so the node gets run from within its base
+    directory, and provenance files get moved into its output directory,
+    instead of getting scattered wherever heudiconv was started
     """
+    if not op.exists(node.base_dir):
+        os.makedirs(node.base_dir)
+    cwd = os.getcwd()
+    os.chdir(node.base_dir)
+    try:
+        res = node.run()
+    finally:
+        os.chdir(cwd)
+    for f in glob(op.join(node.base_dir, 'provenance.*')):
+        shutil.move(f, op.join(node.output_dir(), op.basename(f)))
+    return res
+
+
+def get_fork_context():
+    """Return multiprocessing context starting processes by forking
+
+    Forked processes inherit the state of the parent (e.g. functions of a
+    heuristic loaded from a file), so it does not need to be pickled, as it
+    does with "spawn" start method (default on macOS and Windows).
+
+    Returns
+    -------
+    context or None
+      None if processes cannot be forked (e.g. on Windows), in which case
+      the work should be done serially
+    """
+    import multiprocessing
+    if not hasattr(multiprocessing, 'get_context'):
+        # Python 2, which forks wherever it can
+        return None if sys.platform == 'win32' else multiprocessing
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+def _prepare_destination(src, dest, overwrite, action='copy'):
     if op.isdir(dest):
         dest = op.join(dest, op.basename(src))
     if op.lexists(dest):
         if not overwrite:
             raise RuntimeError(
-                "was asked to copy %s but destination already exists: %s"
-                % (src, dest)
+                "was asked to %s %s but destination already exists: %s"
+                % (action, src, dest)
             )
         os.unlink(dest)
+    return dest
+
+
+def safe_copyfile(src, dest, overwrite=False):
+    """Copy file but blow if destination name already exists
+    """
+    dest = _prepare_destination(src, dest, overwrite)
+    shutil.copyfile(src, dest)
+
+
+def safe_movefile(src, dest, overwrite=False):
+    """Move file but blow if destination name already exists
+
+    File is renamed (so its content is not rewritten) if it is on the same
+    filesystem as the destination, and copied (leaving src in place)
+    otherwise
+    """
+    dest = _prepare_destination(src, dest, overwrite, action='move')
+    try:
+        os.rename(src, dest)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dest)
+
+
+# Ways to output a file, see `output_file`
+FILE_OUTPUT_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+# ioctl to clone (reflink) a file on Linux (e.g. on btrfs or XFS)
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """Make dest share the data of src, copy it if not supported"""
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+                fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError) as exc:
+            lgr.debug("Could not reflink %s, will copy it: %s", src, exc)
     shutil.copyfile(src, dest)
 
 
+def output_file(src, dest, mode='copy'):
+    """Output src file as dest, which should not exist yet
+
+    Parameters
+    ----------
+    src : str
+    dest : str
+    mode : {'copy', 'hardlink', 'symlink', 'reflink'}, optional
+      Either to copy src, hard link it, symlink it (by its absolute path),
+      or make a copy sharing its data (a "reflink").  Files are copied if
+      they cannot be hard linked or reflinked, e.g. since on different
+      filesystems
+    """
+    if mode == 'copy':
+        shutil.copyfile(src, dest)
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dest)
+        except OSError as exc:
+            lgr.debug("Could not hard link %s, will copy it: %s", src, exc)
+            shutil.copyfile(src, dest)
+    elif mode == 'symlink':
+        os.symlink(op.abspath(src), dest)
+    elif mode == 'reflink':
+        _reflink(src, dest)
+    else:
+        raise ValueError(
+            "Unknown file output mode %r, known are: %s"
+            % (mode, ', '.join(FILE_OUTPUT_MODES)))
+
+
 # Globals to check filewriting permissions
 ALL_CAN_WRITE = (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
 ALL_CAN_READ = (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
@@ -373,19 +546,6 @@ def is_readonly(path):
     return not bool(perms & ALL_CAN_WRITE)
 
 
-def clear_temp_dicoms(item_dicoms):
-    """Ensures DICOM temporary directories are safely cleared"""
-    try:
-        tmp = Path(op.commonprefix(item_dicoms)).parents[1]
-    except IndexError:
-        return
-    if (str(tmp.parent) == tempfile.gettempdir()
-        and str(tmp.stem).startswith('heudiconvDCM')
-        and op.exists(str(tmp))):
-        # clean up directory holding dicoms
-        shutil.rmtree(str(tmp))
-
-
 def file_md5sum(filename):
     with open(filename, 'rb') as f:
         return hashlib.md5(f.read()).hexdigest()
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmpdir_factory, monkeypatch):
+    """Keep caches (e.g. of DICOM headers) away from the user's ones"""
+    cache_home = str(tmpdir_factory.mktemp('cache'))
+    monkeypatch.setenv('XDG_CACHE_HOME', cache_home)
+    return cache_home
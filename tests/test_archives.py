@@ -0,0 +1,261 @@
+import os
+import os.path as op
+import tarfile
+import time
+
+import pytest
+from mock import patch
+
+from heudiconv import archives
+from heudiconv.archives import (
+    clear_materialized_files,
+    evict_indexes,
+    get_archive,
+    get_file_key,
+    is_archived,
+    is_temporary,
+    make_temp_dir,
+    materialize_files,
+    open_file,
+    register_archive,
+    register_archives,
+    relocate_files,
+    remove_temp_dirs,
+    set_file_stats,
+    set_index_dir,
+)
+from heudiconv.dicoms import group_dicoms_into_seqinfos
+from heudiconv.parser import get_extracted_dicoms
+
+from .test_dicoms import TEST_DICOMS
+from .utils import TESTS_DATA_PATH
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmpdir):
+    """Keep indexes of tarballs away from the user's cache"""
+    index_dir = str(tmpdir.join('index'))
+    orig = archives._index_dir
+    set_index_dir(index_dir)
+    yield index_dir
+    set_index_dir(orig)
+    archives.close_archives()
+
+
+def _make_tarball(tmpdir):
+    tarball = str(tmpdir.join('dicoms.tgz'))
+    with tarfile.open(tarball, 'w:gz') as tf:
+        tf.add(TESTS_DATA_PATH, arcname='data')
+    return tarball
+
+
+def test_register_archive(tmpdir):
+    tarball = _make_tarball(tmpdir)
+    topdir = str(tmpdir.join('extracted'))
+    files = register_archive(tarball, topdir)
+    assert sorted(files) == sorted(
+        op.join(topdir, 'data', op.relpath(f, TESTS_DATA_PATH))
+        for f in TEST_DICOMS)
+    assert not op.exists(topdir)
+    assert all(is_archived(f) for f in files)
+    assert not is_archived(TEST_DICOMS[0])
+
+    for f in files:
+        orig = op.join(TESTS_DATA_PATH, op.relpath(f, op.join(topdir, 'data')))
+        with open(orig, 'rb') as fo, open_file(f) as fa:
+            assert fa.read() == fo.read()
+        key = get_file_key(f)
+        assert key[0].startswith(op.realpath(tarball) + '//data/')
+        assert key[1:] == (os.stat(orig).st_size, os.stat(tarball).st_mtime)
+
+    key = get_file_key(files[0])
+    materialize_files(files[:1])
+    assert op.exists(files[0])
+    assert not is_archived(files[0])
+    # still identified by the member, e.g. by the conversion cache
+    assert get_file_key(files[0]) == key
+    assert all(is_archived(f) for f in files[1:])
+
+
+def test_get_file_key_stats():
+    f = TEST_DICOMS[0]
+    st = os.stat(f)
+    set_file_stats({f: st})
+    try:
+        with patch.object(archives.os, 'stat', side_effect=AssertionError):
+            assert get_file_key(f) == (op.realpath(f), st.st_size, st.st_mtime)
+    finally:
+        set_file_stats({})
+
+
+def test_register_archives_materialize_parallel(tmpdir):
+    tarballs = []
+    for i in range(3):
+        tarballs.append(_make_tarball(tmpdir.mkdir('t%d' % i)))
+    topdirs = [str(tmpdir.join('extracted%d' % i)) for i in range(3)]
+    files = [register_archives([t], d, jobs=1)[0]
+             for t, d in zip(tarballs, topdirs)]
+    # same paths as if registered one by one, in the order of tarballs
+    assert register_archives(tarballs, topdirs[0], jobs=3)[0] == files[0]
+    # last registered tarball wins for the same paths
+    assert all(get_archive(f) == tarballs[-1] for f in files[0])
+    all_files = sum(files, [])
+    materialize_files(all_files, jobs=3)
+    assert not any(map(is_archived, all_files))
+    for f in all_files:
+        assert os.stat(f).st_mode & 0o777 == 0o700
+
+
+def test_clear_materialized_files(tmpdir):
+    tarball = _make_tarball(tmpdir)
+    topdir = make_temp_dir()
+    files = register_archive(tarball, topdir)
+    materialize_files(files)
+    other = op.join(topdir, 'other')
+    open(other, 'w').close()
+    assert is_temporary(files[0])
+    assert not is_temporary(tarball)
+    assert not is_temporary(topdir + 'x')
+    clear_materialized_files(files[:1] + [other])
+    # can be extracted again
+    assert is_archived(files[0])
+    assert not any(map(is_archived, files[1:]))
+    assert op.exists(other)
+    remove_temp_dirs()
+    assert not op.exists(topdir)
+
+
+def test_relocate_files(tmpdir):
+    tarball = _make_tarball(tmpdir)
+    files = register_archive(tarball, str(tmpdir.join('extracted')))
+    gone = [str(tmpdir.join('gone', op.relpath(f, str(tmpdir.join(
+        'extracted'))))) for f in files]
+    assert relocate_files(gone + TEST_DICOMS[:1], files) \
+        == files + TEST_DICOMS[:1]
+    # only among the given files
+    assert relocate_files(gone, files[:1]) == files[:1] + gone[1:]
+
+
+def test_group_dicoms_from_tarball(tmpdir):
+    tarball = _make_tarball(tmpdir)
+    (session, files), = get_extracted_dicoms([tarball])
+    assert session is None
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, None)
+    # nothing got extracted while grouping
+    assert not any(map(op.exists, files))
+    expected = group_dicoms_into_seqinfos(TEST_DICOMS, None, None, None)
+    assert [(s.series_id, s.dim1, s.dim2, s.dim3, s.example_dcm_file)
+            for s in seqinfo] \
+        == [(s.series_id, s.dim1, s.dim2, s.dim3, s.example_dcm_file)
+            for s in expected]
+
+
+def _list_members_indexes(index_dir):
+    return [f for f in os.listdir(index_dir) if f.endswith('.members')]
+
+
+def test_archive_index(tmpdir, index_dir):
+    tarball = _make_tarball(tmpdir)
+    topdir = str(tmpdir.join('extracted'))
+    files = register_archive(tarball, topdir)
+    assert len(_list_members_indexes(index_dir)) == 1
+    members = [archives._members[f][1] for f in files]
+
+    # unchanged tarball does not get even opened to be registered again
+    with patch.object(archives.tarfile, 'open', side_effect=AssertionError):
+        assert register_archive(tarball, topdir) == files
+    assert [(m.name, m.offset, m.offset_data, m.size)
+            for m in (archives._members[f][1] for f in files)] \
+        == [(m.name, m.offset, m.offset_data, m.size) for m in members]
+    # and members still get read according to the index
+    orig = TEST_DICOMS[0]
+    with open(orig, 'rb') as fo, open_file(
+            op.join(topdir, 'data', op.relpath(orig, TESTS_DATA_PATH))) as fa:
+        assert fa.read() == fo.read()
+
+    # index is not used if tarball changes
+    st = os.stat(tarball)
+    os.utime(tarball, (st.st_atime, st.st_mtime - 10))
+    with patch.object(archives.tarfile, 'open', side_effect=AssertionError):
+        with pytest.raises(AssertionError):
+            register_archive(tarball, topdir)
+    assert register_archive(tarball, topdir) == files
+
+    # nothing gets stored without index directory
+    set_index_dir(None)
+    register_archive(_make_tarball(tmpdir.mkdir('other')), topdir)
+    assert len(_list_members_indexes(index_dir)) == 1
+
+
+def test_archive_gzip_index(tmpdir, index_dir):
+    pytest.importorskip('indexed_gzip')
+    tarball = _make_tarball(tmpdir)
+    files = register_archive(tarball, str(tmpdir.join('extracted')))
+    assert len(os.listdir(index_dir)) == 2
+    archives.close_archives()
+    # members can be read in any order
+    for f in files[::-1]:
+        orig = op.join(TESTS_DATA_PATH,
+                       op.relpath(f, str(tmpdir.join('extracted', 'data'))))
+        with open(orig, 'rb') as fo, open_file(f) as fa:
+            assert fa.read() == fo.read()
+    assert isinstance(archives._get_tarfile(tarball).fileobj,
+                      archives.indexed_gzip.IndexedGzipFile)
+    archives.close_archives()
+    # seek points of the tarball before it changed get removed
+    st = os.stat(tarball)
+    os.utime(tarball, (st.st_atime, st.st_mtime - 10))
+    register_archive(tarball, str(tmpdir.join('extracted')))
+    index_files = os.listdir(index_dir)
+    assert len(index_files) == 2
+    assert '-%d.gzidx' % (st.st_mtime - 10) in ' '.join(index_files)
+
+
+def test_evict_indexes(tmpdir):
+    index_dir = tmpdir.mkdir('index')
+    now = time.time()
+    for name, size, age in (('new', 10, 0), ('recent', 20, 100),
+                            ('old', 30, 200), ('stale', 1, 10000)):
+        index_dir.join(name).write('x' * size)
+        os.utime(str(index_dir.join(name)), (now - age, now - age))
+    evict_indexes(str(index_dir), max_age=1000, max_size=35)
+    assert sorted(os.listdir(str(index_dir))) == ['new', 'recent']
+
+
+HEURISTIC = '''
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    return template, outtype, annotation_classes
+
+
+def infotodict(seqinfo):
+    fmap = create_key('fmap')
+    info = {fmap: []}
+    for s in seqinfo:
+        if 'fmap' in s.protocol_name:
+            info[fmap].append(s.series_id)
+    return info
+'''
+
+
+def test_extract_only_selected_series(tmpdir):
+    from heudiconv.cli.run import main as runner
+    _make_tarball(tmpdir.mkdir('sub'))
+    heuristic = tmpdir.join('heuristic.py')
+    heuristic.write(HEURISTIC)
+    outdir = tmpdir.join('out')
+    requested = []
+
+    def materialize_files_(files, **kwargs):
+        requested.append(sorted(op.basename(f) for f in files))
+        materialize_files(files, **kwargs)
+
+    with patch('heudiconv.convert.materialize_files', materialize_files_):
+        runner(['-d', op.join(str(tmpdir), '{subject}', '*.tgz'),
+                '-s', 'sub', '-f', str(heuristic), '-c', 'dcm2niix',
+                '-o', str(outdir)])
+    assert outdir.join('sub', 'fmap.nii.gz').check()
+    # the first file of each series for the heuristic, and then the files
+    # of the series it selected for conversion
+    assert requested[:2] == [
+        sorted(op.basename(f) for f in TEST_DICOMS),
+        [op.basename(f) for f in TEST_DICOMS if 'fmap' in f]]
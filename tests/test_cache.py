@@ -0,0 +1,276 @@
+import os
+import os.path as op
+import shutil
+import time
+
+from heudiconv.cache import HeaderCache, get_callable_digest
+from heudiconv.dicoms import group_dicoms_into_seqinfos
+
+from .test_dicoms import TEST_DICOMS
+
+SKIP_UIDS = ['1.2.3']
+
+
+def _filter(dcm_data):
+    return dcm_data.StudyInstanceUID in SKIP_UIDS
+
+
+SKIP_DESCRIPTIONS = ['localizer']
+
+
+def _filter_nested(dcm_data):
+    return any(word in SKIP_DESCRIPTIONS
+               for word in dcm_data.SeriesDescription.split())
+
+
+def test_get_callable_digest_nested():
+    global SKIP_DESCRIPTIONS
+    digest = get_callable_digest(_filter_nested)
+    old = SKIP_DESCRIPTIONS
+    try:
+        SKIP_DESCRIPTIONS = ['scout']
+        # referred to only from within the generator expression
+        assert get_callable_digest(_filter_nested) != digest
+    finally:
+        SKIP_DESCRIPTIONS = old
+
+
+def test_get_callable_digest():
+    global SKIP_UIDS
+    digest = get_callable_digest(_filter)
+    assert digest == get_callable_digest(_filter)
+    old = SKIP_UIDS
+    try:
+        SKIP_UIDS = ['1.2.4']
+        # module level values the function uses contribute to the digest
+        assert get_callable_digest(_filter) != digest
+    finally:
+        SKIP_UIDS = old
+    # no source code available
+    assert get_callable_digest(len) is None
+
+
+def test_header_cache(tmpdir):
+    cache = HeaderCache(str(tmpdir.join('cache.sqlite')))
+    f = tmpdir.join('file')
+    f.write('content')
+    key = cache.get_key(str(f))
+    assert key == (op.realpath(str(f)), 7, os.stat(str(f)).st_mtime)
+    assert cache.get(key) is None
+    cache.set(key, {'some': 'value'}, 'filter1', True)
+    cache.flush()
+    assert cache.get(key) == ({'some': 'value'}, False)
+    assert cache.get(key, 'filter1') == ({'some': 'value'}, True)
+    # unknown filter result -- not cached
+    assert cache.get(key, 'filter2') is None
+    cache.close()
+
+    # persists across sessions
+    cache = HeaderCache(str(tmpdir.join('cache.sqlite')))
+    assert cache.get(key) == ({'some': 'value'}, False)
+    # but gets invalidated when file changes
+    f.write('changed content')
+    assert cache.get(cache.get_key(str(f))) is None
+    cache.close()
+
+
+def test_header_cache_evict(tmpdir):
+    cache = HeaderCache(str(tmpdir.join('cache.sqlite')), max_size=2000)
+    keys = [('/file%d' % i, 1, 1.) for i in range(3)]
+    for key in keys:
+        cache.set(key, 'x' * 900)
+    cache.flush()
+    cache.get(keys[0])  # was used, so it is the most recently accessed
+    cache.evict()
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+
+    cache.max_age = -1
+    cache.evict()
+    assert all(cache.get(key) is None for key in keys)
+    cache.close()
+
+
+def test_group_dicoms_into_seqinfos_header_cache(tmpdir):
+    cache = HeaderCache(str(tmpdir.join('cache.sqlite')))
+    seqinfo = group_dicoms_into_seqinfos(
+        TEST_DICOMS, None, _filter, 'studyUID', header_cache=cache)
+    cached = group_dicoms_into_seqinfos(
+        TEST_DICOMS, None, _filter, 'studyUID', header_cache=cache)
+    assert repr(cached) == repr(seqinfo)
+    keys = [cache.get_key(f) for f in TEST_DICOMS]
+    assert all(cache.get(key, get_callable_digest(_filter))
+               for key in keys)
+    # results of another filter_dicom are not mixed up with cached ones
+    filtered = group_dicoms_into_seqinfos(
+        TEST_DICOMS, None, lambda dcm_data: True, 'studyUID',
+        header_cache=cache)
+    assert not filtered
+    cache.close()
+
+
+def test_files_state(tmpdir):
+    import shutil
+    from mock import patch
+    from heudiconv import dicoms
+    from heudiconv.cache import FilesState
+
+    indir = tmpdir.mkdir('in')
+    files = []
+    for f in TEST_DICOMS:
+        files.append(str(indir.join(op.basename(f))))
+        shutil.copy(f, files[-1])
+    files = sorted(files)
+    parsed = []
+    orig_read = dicoms._iter_read_dicom_file_infos
+
+    def read(files, *args, **kwargs):
+        parsed.extend(files)
+        return orig_read(files, *args, **kwargs)
+
+    def group(files, header_cache=None):
+        del parsed[:]
+        state = FilesState(str(tmpdir.join('state.pkl')), header_cache)
+        with patch.object(dicoms, '_iter_read_dicom_file_infos', read):
+            return repr(group_dicoms_into_seqinfos(
+                files, None, _filter, 'studyUID', header_cache=state))
+
+    expected = repr(group_dicoms_into_seqinfos(
+        files, None, _filter, 'studyUID'))
+    assert group(files[1:]) == repr(group_dicoms_into_seqinfos(
+        files[1:], None, _filter, 'studyUID'))
+    assert parsed == files[1:]
+    # only new files get parsed
+    assert group(files) == expected
+    assert parsed == files[:1]
+    assert group(files) == expected
+    assert parsed == []
+    # and changed ones
+    os.utime(files[-1], (0, 0))
+    assert group(files) == expected
+    assert parsed == files[-1:]
+    # files not requested any longer are not retained
+    group(files[:1])
+    assert group(files) == expected
+    assert parsed == files[1:]
+
+    # files not in the state are taken from the header cache if known
+    os.unlink(str(tmpdir.join('state.pkl')))
+    cache = HeaderCache(str(tmpdir.join('cache.sqlite')))
+    assert group(files[1:], cache) == repr(group_dicoms_into_seqinfos(
+        files[1:], None, _filter, 'studyUID'))
+    assert parsed == files[1:]
+    os.unlink(str(tmpdir.join('state.pkl')))
+    assert group(files, cache) == expected
+    assert parsed == files[:1]
+    cache.close()
+
+
+def test_files_state_evict(tmpdir):
+    from heudiconv.cache import FilesState
+    for name in ('stale.pkl', 'recent.pkl', 'other.txt'):
+        tmpdir.join(name).write('')
+    os.utime(str(tmpdir.join('stale.pkl')), (0, 0))
+    os.utime(str(tmpdir.join('other.txt')), (0, 0))
+    state = FilesState(str(tmpdir.join('state.pkl')))
+    group_dicoms_into_seqinfos(TEST_DICOMS, None, None, None,
+                               header_cache=state)
+    state.flush()
+    assert sorted(os.listdir(str(tmpdir))) \
+        == ['other.txt', 'recent.pkl', 'state.pkl']
+
+
+def test_files_state_headers(tmpdir):
+    from heudiconv.cache import FilesState
+    from heudiconv.external.pydicom import dcm
+
+    files = []
+    for f in TEST_DICOMS:
+        for i in range(3):
+            files.append(str(tmpdir.join('%d_%s' % (i, op.basename(f)))))
+            dcm_data = dcm.read_file(f)
+            dcm_data.SOPInstanceUID = dcm.uid.generate_uid()
+            dcm_data.save_as(files[-1])
+    files = sorted(files)
+    path = str(tmpdir.join('state.pkl'))
+    header_stores = []
+    for _ in range(2):
+        header_stores.append({})
+        state = FilesState(path)
+        group_dicoms_into_seqinfos(files, None, None, None,
+                                   header_cache=state,
+                                   header_store=header_stores[-1])
+    # headers of individual files do not prevent sharing the rest
+    assert len(state._infos) == 2
+    assert header_stores[1] == header_stores[0]
+    assert len(header_stores[0]) == 2
+    assert len(set(h['SOPInstanceUID'] for h in header_stores[0].values())) \
+        == 2
+
+
+def test_conversion_cache(tmpdir):
+    from heudiconv.cache import ConversionCache
+
+    cache = ConversionCache(str(tmpdir.join('cache')))
+    dicoms = [str(tmpdir.join('%d.dcm' % i)) for i in range(2)]
+    for orig, f in zip(TEST_DICOMS, dicoms):
+        shutil.copyfile(orig, f)
+    key = cache.get_key(dicoms, 'v1', True)
+    assert cache.get_key(dicoms[::-1], 'v1', True) == key
+    assert cache.get_key(dicoms, 'v2', True) != key
+    assert cache.get_key(dicoms[:1], 'v1', True) != key
+    # changed DICOMs are told apart by their modification time
+    os.utime(dicoms[0], (0, 0))
+    assert cache.get_key(dicoms, 'v1', True) != key
+    assert cache.get(key, str(tmpdir.join('out0'))) is None
+
+    converted = tmpdir.mkdir('converted')
+    res = {'converted_files': [str(converted.join('a.nii.gz'))],
+           'bids': [str(converted.join('a.json'))], 'bvecs': []}
+    for f in sum(res.values(), []):
+        with open(f, 'w') as fp:
+            fp.write(op.basename(f))
+    cache.set(key, res)
+    out = cache.get(key, str(tmpdir.join('out1')))
+    assert out == dict((field, [str(tmpdir.join('out1', op.basename(f)))
+                                for f in files])
+                       for field, files in res.items())
+    for orig, cached in zip(res['converted_files'] + res['bids'],
+                            out['converted_files'] + out['bids']):
+        assert open(cached).read() == open(orig).read()
+        # outputs do not share inodes with the cache, so modifying them
+        # (e.g. post-processing sidecars) does not affect it
+        assert not os.path.samefile(cached, orig)
+    # existing entries are retained
+    with open(res['bids'][0], 'w') as fp:
+        fp.write('modified')
+    cache.set(key, res)
+    assert open(cache.get(key, str(tmpdir.join('out2')))['bids'][0]).read() \
+        == 'a.json'
+
+
+def test_conversion_cache_evict(tmpdir):
+    from heudiconv.cache import ConversionCache
+    cache = ConversionCache(str(tmpdir.join('cache')), max_size=2000)
+    converted = tmpdir.mkdir('converted').join('a.nii.gz')
+    converted.write('x' * 900)
+    keys = ['%032d' % i for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, {'converted_files': [str(converted)]})
+        os.utime(op.join(cache._get_entry_dir(key), cache.INDEX),
+                 (time.time() - 300 + i, time.time() - 300 + i))
+    # was used, so it is the most recently accessed
+    assert cache.get(keys[0], str(tmpdir.join('out0')))
+    # entries being stored are left alone
+    tmpdir.join('cache', '00', keys[1] + '.tmp1').ensure(dir=True)
+    cache.evict()
+    assert cache.get(keys[0], str(tmpdir.join('out1')))
+    assert cache.get(keys[1], str(tmpdir.join('out2'))) is None
+    assert cache.get(keys[2], str(tmpdir.join('out3')))
+    assert tmpdir.join('cache', '00', keys[1] + '.tmp1').exists()
+
+    cache.max_age = -1
+    cache.evict()
+    assert all(cache.get(key, str(tmpdir.join('out4'))) is None
+               for key in keys)
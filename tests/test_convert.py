@@ -0,0 +1,362 @@
+import os
+import os.path as op
+import shutil
+import tarfile
+import tempfile
+from glob import glob
+
+import pytest
+from mock import patch
+
+from heudiconv import archives, convert
+from heudiconv.cli.run import main as runner
+from heudiconv.dicoms import group_dicoms_into_seqinfos
+from heudiconv.convert import (
+    _get_convert_tasks,
+    convert_dicom,
+    dcm2niix_convert,
+    dcm2niix_convert_series,
+    get_nipype_outputs,
+    nipype_convert,
+)
+
+from .test_dicoms import TEST_DICOMS
+from .utils import TESTS_DATA_PATH
+
+
+def test_get_convert_tasks():
+    items = [('/out/sub-1/anat/sub-1_T1w', 'nii.gz', []),
+             ('/out/sub-1/fmap/sub-1_magnitude1', 'nii.gz', []),
+             ('/out/sub-1/func/sub-1_task-rest_bold', 'nii.gz', []),
+             ('/out/sub-1/fmap/sub-1_phasediff', 'nii.gz', []),
+             ('/out/sub-2/fmap/sub-2_phasediff', 'nii.gz', [])]
+    assert _get_convert_tasks(items, True) == [[0], [1, 3], [2], [4]]
+    # field maps are not special without BIDS
+    assert _get_convert_tasks(items, False) == [[0], [1], [2], [3], [4]]
+
+
+@pytest.mark.parametrize('bids', [True, False])
+def test_dcm2niix_convert(tmpdir, bids):
+    fmap = [f for f in TEST_DICOMS if 'fmap' in f]
+    prefix = str(tmpdir.join('out', 'fmap'))
+    res = dcm2niix_convert(fmap, prefix, bids, str(tmpdir.mkdir('direct')))
+    expected = get_nipype_outputs(nipype_convert(
+        fmap, prefix, False, bids, str(tmpdir.mkdir('nipype')))[0])
+    assert res['converted_files']
+    assert all(op.exists(f) for f in sum(res.values(), []))
+    assert bool(res['bids']) == bids
+
+    def basenames(outputs):
+        return dict((k, [op.basename(f) for f in v])
+                    for k, v in outputs.items())
+    assert basenames(res) == basenames(expected)
+    for direct, nipype in zip(res['bids'], expected['bids']):
+        with open(direct) as fd, open(nipype) as fn:
+            assert fd.read() == fn.read()
+
+
+def test_dcm2niix_convert_series(tmpdir):
+    seqinfo = group_dicoms_into_seqinfos(TEST_DICOMS, None, None, None)
+    series = dict((si.series_uid, files) for si, files in seqinfo.items())
+    assert len(series) == 2
+    res = dcm2niix_convert_series(series, True, str(tmpdir.mkdir('all')))
+    assert sorted(res) == sorted(series)
+    for i, (uid, files) in enumerate(series.items()):
+        expected = dcm2niix_convert(files, str(tmpdir.join('out', 'x')), True,
+                                    str(tmpdir.mkdir(str(i))))
+        assert dict((k, len(v)) for k, v in res[uid].items()) \
+            == dict((k, len(v)) for k, v in expected.items())
+        for converted, single in zip(res[uid]['bids'], expected['bids']):
+            with open(converted) as fc, open(single) as fs:
+                assert fc.read() == fs.read()
+
+    # outputs of unknown series cannot be demultiplexed
+    series.pop(uid)
+    series['1.2.3'] = files
+    assert dcm2niix_convert_series(series, True,
+                                   str(tmpdir.mkdir('unknown'))) is None
+
+
+HEURISTIC = '''
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    return template, outtype, annotation_classes
+
+
+def infotodict(seqinfo):
+    scout = create_key('sub-{subject}/anat/sub-{subject}_acq-scout_T1w')
+    fmap = create_key('sub-{subject}/fmap/sub-{subject}_magnitude')
+    info = {scout: [], fmap: []}
+    for s in seqinfo:
+        info[fmap if 'fmap' in s.protocol_name else scout].append(s.series_id)
+    return info
+
+
+def custom_callable(prefix, outtypes, item_dicoms):
+    with open(%r, 'a') as f:
+        f.write(prefix + '\\n')
+'''
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_convert_jobs(tmpdir, jobs):
+    called = tmpdir.join('called')
+    # heuristics get imported by the name of the file
+    heuristic = tmpdir.join('convert_jobs%d.py' % jobs)
+    heuristic.write(HEURISTIC % str(called))
+    outdir = tmpdir.join('out')
+    runner(['-d', op.join(op.dirname(TESTS_DATA_PATH), '{subject}', '*', '*'),
+            '-s', op.basename(TESTS_DATA_PATH), '-f', str(heuristic),
+            '-c', 'dcm2niix', '-b', '-o', str(outdir), '-j', str(jobs)])
+    subdir = outdir.join('sub-data')
+    niftis = glob(str(subdir.join('*', '*.nii.gz')))
+    assert len(niftis) >= 2
+    assert subdir.join('anat', 'sub-data_acq-scout_T1w.json').check()
+    # all files got recorded in a single *_scans.tsv
+    with open(str(subdir.join('sub-data_scans.tsv'))) as f:
+        assert len(f.readlines()) == 1 + len(niftis)
+    assert sorted(called.read().splitlines()) == sorted([
+        str(subdir.join('anat', 'sub-data_acq-scout_T1w')),
+        str(subdir.join('fmap', 'sub-data_magnitude'))])
+
+
+def test_convert_single_dcm2niix_run(tmpdir):
+    heuristic = tmpdir.join('single_dcm2niix_run.py')
+    heuristic.write(HEURISTIC % str(tmpdir.join('called')))
+    outdirs = []
+    for single in True, False:
+        outdirs.append(tmpdir.join('out%d' % single))
+        with patch.object(convert, '_run_dcm2niix',
+                          wraps=convert._run_dcm2niix) as run, \
+                patch.object(convert, 'dcm2niix_convert_series',
+                             wraps=convert.dcm2niix_convert_series
+                             if single else lambda *args: None):
+            runner(['-d', op.join(op.dirname(TESTS_DATA_PATH), '{subject}',
+                                  '*', '*'),
+                    '-s', op.basename(TESTS_DATA_PATH), '-f', str(heuristic),
+                    '-c', 'dcm2niix', '-b', '-o', str(outdirs[-1])])
+        # falls back to converting series one by one
+        assert run.call_count == (1 if single else 2)
+    assert _list_files(outdirs[0]) == _list_files(outdirs[1])
+    for f in _list_files(outdirs[0]):
+        if f.endswith('.json'):
+            assert outdirs[0].join(f).read() == outdirs[1].join(f).read()
+
+
+@pytest.mark.parametrize('single', [True, False])
+def test_convert_conversion_cache(tmpdir, single):
+    heuristic = tmpdir.join('conversion_cache%d.py' % single)
+    heuristic.write(HEURISTIC % str(tmpdir.join('called')))
+    outdir = tmpdir.join('out')
+    outputs = []
+    for _ in range(2):
+        with patch.object(convert, '_run_dcm2niix',
+                          wraps=convert._run_dcm2niix) as run, \
+                patch.object(convert, 'dcm2niix_convert_series',
+                             wraps=convert.dcm2niix_convert_series
+                             if single else lambda *args: None):
+            runner(['-d', op.join(op.dirname(TESTS_DATA_PATH), '{subject}',
+                                  '*', '*'),
+                    '-s', op.basename(TESTS_DATA_PATH), '-f', str(heuristic),
+                    '-c', 'dcm2niix', '-b', '-o', str(outdir), '--overwrite',
+                    '--conversion-cache', str(tmpdir.join('cache'))])
+        outputs.append(dict((f, outdir.join(f).read_binary())
+                            for f in _list_files(outdir)
+                            if not f.startswith('.heudiconv')))
+        # converted by dcm2niix only the first time
+        if not _:
+            assert run.call_count == (1 if single else 2)
+    assert run.call_count == 0
+    assert outputs[1] == outputs[0]
+
+
+DICOM_HEURISTIC = '''
+def infotodict(seqinfo):
+    return {('{subject}_{item}', ('dicom',), None):
+            [s.series_id for s in seqinfo]}
+'''
+
+
+@pytest.mark.parametrize('mode', ['copy', 'hardlink', 'symlink', 'reflink'])
+def test_dicom_output(tmpdir, mode):
+    heuristic = tmpdir.join('dicom_output_%s.py' % mode)
+    heuristic.write(DICOM_HEURISTIC)
+    indir = tmpdir.join('in', 'sub')
+    shutil.copytree(TESTS_DATA_PATH, str(indir))
+    outdir = tmpdir.join('out')
+    runner(['-d', str(tmpdir.join('in', '{subject}', '*', '*')), '-s', 'sub',
+            '-f', str(heuristic), '-c', 'dcm2niix', '-o', str(outdir),
+            '--dicom-output', mode])
+    outputs = glob(str(outdir.join('sub', 'sub_*_dicom', '*')))
+    assert sorted(map(op.basename, outputs)) \
+        == sorted(op.basename(f) for f in TEST_DICOMS)
+    for f in outputs:
+        orig = str(indir.join(op.relpath(
+            [d for d in TEST_DICOMS if op.basename(d) == op.basename(f)][0],
+            TESTS_DATA_PATH)))
+        with open(orig, 'rb') as fo, open(f, 'rb') as fd:
+            assert fd.read() == fo.read()
+        assert op.islink(f) == (mode == 'symlink')
+        assert (os.stat(f).st_ino == os.stat(orig).st_ino) \
+            == (mode in ('hardlink', 'symlink'))
+
+
+@pytest.mark.parametrize('symlink', [True, False])
+def test_convert_dicom_bool(tmpdir, symlink):
+    prefix = str(tmpdir.join('out', 'sub_1'))
+    os.makedirs(op.dirname(prefix))
+    convert_dicom(TEST_DICOMS, False, prefix, str(tmpdir.join('out')), None,
+                  symlink, False)
+    outputs = glob(prefix + '_dicom/*')
+    assert len(outputs) == len(TEST_DICOMS)
+    assert all(op.islink(f) == symlink for f in outputs)
+
+
+def test_dicom_output_tarball(tmpdir):
+    heuristic = tmpdir.join('dicom_output_tarball.py')
+    heuristic.write(DICOM_HEURISTIC)
+    with tarfile.open(str(tmpdir.join('sub.tgz')), 'w:gz') as tf:
+        tf.add(TESTS_DATA_PATH, arcname='data')
+    outdir = tmpdir.join('out')
+    runner(['-d', str(tmpdir.join('{subject}.tgz')), '-s', 'sub',
+            '-f', str(heuristic), '-c', 'dcm2niix', '-o', str(outdir),
+            '--dicom-output', 'symlink'])
+    outputs = glob(str(outdir.join('sub', 'sub_*_dicom', '*')))
+    assert len(outputs) == len(TEST_DICOMS)
+    # extracted files got removed, so they are hard linked instead
+    assert not any(map(op.islink, outputs))
+
+
+def test_convert_tarball_rerun(tmpdir):
+    heuristic = tmpdir.join('convert_tarball_rerun.py')
+    heuristic.write(HEURISTIC % str(tmpdir.join('called')))
+    with tarfile.open(str(tmpdir.join('sub.tgz')), 'w:gz') as tf:
+        tf.add(TESTS_DATA_PATH, arcname='data')
+    outdir = tmpdir.join('out')
+    subdir = outdir.join('sub-sub')
+    for _ in range(2):
+        # the conversion table of the first run gets reused, while files
+        # got registered under another temporary directory
+        runner(['-d', str(tmpdir.join('{subject}.tgz')), '-s', 'sub',
+                '-f', str(heuristic), '-c', 'dcm2niix', '-b',
+                '-o', str(outdir), '--overwrite'])
+        niftis = sorted(glob(str(subdir.join('*', '*.nii.gz'))))
+        assert len(niftis) >= 2
+        for d in 'anat', 'fmap':
+            shutil.rmtree(str(subdir.join(d)))
+        # as if run by another process
+        archives._members.clear()
+
+
+def test_process_sessions_jobs(tmpdir):
+    subjects = ['sub%d' % i for i in range(3)]
+    for subject in subjects:
+        shutil.copytree(TESTS_DATA_PATH, str(tmpdir.join('in', subject)))
+    heuristic = tmpdir.join('process_sessions_jobs.py')
+    heuristic.write(HEURISTIC % str(tmpdir.join('called')))
+    outdirs = []
+    for jobs in 1, 3:
+        outdirs.append(tmpdir.join('out%d' % jobs))
+        runner(['-d', str(tmpdir.join('in', '{subject}', '*', '*')),
+                '-s'] + subjects + ['-f', str(heuristic), '-c', 'dcm2niix',
+                '-b', '-o', str(outdirs[-1]), '-j', str(jobs)])
+    # sessions might complete in any order
+    participants = [sorted(outdir.join('participants.tsv').readlines())
+                    for outdir in outdirs]
+    assert participants[0] == participants[1]
+    assert [l.split('\t')[0] for l in participants[0]] \
+        == ['participant_id'] + ['sub-%s' % s for s in subjects]
+    # only concurrent sessions lock the study
+    assert not outdirs[0].join('.heudiconv', '.lock').exists()
+    outdirs[1].join('.heudiconv', '.lock').remove()
+    assert _list_files(outdirs[0]) == _list_files(outdirs[1])
+    for f in _list_files(outdirs[0]):
+        if f.endswith(('.json', '.tsv')) and f != 'participants.tsv':
+            assert outdirs[0].join(f).read() == outdirs[1].join(f).read()
+
+
+def _list_files(topdir):
+    return sorted(op.relpath(op.join(root, f), str(topdir))
+                  for root, _, files in os.walk(str(topdir)) for f in files)
+
+
+def test_process_sessions_jobs_tarballs(tmpdir):
+    # sessions of both tarballs get registered under the same temporary
+    # directory, so one should not remove files the other one needs
+    for i in range(2):
+        with tarfile.open(str(tmpdir.join('sub-%d.tgz' % i)), 'w:gz') as tf:
+            tf.add(TESTS_DATA_PATH, arcname='data')
+    called = tmpdir.join('called')
+    heuristic = tmpdir.join('process_sessions_jobs_tarballs.py')
+    heuristic.write(
+        HEURISTIC.replace('sub-{subject}/', 'sub-{subject}/{session}/')
+        .replace('_acq', '_{session}_acq')
+        .replace('_magnitude', '_{session}_magnitude') % str(called))
+    outdir = tmpdir.join('out')
+    temp_dirs = set(glob(op.join(tempfile.gettempdir(), 'heudiconvDCM*')))
+    runner(['-d', str(tmpdir.join('{subject}-*.tgz')), '-s', 'sub',
+            '-f', str(heuristic), '-c', 'dcm2niix', '-b', '-o', str(outdir),
+            '-j', '2'])
+    assert len(called.read().splitlines()) == 4
+    assert len(glob(str(outdir.join('sub-sub', 'ses-*', '*', '*.nii.gz')))) \
+        >= 4
+    # removed once all sessions got converted
+    assert set(glob(op.join(tempfile.gettempdir(), 'heudiconvDCM*'))) \
+        <= temp_dirs
+
+
+def test_convert_with_prov(tmpdir, monkeypatch):
+    heuristic = tmpdir.join('convert_with_prov.py')
+    heuristic.write(HEURISTIC % str(tmpdir.join('called')))
+    outdir = tmpdir.join('out')
+    cwd = tmpdir.mkdir('cwd')
+    monkeypatch.chdir(str(cwd))
+    runner(['-d', op.join(op.dirname(TESTS_DATA_PATH), '{subject}', '*', '*'),
+            '-s', op.basename(TESTS_DATA_PATH), '-f', str(heuristic),
+            '-c', 'dcm2niix', '-b', '-o', str(outdir), '--with-prov'])
+    assert len(glob(str(outdir.join('sub-data', '*', '*_prov.ttl')))) == 2
+    # nipype did not write provenance wherever heudiconv was started
+    assert not cwd.listdir()
+
+
+EXAMPLES_HEURISTIC = '''
+import glob
+import os.path as op
+
+
+def infotodict(seqinfo):
+    with open(%r, 'w') as f:
+        for s in seqinfo:
+            f.write('%%d\\n' %% len(glob.glob(op.join(
+                %r, 'heudiconvDCM*', 'data', s.dcm_dir_name,
+                s.example_dcm_file))))
+    return {}
+'''
+
+
+def test_example_dcm_files_extracted(tmpdir, monkeypatch):
+    # so files of other runs are not found
+    tmp = str(tmpdir.mkdir('tmp'))
+    monkeypatch.setattr(tempfile, 'tempdir', tmp)
+    heuristic = tmpdir.join('example_dcm_files_extracted.py')
+    heuristic.write(EXAMPLES_HEURISTIC % (str(tmpdir.join('found')), tmp))
+    with tarfile.open(str(tmpdir.join('sub.tgz')), 'w:gz') as tf:
+        tf.add(TESTS_DATA_PATH, arcname='data')
+    runner(['-d', str(tmpdir.join('{subject}.tgz')), '-s', 'sub',
+            '-f', str(heuristic), '-c', 'none', '-o', str(tmpdir.join('out'))])
+    # example files of all series were on disk for the heuristic
+    assert tmpdir.join('found').read().split() == ['1', '1']
+
+
+def test_command_removes_temp_dirs(tmpdir, monkeypatch):
+    tmp = str(tmpdir.mkdir('tmp'))
+    monkeypatch.setattr(tempfile, 'tempdir', tmp)
+    with tarfile.open(str(tmpdir.join('sub.tgz')), 'w:gz') as tf:
+        tf.add(TESTS_DATA_PATH, arcname='data')
+    heuristic = tmpdir.join('command_removes_temp_dirs.py')
+    heuristic.write(
+        "from heudiconv.heuristics.convertall import infotodict\n"
+        "def infotoids(seqinfos, outdir):\n"
+        "    return {'subject': 'sub', 'session': None, 'locator': None}\n")
+    runner(['--command', 'ls', '-f', str(heuristic), '-o', str(tmpdir),
+            '--files', str(tmpdir.join('sub.tgz'))])
+    assert os.listdir(tmp) == []
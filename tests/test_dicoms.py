@@ -0,0 +1,362 @@
+import operator
+import os
+import os.path as op
+import time
+
+import pytest
+from glob import glob
+from mock import patch
+
+from heudiconv import dicoms
+from heudiconv.bids import get_formatted_scans_key_row
+from heudiconv.external.pydicom import dcm
+from heudiconv.dicoms import (
+    DicomFileInfo,
+    embed_metadata_from_dicoms,
+    get_dicom_series_time,
+    get_header_fields,
+    get_image_shape,
+    get_series_signature_key,
+    get_seqinfo_fields,
+    group_dicoms_into_seqinfos,
+    is_dicom_file,
+    is_same_series,
+    iter_seqinfos,
+    read_dicomdir_series,
+    read_dicom_header,
+    read_dicom_header_of_image,
+    stack_dicom_headers,
+)
+from heudiconv.utils import TempDirs, load_json
+
+from .utils import TESTS_DATA_PATH
+
+TEST_DICOMS = sorted(glob(op.join(TESTS_DATA_PATH, '*', '*.dcm')))
+
+
+def test_read_dicom_header():
+    for filename in TEST_DICOMS:
+        dcm_data = read_dicom_header(filename)
+        assert 'PixelData' not in dcm_data
+        assert dcm_data.Rows and dcm_data.Columns
+
+
+def test_get_image_shape():
+    from heudiconv.external.dcmstack import ds
+    dcm_data = read_dicom_header(TEST_DICOMS[0])
+    assert get_image_shape(ds.wrapper_from_data(dcm_data)) == (160, 160)
+    dcm_data.NumberOfFrames = 3
+    assert get_image_shape(ds.wrapper_from_data(dcm_data)) == (160, 160, 3)
+    del dcm_data.Rows
+    assert get_image_shape(ds.wrapper_from_data(dcm_data)) is None
+
+
+def test_get_seqinfo_fields():
+    fields = get_seqinfo_fields(read_dicom_header(TEST_DICOMS[1]))
+    assert fields['ProtocolName'] == 'fmap_acq-3mm'
+    assert fields['ImageType'] == ['ORIGINAL', 'PRIMARY', 'P', 'ND']
+    assert fields['SequenceName'] == '*fm2d2r'
+    # only the number of items of sequences is retained
+    assert fields['NumberOfReferencedImages'] == 1
+    assert 'ReferencedImageSequence' not in fields
+    assert not any(isinstance(v, (dcm.dataset.Dataset, dcm.sequence.Sequence,
+                                  dcm.multival.MultiValue))
+                   for v in fields.values())
+
+
+def test_group_dicoms_into_seqinfos_header_only():
+    seqinfo = group_dicoms_into_seqinfos(
+        TEST_DICOMS, file_filter=None, dcmfilter=None,
+        grouping='accession_number')
+    assert list(seqinfo) == ['phantom-1']
+    seqinfo = seqinfo['phantom-1']
+    assert [(s.series_id, s.dim1, s.dim2, s.dim3, s.dim4) for s in seqinfo] \
+        == [('1-anat-scout_ses-localizer', 160, 160, 1, 1),
+            ('6-fmap_acq-3mm', 64, 64, 1, 1)]
+    assert list(seqinfo.values()) == [[f] for f in TEST_DICOMS]
+
+
+def test_get_series_signature_key():
+    eq = operator.eq
+    close = lambda x, y: x is None and y is None or abs(x - y) < 0.1
+    sig = {'SeriesNumber': ('1', eq),
+           'ImageType': (['ORIGINAL', 'PRIMARY'], eq),
+           'vox': (1.0, close),
+           'EchoNumbers': (None, eq)}
+    key = get_series_signature_key(sig)
+    assert key == (('ImageType', ('ORIGINAL', 'PRIMARY')),
+                   ('SeriesNumber', '1'))
+    # tolerance based fields and None values do not contribute
+    sig2 = dict(sig, vox=(1.05, close))
+    del sig2['EchoNumbers']
+    assert get_series_signature_key(sig2) == key
+    assert get_series_signature_key(dict(sig, SeriesNumber=('2', eq))) != key
+    # unhashable values lead to no key at all
+    assert get_series_signature_key(dict(sig, bad=({}, eq))) is None
+
+
+def test_is_same_series():
+    eq = operator.eq
+    close = lambda x, y: x is None and y is None or abs(x - y) < 0.1
+    sig = {'SeriesNumber': ('1', eq), 'vox': (1.0, close)}
+    assert is_same_series(sig, sig)
+    assert is_same_series(sig, dict(sig, vox=(1.05, close)))
+    assert not is_same_series(sig, dict(sig, vox=(1.5, close)))
+    assert not is_same_series(sig, dict(sig, SeriesNumber=('2', eq)))
+    # missing fields compare as None
+    assert is_same_series(sig, dict(sig, EchoNumbers=(None, eq)))
+    assert not is_same_series(sig, dict(sig, EchoNumbers=('1', eq)))
+
+
+@pytest.mark.parametrize('grouping', ['studyUID', 'accession_number', None])
+def test_group_dicoms_into_seqinfos_jobs(grouping):
+    # have more files than processes, with the same series in different chunks
+    files = TEST_DICOMS * 3
+    # lambda is not picklable but must still work in the worker processes
+    dcmfilter = lambda dcm_data: dcm_data.SeriesNumber == 6
+    serial = group_dicoms_into_seqinfos(files, None, dcmfilter, grouping)
+    parallel = group_dicoms_into_seqinfos(files, None, dcmfilter, grouping,
+                                          jobs=2)
+    assert parallel == serial
+    assert repr(parallel) == repr(serial)
+
+
+def test_group_dicoms_into_seqinfos_jobs_no_fork():
+    files = TEST_DICOMS * 3
+    serial = group_dicoms_into_seqinfos(files, None, None, None)
+    # without fork (e.g. on Windows) files get parsed serially
+    with patch.object(dicoms, 'get_fork_context', return_value=None):
+        assert group_dicoms_into_seqinfos(files, None, None, None,
+                                          jobs=2) == serial
+
+
+def _make_dicom_file_infos(nseries, nfiles_per_series):
+    """Synthetic DicomFileInfo records for interleaved files of many series"""
+    infos = []
+    for iseries in range(nseries):
+        fields = {'SeriesNumber': iseries + 1,
+                  'ProtocolName': 'proto%d' % iseries,
+                  'SeriesDescription': 'desc%d' % iseries,
+                  'StudyInstanceUID': '1.2.3'}
+        infos.append(DicomFileInfo(
+            (iseries + 1, fields['ProtocolName']), '1.2.3',
+            {'SeriesNumber': (iseries + 1, operator.eq)},
+            (64, 64), fields, None))
+    return [infos[i % nseries] for i in range(nseries * nfiles_per_series)]
+
+
+def test_group_dicoms_into_seqinfos_many_files(monkeypatch):
+    # regression benchmark: files must be bucketed into series in a single
+    # pass, not by rescanning all 100k files for each of 1000 series
+    nseries, nfiles_per_series = 1000, 100
+    infos = _make_dicom_file_infos(nseries, nfiles_per_series)
+    files = ['/data/%d/%06d.dcm' % (i % nseries, i) for i in range(len(infos))]
+    monkeypatch.setattr(
+        'heudiconv.dicoms.iter_dicom_file_infos',
+        lambda files, *args, **kwargs: iter(infos))
+    t0 = time.time()
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, None)
+    duration = time.time() - t0
+    assert len(seqinfo) == nseries
+    for iseries, (info, series_files) in enumerate(seqinfo.items()):
+        assert info.series_id == '%d-proto%d' % (iseries + 1, iseries)
+        assert info.dim3 == nfiles_per_series
+        assert series_files == files[iseries::nseries]
+    assert duration < 30
+
+
+@pytest.mark.parametrize('grouping', ['studyUID', 'accession_number', None])
+def test_iter_seqinfos(grouping):
+    seqinfo = group_dicoms_into_seqinfos(TEST_DICOMS, None, None, grouping)
+    if grouping:
+        expected = [(group, info, files)
+                    for group, infos in seqinfo.items()
+                    for info, files in infos.items()]
+    else:
+        expected = [(None, info, files) for info, files in seqinfo.items()]
+    assert list(iter_seqinfos(TEST_DICOMS, None, None, grouping)) == expected
+
+
+def test_iter_seqinfos_streams(monkeypatch):
+    nseries, nfiles_per_series = 3, 4
+    infos = sorted(_make_dicom_file_infos(nseries, nfiles_per_series),
+                   key=lambda info: info.series_id)
+    files = ['/data/%d/%d.dcm' % (i // nfiles_per_series, i)
+             for i in range(len(infos))]
+    parsed = []
+
+    def iter_dicom_file_infos(files, *args, **kwargs):
+        for f, info in zip(files, infos):
+            parsed.append(f)
+            yield info
+
+    monkeypatch.setattr('heudiconv.dicoms.iter_dicom_file_infos',
+                        iter_dicom_file_infos)
+    total = 0
+    for iseries, (group, info, series_files) in enumerate(
+            iter_seqinfos(files, None, None, None)):
+        assert group is None
+        assert info.series_id == '%d-proto%d' % (iseries + 1, iseries)
+        assert series_files == files[iseries * nfiles_per_series:
+                                     (iseries + 1) * nfiles_per_series]
+        total += len(series_files)
+        assert info.total_files_till_now == total
+        # series is generated as soon as the next directory is reached
+        assert len(parsed) == min(total + 1, len(files))
+    assert iseries == nseries - 1
+
+
+def _make_dicomdir(outdir, ninstances):
+    """Export copies of TEST_DICOMS along with a DICOMDIR into outdir"""
+    fileset = pytest.importorskip('pydicom.fileset')
+    fs = fileset.FileSet()
+    for filename in TEST_DICOMS:
+        for i in range(ninstances):
+            dcm_data = dcm.read_file(filename)
+            uid = dcm.uid.generate_uid()
+            dcm_data.SOPInstanceUID = uid
+            dcm_data.file_meta.MediaStorageSOPInstanceUID = uid
+            fs.add(dcm_data)
+    fs.write(outdir)
+    return sorted(
+        op.join(dirpath, f)
+        for dirpath, _, filenames in os.walk(outdir) for f in filenames)
+
+
+def test_read_dicomdir_series(tmpdir):
+    _make_dicomdir(str(tmpdir), 3)
+    series = read_dicomdir_series(str(tmpdir.join('DICOMDIR')))
+    assert list(series) == [dcm.read_file(f).SeriesInstanceUID
+                            for f in TEST_DICOMS]
+    for series_files in series.values():
+        assert len(series_files) == 3
+        assert len(set(map(op.dirname, series_files))) == 1
+        assert all(op.exists(f) for f in series_files)
+
+
+def test_group_dicoms_into_seqinfos_dicomdir(tmpdir, monkeypatch):
+    files = _make_dicomdir(str(tmpdir), 3)
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, 'studyUID')
+    read = []
+
+    def read_dicom_header(filename):
+        read.append(filename)
+        return dcm.read_file(filename, stop_before_pixels=True, force=True)
+    monkeypatch.setattr('heudiconv.dicoms.read_dicom_header',
+                        read_dicom_header)
+    assert group_dicoms_into_seqinfos(
+        files, None, None, 'studyUID', use_dicomdir=True) == seqinfo
+    # only a single file per series was read
+    assert len(read) == 2
+    assert [s.dim3 for s in list(seqinfo.values())[0]] == [3, 3]
+
+
+def test_group_dicoms_into_seqinfos_header_store(tmpdir, monkeypatch):
+    files = _make_dicomdir(str(tmpdir), 3)
+    # so the first file of each series is not the smallest one
+    files = files[::-1]
+    header_store = {}
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, None,
+                                         header_store=header_store)
+    series_files = list(seqinfo.values())
+    assert sorted(header_store) == sorted(
+        [f[0] for f in series_files] + [min(f) for f in series_files])
+    rows = {}
+    for filename, fields in header_store.items():
+        assert fields == get_header_fields(dcm.read_file(filename))
+        assert 'SOPInstanceUID' in fields
+        rows[filename] = (get_formatted_scans_key_row(filename),
+                          get_dicom_series_time([filename]))
+
+    # DICOMs in the store do not get read again
+    def read_file(*args, **kwargs):
+        raise AssertionError("should not be read")
+    monkeypatch.setattr(dcm, 'read_file', read_file)
+    for filename, row in rows.items():
+        assert (get_formatted_scans_key_row(filename, header_store),
+                get_dicom_series_time([filename], header_store)) == row
+    monkeypatch.undo()
+
+    # headers of the files represented by others are not known
+    header_store = {}
+    group_dicoms_into_seqinfos(files, None, None, None, use_dicomdir=True,
+                               header_store=header_store)
+    dicomdir = [f for f in files if op.basename(f) == 'DICOMDIR'][0]
+    assert sorted(header_store) == sorted(
+        f[0] for f in read_dicomdir_series(dicomdir).values())
+
+
+def test_is_dicom_file(tmpdir):
+    assert all(is_dicom_file(f) for f in TEST_DICOMS)
+    readme = tmpdir.join('README')
+    readme.write('Some text which is long enough\n' * 10)
+    assert not is_dicom_file(str(readme))
+    assert not is_dicom_file(str(readme), allow_no_preamble=True)
+    assert not is_dicom_file(str(tmpdir.join('missing')))
+    # DICOM without the preamble and DICM prefix
+    no_preamble = tmpdir.join('no_preamble')
+    with open(TEST_DICOMS[0], 'rb') as f:
+        f.seek(132)
+        no_preamble.write_binary(f.read())
+    assert not is_dicom_file(str(no_preamble))
+    assert is_dicom_file(str(no_preamble), allow_no_preamble=True)
+
+    files = TEST_DICOMS + [str(readme), str(no_preamble)]
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, None)
+    assert [f for files_ in seqinfo.values() for f in files_] == TEST_DICOMS
+    seqinfo = group_dicoms_into_seqinfos(files, None, None, None,
+                                         allow_no_preamble=True)
+    assert [f for files_ in seqinfo.values() for f in files_] \
+        == [TEST_DICOMS[0], str(no_preamble), TEST_DICOMS[1]]
+
+
+def test_embed_metadata_from_dicoms_min_meta(tmpdir):
+    prefix = str(tmpdir.join('sub-1_task-rest_bold'))
+    tmpdir.join('sub-1_task-rest_bold.json').write('{"EchoTime": 0.03}')
+    # no nipype Node is involved without provenance
+    with patch.object(dicoms, '_run_embed_nifti_node',
+                      side_effect=AssertionError):
+        embed_metadata_from_dicoms(True, TEST_DICOMS[:1], prefix + '.nii.gz',
+                                   prefix + '.json', None,
+                                   prefix + '_info.json', TempDirs(),
+                                   False, True)
+    assert load_json(prefix + '_info.json') \
+        == {'EchoTime': 0.03, 'TaskName': 'rest'}
+    assert not os.stat(prefix + '_info.json').st_mode & 0o222
+
+
+def test_read_dicom_header_of_image(tmpdir):
+    dcm_data, is_image = read_dicom_header_of_image(TEST_DICOMS[0])
+    assert is_image
+    assert 'PixelData' not in dcm_data
+    assert dcm_data.SeriesNumber == read_dicom_header(TEST_DICOMS[0]).SeriesNumber
+    # DICOM without pixel data
+    dcm_data.save_as(str(tmpdir.join('header.dcm')))
+    assert not read_dicom_header_of_image(str(tmpdir.join('header.dcm')))[1]
+
+
+@pytest.mark.parametrize('voxel_order', ['LAS', 'PIL', ''])
+def test_stack_dicom_headers(voxel_order):
+    from heudiconv.external.dcmstack import ds
+    files = [f for f in TEST_DICOMS if 'fmap' in f]
+    stacks = stack_dicom_headers(TEST_DICOMS)
+    assert list(stacks) == list(ds.parse_and_stack(TEST_DICOMS))
+    stack, = stack_dicom_headers(files).values()
+    expected, = ds.parse_and_stack(files).values()
+    assert stack.shape == expected.shape
+    meta = ds.NiftiWrapper(stack.to_nifti(voxel_order, embed_meta=True)) \
+        .meta_ext.to_json()
+    assert meta == ds.NiftiWrapper(
+        expected.to_nifti(voxel_order, embed_meta=True)).meta_ext.to_json()
+
+
+def test_header_dataset():
+    from nibabel.nicom.dicomwrappers import wrapper_from_data
+    from heudiconv.external.dcmstack import HeaderDataset
+    dcm_data, _ = read_dicom_header_of_image(TEST_DICOMS[0])
+    header = HeaderDataset(dcm_data)
+    assert header.SeriesNumber == dcm_data.SeriesNumber
+    data = wrapper_from_data(header).get_data()
+    expected = wrapper_from_data(dcm.read_file(TEST_DICOMS[0])).get_data()
+    assert data.shape == expected.shape
+    assert not data.any()
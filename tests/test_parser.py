@@ -0,0 +1,87 @@
+import os
+import os.path as op
+
+from mock import patch
+
+from heudiconv import parser
+from heudiconv.parser import find_files
+
+
+def _make_tree(topdir):
+    for path in ['a/1.dcm', 'a/b/2.dcm', 'a/b/c/3.txt', '4.dcm',
+                 '.git/objects/5', '.gitattributes', 'a/.datalad/6.dcm',
+                 'a/.heudiconv/7.dcm', 'd/.git']:
+        path = topdir.join(*path.split('/'))
+        path.dirpath().ensure(dir=True)
+        path.write(path.basename)
+    os.symlink(str(topdir.join('a')), str(topdir.join('link')))
+
+
+def test_find_files(tmpdir):
+    _make_tree(tmpdir)
+    topdir = str(tmpdir)
+
+    def find(*args, **kwargs):
+        return sorted(op.relpath(p, topdir)
+                      for p in find_files(*args, topdir=topdir, **kwargs))
+
+    assert find('.*') == [
+        '4.dcm', op.join('a', '.datalad', '6.dcm'),
+        op.join('a', '.heudiconv', '7.dcm'), op.join('a', '1.dcm'),
+        op.join('a', 'b', '2.dcm'), op.join('a', 'b', 'c', '3.txt')]
+    assert find('.*', exclude_vcs=False) == sorted(
+        find('.*') + [op.join('.git', 'objects', '5'), '.gitattributes',
+                      op.join('d', '.git')])
+    assert find(r'\.dcm$', exclude=r'/\.(datalad|heudiconv)/') == [
+        '4.dcm', op.join('a', '1.dcm'), op.join('a', 'b', '2.dcm')]
+    assert find('b', dirs=True) == [
+        op.join('a', 'b'), op.join('a', 'b', '2.dcm'),
+        op.join('a', 'b', 'c'), op.join('a', 'b', 'c', '3.txt')]
+    # symlinks to directories are matched but not descended into
+    assert 'link' in find('link', dirs=True)
+    # paths under directories matching exclude are excluded only if they
+    # match it themselves
+    assert find(r'\.dcm$', exclude=r'/b$', dirs=True) \
+        == find(r'\.dcm$', dirs=True)
+    assert find('b', exclude=r'/b$', dirs=True) == [
+        op.join('a', 'b', '2.dcm'), op.join('a', 'b', 'c'),
+        op.join('a', 'b', 'c', '3.txt')]
+    assert find('b', exclude_dirs=r'/b/$', dirs=True) == []
+
+
+def test_find_files_order(tmpdir):
+    _make_tree(tmpdir)
+    topdir = str(tmpdir)
+    # as os.walk would generate them, directories before files
+    expected = []
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        expected += [op.join(dirpath, name) for name in dirnames + filenames]
+    assert list(find_files('.*', topdir=topdir, exclude_vcs=False,
+                           dirs=True)) == expected
+
+
+def test_find_files_prunes(tmpdir):
+    _make_tree(tmpdir)
+    scanned = []
+
+    def scandir(path):
+        scanned.append(op.relpath(path, str(tmpdir)))
+        return os.scandir(path)
+
+    with patch.object(parser, 'scandir', scandir):
+        found = list(find_files('.*', topdir=str(tmpdir),
+                                exclude_dirs=r'/\.(datalad|heudiconv)/$'))
+    assert sorted(scanned) == [
+        '.', 'a', op.join('a', 'b'), op.join('a', 'b', 'c'), 'd']
+    assert len(found) == 4
+
+
+def test_find_files_stat(tmpdir):
+    _make_tree(tmpdir)
+    os.symlink(str(tmpdir.join('missing')), str(tmpdir.join('broken')))
+    found = dict(find_files('.*', topdir=str(tmpdir), stat=True))
+    assert found.pop(str(tmpdir.join('broken'))) is None
+    assert len(found) == 6
+    for path, st in found.items():
+        assert (st.st_size, st.st_mtime) \
+            == (os.stat(path).st_size, os.stat(path).st_mtime)
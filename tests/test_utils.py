@@ -1,12 +1,17 @@
+import errno
 import os
 import os.path as op
+from heudiconv import utils
 from heudiconv.utils import (
     get_known_heuristics_with_descriptions,
     get_heuristic_description,
     load_heuristic,
-    json_dumps_pretty)
+    json_dumps_pretty,
+    output_file,
+    safe_movefile)
 
 import pytest
+from mock import patch
 from .utils import HEURISTICS_PATH
 
 
@@ -52,3 +57,64 @@ def test_json_dumps_pretty():
         == '{\n  "a": -1,\n  "b": "123",\n  "c": [1, 2, 3],\n  "d": ["1.0", "2.0"]\n}'
     assert pretty({'a': ["0.3", "-1.9128906358217845e-12", "0.2"]}) \
         == '{\n  "a": ["0.3", "-1.9128906358217845e-12", "0.2"]\n}'
+
+
+def test_safe_movefile(tmpdir):
+    src, dest = tmpdir.join('src'), tmpdir.join('dest')
+    src.write('content')
+    ino = os.stat(str(src)).st_ino
+    safe_movefile(str(src), str(dest))
+    assert not src.check()
+    assert dest.read() == 'content'
+    # file got renamed, not copied
+    assert os.stat(str(dest)).st_ino == ino
+
+    src.write('new')
+    with pytest.raises(RuntimeError):
+        safe_movefile(str(src), str(dest))
+    # copied if cannot be renamed across filesystems
+    with patch.object(utils.os, 'rename',
+                      side_effect=OSError(errno.EXDEV, 'cross-device')):
+        safe_movefile(str(src), str(dest), overwrite=True)
+    assert src.read() == dest.read() == 'new'
+
+
+def test_output_file(tmpdir):
+    src = tmpdir.join('src')
+    src.write('content')
+    for mode in 'copy', 'hardlink', 'symlink', 'reflink':
+        dest = str(tmpdir.join(mode))
+        output_file(str(src), dest, mode)
+        with open(dest) as f:
+            assert f.read() == 'content'
+        assert op.islink(dest) == (mode == 'symlink')
+        assert os.lstat(dest).st_nlink == (2 if mode == 'hardlink' else 1)
+    assert os.readlink(str(tmpdir.join('symlink'))) == str(src)
+
+    # copied if cannot be hard linked
+    with patch.object(utils.os, 'link',
+                      side_effect=OSError(errno.EXDEV, 'cross-device')):
+        output_file(str(src), str(tmpdir.join('hardlink2')), 'hardlink')
+    assert tmpdir.join('hardlink2').read() == 'content'
+    assert os.stat(str(src)).st_nlink == 2
+
+    with pytest.raises(ValueError):
+        output_file(str(src), str(tmpdir.join('unknown')), 'unknown')
+
+
+@pytest.mark.skipif(not utils.can_lock(), reason="fcntl is not available")
+def test_locked(tmpdir):
+    lockfile = tmpdir.join('.heudiconv', '.lock')
+    # nothing to lock against unless sessions get processed concurrently
+    with utils.locked(str(tmpdir)):
+        pass
+    assert not tmpdir.join('.heudiconv').exists()
+
+    with patch.object(utils, '_locking', True):
+        with utils.locked(str(tmpdir)):
+            assert lockfile.exists()
+        # no lock file can be opened, but that should not stop the work
+        other = tmpdir.mkdir('other')
+        other.join('.heudiconv').write('')
+        with utils.locked(str(other)):
+            pass